@@ -156,6 +156,10 @@ CELERY_BEAT_SCHEDULE = {
         'task': 'admin_panel.tasks.inactive_customers_activity_email_notifier',
         'schedule': 60 * 60 * 24,  # Run every day (in seconds)
     },
+    'database-profiler-index-advisor': {
+        'task': 'database_profiler.tasks.run_index_advisor',
+        'schedule': 60 * 60,  # Run every hour (in seconds)
+    },
 }
 
 # django-cacheops Configuration
@@ -165,6 +169,42 @@ CACHEOPS = {
     'auth.*': {'ops': 'all', 'timeout': 60 * 5},        # Cache auth models for 5min
 }
 
+# database profiler configuration (see database_profiler/conf.py for all options)
+DATABASE_PROFILER = {
+    'WRITER_QUEUE_SIZE': 10000,
+    'WRITER_BATCH_SIZE': 200,
+    'WRITER_FLUSH_INTERVAL_SECONDS': 1.0,
+    'WRITER_OVERFLOW_POLICY': 'drop_oldest',  # drop_oldest, drop_newest or block
+    'STORAGE_FORMAT': 'compact',  # compact or expanded
+    'CAPTURE_PARAMS': False,
+    'SAMPLE_RATE': 1.0,
+    'PATH_SAMPLE_RATES': {},  # e.g. {'/film/films/': 0.1}
+    'SLOW_REQUEST_THRESHOLD_SECONDS': 1.0,
+    'ERROR_STATUS_THRESHOLD': 500,
+    'RESPONSE_CAPTURE': 'full',  # off, hash, preview or full
+    'RESPONSE_PREVIEW_CHARS': 512,
+    'MEASURE_FETCH_TIME': False,
+    'CAPTURE_STACKS': False,
+    'STACK_DEPTH': 5,
+    'ROLLUPS_ENABLED': True,
+    'MINUTE_ROLLUP_RETENTION_DAYS': 7,  # hour buckets are kept forever
+    'FINGERPRINT_STATS_ENABLED': True,
+    'ENSURE_INDEXES_ON_STARTUP': True,
+    'RETENTION_DAYS': 30,
+    'COUNT_CACHE_SECONDS': 60,
+    'EXPORT_BATCH_SIZE': 1000,
+    'ADVISOR_LOOKBACK_HOURS': 24,
+    'ADVISOR_MAX_FINGERPRINTS': 200,
+    'ADVISOR_WHAT_IF': True,
+    'ADVISOR_WHAT_IF_DB_ALIAS': None,  # e.g. a 'scratch' entry in DATABASES, used when HypoPG is missing
+    'EXPLAIN_SLOW_QUERIES': False,
+    'EXPLAIN_ANALYZE_MAX_PER_HOUR': 2,
+    'EXPLAIN_ANALYZE_DB_ALIAS': None,  # e.g. a read replica
+    'RELEASE_ENV_VAR': 'RELEASE_ID',
+    'REGRESSION_THRESHOLD': 0.2,
+    'REGRESSION_MIN_SAMPLES': 30,
+}
+
 # Logging Configuration
 LOGGING = {
     'version': 1,
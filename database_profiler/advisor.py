@@ -0,0 +1,411 @@
+import json
+import logging
+import re
+from collections import namedtuple
+from datetime import datetime as dt, timedelta
+import sqlglot
+from sqlglot import exp
+from django.core.cache import cache
+from django.db import connections, transaction
+from pymongo import UpdateOne
+from pymongo_wrapper.model import Query, IndexSuggestion, SqlText
+from .conf import profiler_setting
+from .fingerprint import normalize_sql
+
+logger = logging.getLogger(__name__)
+
+IndexInfo = namedtuple('IndexInfo', ['name', 'columns', 'is_unique'])
+
+# how the cost of a plan with a suggested index is estimated
+HYPOPG = 'hypopg'
+SCRATCH_DATABASE = 'scratch_database'
+
+
+def workload_fingerprints(since, limit):
+    """
+    The distinct SELECT fingerprints captured since the given datetime, most expensive first,
+    each with one sample statement and how often and how long it ran.
+    Compact documents only reference the statement, it is looked up in SqlText.
+    """
+    return list(Query.aggregate([
+        {"$match": {"request_execution_datetime": {"$gte": since}, "query_count": {"$gt": 0}}},
+        {"$unwind": "$queries"},
+        {"$match": {"queries.fingerprint": {"$exists": True}}},
+        {
+            "$group": {
+                "_id": "$queries.fingerprint",
+                "sql": {"$first": "$queries.sql"},
+                "params": {"$first": "$queries.params"},
+                "tables": {"$first": "$queries.tables"},
+                "db_alias": {"$first": {"$ifNull": ["$queries.db_alias", "$db_alias"]}},
+                "call_count": {"$sum": 1},
+                "total_duration": {"$sum": {"$ifNull": [
+                    "$queries.execution_duration", {"$divide": ["$queries.duration_us", 1000000]}]}}
+            }
+        },
+        {"$lookup": {"from": SqlText._get_name(), "localField": "_id", "foreignField": "fingerprint", "as": "text"}},
+        {
+            "$set": {
+                "sql": {"$ifNull": ["$sql", {"$first": "$text.sql"}]},
+                "params": {"$ifNull": ["$params", {"$first": "$text.params"}]},
+                "tables": {"$ifNull": ["$tables", {"$first": "$text.tables"}]},
+            }
+        },
+        {"$unset": "text"},
+        {"$match": {"sql": {"$regex": r"^\s*SELECT", "$options": "i"}}},
+        {"$sort": {"total_duration": -1}},
+        {"$limit": limit},
+    ]))
+
+
+def generic_plan_sql(sql):
+    """
+    Number the %s placeholders of a statement ($1, $2, ...) for EXPLAIN (GENERIC_PLAN), which
+    plans a statement without its params. Escaped percent signs are unescaped, the statement is
+    executed without params.
+    """
+    numbers = iter(range(1, sql.count('%s') + 1))
+    return re.sub(r'%%|%s', lambda match: '%' if match.group() == '%%' else f'${next(numbers)}', sql)
+
+
+def explain(cursor, sql, params):
+    """
+    Return the root plan node of EXPLAIN (FORMAT JSON) for a statement. The statement is not run.
+    Statements captured without params (CAPTURE_PARAMS off) get a generic plan, PostgreSQL 16 or later.
+    """
+    if params is None:
+        cursor.execute(f"EXPLAIN (GENERIC_PLAN, FORMAT JSON) {generic_plan_sql(sql)}")
+    else:
+        cursor.execute(f"EXPLAIN (FORMAT JSON) {sql}", params)
+    plan_data = cursor.fetchall()[0][0]
+    if isinstance(plan_data, str):
+        plan_data = json.loads(plan_data)
+    return plan_data[0]["Plan"]
+
+
+def cached_explain(cursor, db_alias, fingerprint, sql, params):
+    """
+    EXPLAIN a fingerprint's sample statement, reusing the plan for ADVISOR_EXPLAIN_CACHE_SECONDS.
+    """
+    cache_key = f'database_profiler:explain:{db_alias}:{fingerprint}'
+    plan = cache.get(cache_key)
+    if plan is None:
+        plan = explain(cursor, sql, params)
+        cache.set(cache_key, plan, profiler_setting('ADVISOR_EXPLAIN_CACHE_SECONDS'))
+    return plan
+
+
+def find_seq_scan_nodes(plan):
+    """Recursively find all Seq Scan nodes in the query plan."""
+    nodes = []
+    if plan.get("Node Type") == "Seq Scan":
+        nodes.append(plan)
+    for subplan in plan.get("Plans", []):
+        nodes.extend(find_seq_scan_nodes(subplan))
+    return nodes
+
+
+def table_row_counts(cursor, tables):
+    """
+    Estimated row counts of all given tables, in a single pg_class lookup.
+    """
+    cursor.execute("SELECT relname, reltuples FROM pg_class WHERE relkind IN ('r', 'p', 'm') AND relname = ANY(%s)",
+                   [list(tables)])
+    return {table: rows or 0 for table, rows in cursor.fetchall()}
+
+
+def table_indexes(cursor, tables):
+    """
+    The valid, non-partial indexes of all given tables with their key columns in key order,
+    in a single pg_index/pg_attribute lookup. Expression keys have no column name (None).
+    """
+    cursor.execute("""
+        SELECT t.relname, i.relname, ix.indisunique,
+               ARRAY(
+                   SELECT a.attname
+                   FROM unnest(ix.indkey::int2[]) WITH ORDINALITY AS k(attnum, ord)
+                   LEFT JOIN pg_attribute a ON a.attrelid = ix.indrelid AND a.attnum = k.attnum AND k.attnum > 0
+                   WHERE k.ord <= ix.indnkeyatts
+                   ORDER BY k.ord
+               )
+        FROM pg_index ix
+        JOIN pg_class t ON t.oid = ix.indrelid
+        JOIN pg_class i ON i.oid = ix.indexrelid
+        WHERE t.relname = ANY(%s) AND ix.indisvalid AND ix.indpred IS NULL
+    """, [list(tables)])
+    indexes = {}
+    for table, name, is_unique, columns in cursor.fetchall():
+        indexes.setdefault(table, []).append(IndexInfo(name, tuple(columns), is_unique))
+    return indexes
+
+
+def _conjuncts(condition):
+    if isinstance(condition, exp.Paren):
+        return _conjuncts(condition.this)
+    if isinstance(condition, exp.And):
+        return _conjuncts(condition.this) + _conjuncts(condition.expression)
+    return [condition]
+
+
+def index_key_columns(sql, table):
+    """
+    The columns of table a statement looks up by equality (=, IN, IS, join conditions), by range
+    (<, <=, >, >=, BETWEEN) and sorts on, each in statement order.
+    The statement is normalized first, sqlglot cannot parse Django's %s placeholders.
+    """
+    parsed = sqlglot.parse_one(normalize_sql(sql))
+    statement_tables = list(parsed.find_all(exp.Table))
+    # Django qualifies every column, with the table name or an alias such as T3
+    names = {table} | {statement_table.alias_or_name for statement_table in statement_tables
+                       if statement_table.name == table}
+    is_single_table = {statement_table.name for statement_table in statement_tables} == {table}
+
+    def own_column(node):
+        if isinstance(node, exp.Column) and (node.table in names or (not node.table and is_single_table)):
+            return node.name
+        return None
+
+    predicates = []
+    for join in parsed.args.get('joins') or []:
+        if join.args.get('on') is not None:
+            predicates.extend(_conjuncts(join.args['on']))
+    where = parsed.args.get('where')
+    if where is not None:
+        predicates.extend(_conjuncts(where.this))
+
+    equality, range_ = [], []
+    for predicate in predicates:
+        if isinstance(predicate, (exp.EQ, exp.In, exp.Is)):
+            columns = equality
+        elif isinstance(predicate, (exp.GT, exp.GTE, exp.LT, exp.LTE, exp.Between)):
+            columns = range_
+        else:
+            continue
+        for side in (predicate.this, predicate.args.get('expression')):
+            column = own_column(side)
+            if column:
+                if column not in columns:
+                    columns.append(column)
+                break
+
+    order = []
+    if parsed.args.get('order') is not None:
+        for ordered in parsed.args['order'].expressions:
+            column = own_column(ordered.this)
+            if column and column not in order:
+                order.append(column)
+
+    range_ = [column for column in range_ if column not in equality]
+    return equality, range_, order
+
+
+def propose_index(equality, range_, order):
+    """
+    Composite index key for the given columns: equality columns first, then the first range
+    column. Without a range column the ORDER BY columns follow, so the index also provides the order.
+    """
+    columns = list(equality)
+    if range_:
+        columns.append(range_[0])
+    else:
+        columns.extend(column for column in order if column not in columns)
+    return columns
+
+
+def covering_index(indexes, columns, equality_count):
+    """
+    Return an existing index whose leading keys serve the proposed columns, or None.
+    The equality columns may come in any order, the remaining ones must follow in order.
+    """
+    for index in indexes:
+        keys = index.columns
+        if len(keys) < len(columns):
+            continue
+        if set(keys[:equality_count]) == set(columns[:equality_count]) \
+                and list(keys[equality_count:len(columns)]) == columns[equality_count:]:
+            return index
+    return None
+
+
+def suggest_indexes(sql, plan, avg_duration, row_counts, indexes):
+    """
+    Suggest composite indexes for the selective sequential scans of a plan.
+    A scan qualifies when its table has more than ADVISOR_MIN_TABLE_ROWS rows, it is expected to
+    return less than ADVISOR_MAX_SELECTIVITY of them and the statement takes at least
+    ADVISOR_MIN_DURATION_SECONDS on average.
+    """
+    if avg_duration < profiler_setting('ADVISOR_MIN_DURATION_SECONDS'):
+        return []
+    suggestions = []
+    for node in find_seq_scan_nodes(plan):
+        table = node.get("Relation Name")
+        total_rows = row_counts.get(table, 0)
+        estimated_rows = node.get("Plan Rows", 0)
+        selectivity = estimated_rows / total_rows if total_rows > 0 else 1.0
+        if total_rows <= profiler_setting('ADVISOR_MIN_TABLE_ROWS') \
+                or selectivity >= profiler_setting('ADVISOR_MAX_SELECTIVITY'):
+            continue
+        equality, range_, order = index_key_columns(sql, table)
+        columns = propose_index(equality, range_, order)
+        existing_indexes = indexes.get(table, [])
+        if not columns or covering_index(existing_indexes, columns, len(equality)):
+            continue
+        suggestions.append({
+            'table': table,
+            'columns': columns,
+            'equality_columns': equality,
+            'range_columns': range_,
+            'order_columns': order,
+            'statement': 'CREATE INDEX ON "{}" ({})'.format(table, ', '.join(f'"{column}"' for column in columns)),
+            # existing indexes whose leading column the statement can use, e.g. to extend them instead
+            'usable_indexes': [index.name for index in existing_indexes if index.columns
+                               and index.columns[0] in equality + range_],
+            'total_rows': total_rows,
+            'estimated_rows': estimated_rows,
+            'selectivity': selectivity,
+        })
+    return suggestions
+
+
+def has_hypopg(cursor):
+    cursor.execute("SELECT 1 FROM pg_extension WHERE extname = 'hypopg'")
+    return cursor.fetchone() is not None
+
+
+def hypothetical_index_cost(cursor, statement, sql, params):
+    """
+    The plan costs (without, with) of a statement and a HypoPG hypothetical index, which only
+    exists in the planner. Both plans come from the same connection, one right after the other.
+    """
+    base_cost = explain(cursor, sql, params)["Total Cost"]
+    cursor.execute("SELECT indexrelid FROM hypopg_create_index(%s)", [statement])
+    try:
+        return base_cost, explain(cursor, sql, params)["Total Cost"]
+    finally:
+        cursor.execute("SELECT hypopg_reset()")
+
+
+def scratch_index_cost(db_alias, statement, sql, params):
+    """
+    The plan costs (without, with) of a statement and an index really created on the scratch
+    database, both in one transaction that is rolled back. CREATE INDEX builds the index and
+    locks the table against writes, which is why this never runs on the database serving the application.
+    """
+    with transaction.atomic(using=db_alias):
+        with connections[db_alias].cursor() as cursor:
+            base_cost = explain(cursor, sql, params)["Total Cost"]
+            cursor.execute(statement)
+            cost = explain(cursor, sql, params)["Total Cost"]
+        transaction.set_rollback(True, using=db_alias)
+    return base_cost, cost
+
+
+def what_if_method(cursor):
+    """
+    HypoPG when the extension is installed, otherwise the scratch database if one is configured.
+    """
+    if has_hypopg(cursor):
+        return HYPOPG
+    if profiler_setting('ADVISOR_WHAT_IF_DB_ALIAS'):
+        return SCRATCH_DATABASE
+    return None
+
+
+def evaluate_suggestions(cursor, method, item, suggestions):
+    """
+    Estimate the plan cost of the fingerprint's statement with each suggested index and weight
+    the cost reduction by how often the fingerprint ran. Returns the highest estimated benefit.
+
+    The cost without the index is EXPLAINed again right before each what-if plan, on the same
+    database: the cached plan may be hours old and, with a scratch database, from another database.
+    """
+    best_benefit = 0.0
+    for suggestion in suggestions:
+        try:
+            if method == HYPOPG:
+                base_cost, cost = hypothetical_index_cost(cursor, suggestion['statement'], item['sql'], item['params'])
+            else:
+                base_cost, cost = scratch_index_cost(profiler_setting('ADVISOR_WHAT_IF_DB_ALIAS'),
+                                                     suggestion['statement'], item['sql'], item['params'])
+        except Exception as e:
+            logger.warning(f"What-if evaluation of {suggestion['statement']} failed: {e}")
+            continue
+        suggestion['base_cost'] = base_cost
+        suggestion['estimated_cost'] = cost
+        suggestion['cost_reduction'] = max(base_cost - cost, 0.0)
+        suggestion['estimated_benefit'] = suggestion['cost_reduction'] * item['call_count']
+        best_benefit = max(best_benefit, suggestion['estimated_benefit'])
+    suggestions.sort(key=lambda suggestion: suggestion.get('estimated_benefit', 0.0), reverse=True)
+    return best_benefit
+
+
+def _advise_alias(db_alias, workload):
+    """
+    EXPLAIN the workload of one database and return the IndexSuggestion upserts.
+    The catalog is read once for all tables scanned by the workload's plans.
+    """
+    connection = connections[db_alias]
+    if connection.vendor != 'postgresql':
+        logger.info(f"Skipping the index advisor for the {connection.vendor} database {db_alias}")
+        return []
+
+    analyzed_at = dt.now()
+    plans = {}
+    with connection.cursor() as cursor:
+        for item in workload:
+            try:
+                plans[item['_id']] = cached_explain(cursor, db_alias, item['_id'], item['sql'], item['params'])
+            except Exception as e:
+                logger.warning(f"EXPLAIN failed for fingerprint {item['_id']}: {e}")
+
+        tables = {node.get("Relation Name") for plan in plans.values() for node in find_seq_scan_nodes(plan)}
+        tables.discard(None)
+        row_counts = table_row_counts(cursor, tables) if tables else {}
+        indexes = table_indexes(cursor, tables) if tables else {}
+        method = what_if_method(cursor) if profiler_setting('ADVISOR_WHAT_IF') else None
+
+        operations = []
+        for item in workload:
+            plan = plans.get(item['_id'])
+            if plan is None:
+                continue
+            try:
+                suggestions = suggest_indexes(item['sql'], plan, item['total_duration'] / item['call_count'],
+                                              row_counts, indexes)
+            except Exception as e:
+                logger.warning(f"Analyzing fingerprint {item['_id']} failed: {e}")
+                continue
+            estimated_benefit = evaluate_suggestions(cursor, method, item, suggestions) \
+                if method and suggestions else 0.0
+            operations.append(UpdateOne({'fingerprint': item['_id']}, {'$set': {
+                'sql': item['sql'],
+                'tables': item['tables'],
+                'db_alias': db_alias,
+                'call_count': item['call_count'],
+                'total_duration': item['total_duration'],
+                'suggestions': suggestions,
+                'estimated_benefit': estimated_benefit,
+                'what_if_method': method if suggestions else None,
+                'analyzed_at': analyzed_at,
+            }}, upsert=True))
+    return operations
+
+
+def advise_workload():
+    """
+    Run the index advisor over the distinct fingerprints of the recent workload and store one
+    IndexSuggestion per fingerprint. Returns the number of fingerprints analyzed.
+    """
+    since = dt.now() - timedelta(hours=profiler_setting('ADVISOR_LOOKBACK_HOURS'))
+    workload = workload_fingerprints(since, profiler_setting('ADVISOR_MAX_FINGERPRINTS'))
+
+    by_alias = {}
+    for item in workload:
+        by_alias.setdefault(item.get('db_alias') or 'default', []).append(item)
+
+    operations = []
+    for db_alias, items in by_alias.items():
+        operations.extend(_advise_alias(db_alias, items))
+    if operations:
+        IndexSuggestion.bulk_write(operations, ordered=False)
+    return len(operations)
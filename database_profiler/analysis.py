@@ -0,0 +1,184 @@
+import threading
+from django.apps import apps
+from .fingerprint import get_parse_cache
+from .sampling import SAMPLED
+
+SELECT_RELATED = 'select_related'
+PREFETCH_RELATED = 'prefetch_related'
+
+
+class RelationIndex:
+    """
+    Model metadata needed by the N+1 detector, computed once from the app registry:
+    table -> model, and (parent table, related table) -> (select_related/prefetch_related, field name).
+    """
+
+    def __init__(self, models):
+        self.models = {}
+        self.relations = {}
+        for model in models:
+            self.models.setdefault(model._meta.db_table, model)
+        # forward ForeignKey/OneToOneField relations win over many-to-many and reverse ones
+        for model in models:
+            for field in model._meta.get_fields():
+                if field.is_relation and (field.one_to_one or field.many_to_one) and field.related_model:
+                    self.relations.setdefault((model._meta.db_table, field.related_model._meta.db_table),
+                                              (SELECT_RELATED, field.name))
+        for model in models:
+            for field in model._meta.get_fields():
+                if field.is_relation and (field.many_to_many or field.one_to_many) and field.related_model:
+                    self.relations.setdefault((model._meta.db_table, field.related_model._meta.db_table),
+                                              (PREFETCH_RELATED, field.name))
+
+    def relation(self, parent_table, related_table):
+        return self.relations.get((parent_table, related_table))
+
+
+_relation_index = None
+_relation_index_lock = threading.Lock()
+
+
+def get_relation_index():
+    """
+    Return the process-wide RelationIndex. Built by the app's ready() hook, or on first use.
+    """
+    global _relation_index
+    if _relation_index is None:
+        with _relation_index_lock:
+            if _relation_index is None:
+                _relation_index = RelationIndex(apps.get_models())
+    return _relation_index
+
+
+def get_model_for_table(table_name):
+    """
+    Find the Django model associated with a table name.
+    """
+    return get_relation_index().models.get(table_name)
+
+
+def is_foreign_key_relationship(parent_table, related_table):
+    """
+    Check if there's a ForeignKey or OneToOneField from parent_table to related_table.
+    """
+    relation = get_relation_index().relation(parent_table, related_table)
+    if relation and relation[0] == SELECT_RELATED:
+        return relation[1]
+    return None
+
+
+def is_many_to_many_or_reverse_fk(parent_table, related_table):
+    """
+    Check if there's a ManyToManyField or reverse ForeignKey from parent_table to related_table.
+    """
+    relation = get_relation_index().relation(parent_table, related_table)
+    if relation and relation[0] == PREFETCH_RELATED:
+        return relation[1]
+    return None
+
+
+def find_n_plus_one_groups(queries, relation_index=None):
+    """
+    Find every group of repeated single-table SELECTs that an earlier or neighbouring query
+    could have loaded with select_related or prefetch_related.
+
+    Queries are grouped by fingerprint in one pass, so the cost is linear in the number of
+    queries (plus one relation lookup per repeated group and table).
+    """
+    relation_index = relation_index or get_relation_index()
+    groups = {}
+    # table -> fingerprints of the queries touching it, in order of first appearance
+    table_fingerprints = {}
+    for index, query in enumerate(queries):
+        for table in query['tables']:
+            table_fingerprints.setdefault(table, set()).add(query['fingerprint'])
+        if not query['sql'].lstrip().upper().startswith('SELECT'):
+            continue
+        key = (query['fingerprint'], tuple(query['tables']))
+        group = groups.get(key)
+        if group is None:
+            groups[key] = {'first_query_index': index, 'count': 1}
+        else:
+            group['count'] += 1
+
+    n_plus_one_groups = []
+    for (fingerprint, tables), group in groups.items():
+        if group['count'] < 2 or len(tables) != 1:
+            continue
+        related_table = tables[0]
+        for parent_table, fingerprints in table_fingerprints.items():
+            # tables only touched by the repeated query itself cannot be the parent
+            if fingerprints == {fingerprint}:
+                continue
+            relation = relation_index.relation(parent_table, related_table)
+            if relation:
+                method, field_name = relation
+                n_plus_one_groups.append({
+                    'fingerprint': fingerprint,
+                    'sql': queries[group['first_query_index']]['sql'],
+                    'table': related_table,
+                    'parent_table': parent_table,
+                    'count': group['count'],
+                    'first_query_index': group['first_query_index'],
+                    'call_site': queries[group['first_query_index']].get('call_site'),
+                    'suggestion': f"Use {method}('{field_name}')",
+                })
+                break
+    return n_plus_one_groups
+
+
+def detect_n_plus_one(queries):
+    """
+    Detect N+1 query patterns and suggest select_related or prefetch_related.
+    Returns (is_n_plus_one, suggestion) for the first group found.
+    """
+    n_plus_one_groups = find_n_plus_one_groups(queries)
+    if not n_plus_one_groups:
+        return False, None
+    return True, n_plus_one_groups[0]['suggestion']
+
+
+def analyze_record(record):
+    """
+    Deferred analysis stage for a captured request record.
+    Fills in the fingerprint and table list of every query, the N+1 detection fields
+    and the per-request aggregates.
+    """
+    parse_cache = get_parse_cache()
+    for query in record['queries']:
+        parsed = parse_cache.parse(query['sql'])
+        query['fingerprint'] = parsed.fingerprint
+        query['tables'] = list(parsed.tables)
+    n_plus_one_groups = find_n_plus_one_groups(record['queries'])
+    record['n_plus_one_groups'] = n_plus_one_groups
+    record['is_n_plus_one'] = bool(n_plus_one_groups)
+    record['n_plus_one_suggestion'] = n_plus_one_groups[0]['suggestion'] if n_plus_one_groups else None
+    record.update(request_aggregates(record['queries']))
+    record['app_duration'] = app_duration(record)
+    return record
+
+
+def app_duration(record):
+    """
+    Time the request spent outside the database: Python code, serialization and rendering.
+    Only known when the request's queries were captured.
+    """
+    if record.get('request_duration') is None or record.get('sample_reason') not in (None, SAMPLED):
+        return None
+    return max(record['request_duration'] - record['total_duration'] - record['total_fetch_duration'], 0.0)
+
+
+def request_aggregates(queries):
+    """
+    Per-request aggregates stored on each Query document, so the analytics views
+    can sort on indexed fields instead of recomputing them for every document.
+    """
+    durations = [query['execution_duration'] for query in queries]
+    max_query_duration = max(durations, default=0.0)
+    return {
+        'total_duration': sum(durations, 0.0),
+        'total_fetch_duration': sum((query.get('fetch_duration') or 0.0 for query in queries), 0.0),
+        'query_count': len(durations),
+        'max_query_duration': max_query_duration,
+        'slowest_query_index': durations.index(max_query_duration) if durations else None,
+    }
@@ -1,6 +1,17 @@
+import threading
 from django.apps import AppConfig
 
 
 class DatabaseProfilerConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'database_profiler'
+
+    def ready(self):
+        from .analysis import get_relation_index
+        from .conf import profiler_setting
+        from .indexes import ensure_profiler_indexes
+        # Model metadata for the N+1 detector, so the writer never walks the app registry
+        get_relation_index()
+        if profiler_setting('ENSURE_INDEXES_ON_STARTUP'):
+            # Runs in the background so an unreachable MongoDB never delays startup
+            threading.Thread(target=ensure_profiler_indexes, name='database-profiler-indexes', daemon=True).start()
@@ -0,0 +1,219 @@
+import hashlib
+import json
+import os
+import sys
+import sysconfig
+import time
+from datetime import datetime as dt
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+from utils.helpers import convert_to_bson_safe
+
+RESPONSE_CAPTURE_OFF = 'off'
+RESPONSE_CAPTURE_HASH = 'hash'
+RESPONSE_CAPTURE_PREVIEW = 'preview'
+RESPONSE_CAPTURE_FULL = 'full'
+RESPONSE_CAPTURE_POLICIES = (RESPONSE_CAPTURE_OFF, RESPONSE_CAPTURE_HASH, RESPONSE_CAPTURE_PREVIEW,
+                             RESPONSE_CAPTURE_FULL)
+
+# sent by the replay_workload command, "<replay run id>:<id of the replayed Query document>"
+REPLAY_ID_HEADER = 'X-Profiler-Replay-Id'
+
+
+_PROFILER_DIR = os.path.dirname(os.path.abspath(__file__))
+_LIBRARY_DIRS = tuple({sysconfig.get_path('purelib'), sysconfig.get_path('platlib'), sysconfig.get_path('stdlib')})
+
+
+def _is_project_file(filename):
+    return filename.startswith(str(settings.BASE_DIR)) and not filename.startswith(_PROFILER_DIR) \
+        and not filename.startswith(_LIBRARY_DIRS)
+
+
+def project_call_site(depth):
+    """
+    Return the innermost depth frames of the current stack that belong to the project
+    (not Django, other libraries or the profiler), innermost first, as "path:line in function".
+    Frames are walked directly instead of through traceback, so no source lines are read.
+    """
+    frames = []
+    frame = sys._getframe(1)
+    while frame is not None and len(frames) < depth:
+        code = frame.f_code
+        if _is_project_file(code.co_filename):
+            frames.append(f"{os.path.relpath(code.co_filename, settings.BASE_DIR)}:{frame.f_lineno} in {code.co_name}")
+        frame = frame.f_back
+    return frames
+
+
+def _response_body(response):
+    """
+    Return the JSON body of a DRF response as bytes, or None.
+    DRF has already rendered the response by the time it reaches the middleware, so for JSON
+    responses the rendered content is reused; anything else is serialized here, exactly once.
+    """
+    data = getattr(response, 'data', None)
+    if data is None or response.streaming:
+        return None
+    if getattr(response, 'is_rendered', True) and response.get('Content-Type', '').startswith('application/json'):
+        return response.content
+    try:
+        return json.dumps(data).encode()
+    except (TypeError, ValueError):
+        return None
+
+
+class RequestCapture:
+    """
+    Profiler state of a single request.
+
+    A new instance is created for every request and kept on the request object,
+    so concurrent requests served by the same middleware instance (threaded
+    workers, ASGI) never share captured queries. The instance itself is the
+    execute wrapper installed on the database connection.
+    """
+
+    def __init__(self, request_path, is_capturing, measure_fetch_time=False, stack_depth=0, release=None):
+        self.request_path = request_path
+        self.release = release
+        self.request_method = None
+        self.request_query_string = None
+        self.request_authenticated = False
+        self.replay_id = None
+        self.request_execution_datetime = dt.now()
+        self.is_capturing = is_capturing
+        self.measure_fetch_time = measure_fetch_time
+        # number of project frames kept per distinct SQL statement, 0 disables stack capture
+        self.stack_depth = stack_depth
+        self.captured_call_sites = set()
+        # time spent in the profiler's own bookkeeping, excluded from the recorded durations
+        self.profiler_overhead = 0.0
+        self.sample_reason = None
+        self.request_finished_datetime = None
+        self.request_duration = None
+        self.render_duration = None
+        self.queries = []
+        self.response_status_code = None
+        self.response_data = None
+        self.response_size = None
+        self.response_hash = None
+        self.response_preview = None
+
+    def __call__(self, execute, sql, params, many, context):
+        wrapper_start_time = time.perf_counter()
+        execution_time = timezone.now()
+        # Only the driver call is timed: everything else here is profiler overhead
+        start_time = time.perf_counter()
+        result = execute(sql, params, many, context)
+        execution_duration = time.perf_counter() - start_time
+        query = {
+            'sql': sql,
+            # Preprocess params to values MongoDB can store (UUIDs, Decimals, dates, ...)
+            'params': tuple(convert_to_bson_safe(param) for param in params) if params is not None else (),
+            'execution_duration': execution_duration,
+            'execution_time': execution_time,
+            'is_in_transaction': context['connection'].in_atomic_block,
+            'db_alias': context['connection'].alias,
+            'rows_affected': context['cursor'].rowcount,
+            'db_vendor': connection.vendor,
+            'needs_rollback': context['connection'].needs_rollback,
+        }
+        if self.stack_depth and sql not in self.captured_call_sites:
+            # The ORM repeats the same SQL text (with different params) for every row of an N+1,
+            # so the stack is only walked the first time a statement runs in the request
+            self.captured_call_sites.add(sql)
+            query['call_site'] = project_call_site(self.stack_depth)
+        if self.measure_fetch_time:
+            query['fetch_duration'] = 0.0
+            self._time_fetches(context['cursor'], query)
+        self.queries.append(query)
+        self.profiler_overhead += time.perf_counter() - wrapper_start_time - execution_duration
+        return result
+
+    def _time_fetches(self, cursor, query):
+        """
+        Add the time spent fetching rows from cursor to the query's fetch_duration.
+
+        Django's CursorWrapper resolves the fetch methods through __getattr__, so instance
+        attributes shadow them. With server-side cursors (QuerySet.iterator() on PostgreSQL)
+        the rows are only read from the database during these calls.
+        """
+        for name in ('fetchone', 'fetchmany', 'fetchall'):
+            # drop the wrapper of a previous statement on the same cursor
+            cursor.__dict__.pop(name, None)
+            setattr(cursor, name, self._timed_fetch(getattr(cursor, name), query))
+
+    @staticmethod
+    def _timed_fetch(fetch, query):
+        def timed_fetch(*args, **kwargs):
+            start_time = time.perf_counter()
+            try:
+                return fetch(*args, **kwargs)
+            finally:
+                query['fetch_duration'] += time.perf_counter() - start_time
+        return timed_fetch
+
+    def capture_request(self, request):
+        """
+        Record what is needed to replay the request: its method, query string, whether it carried
+        credentials, and the replay id when it was sent by the replay_workload command.
+        """
+        self.request_method = request.method
+        self.request_query_string = request.META.get('QUERY_STRING') or None
+        self.request_authenticated = 'HTTP_AUTHORIZATION' in request.META
+        self.replay_id = request.headers.get(REPLAY_ID_HEADER)
+
+    def time_render(self, response):
+        """
+        Measure how long the deferred rendering of a template response (DRF's renderer) takes.
+        Called just before Django renders the response, after the view has returned.
+        """
+        start_time = time.perf_counter()
+
+        def render_finished(rendered_response):
+            self.render_duration = time.perf_counter() - start_time
+
+        response.add_post_render_callback(render_finished)
+
+    def capture_response(self, response, policy, preview_chars):
+        """
+        Record the response status and, depending on the capture policy, its body.
+        With the full policy the body is stored as JSON text, which Mongo stores as is.
+        """
+        self.response_status_code = response.status_code
+        if policy == RESPONSE_CAPTURE_OFF:
+            return
+        body = _response_body(response)
+        if body is None:
+            return
+        self.response_size = len(body)
+        self.response_hash = hashlib.blake2b(body, digest_size=16).hexdigest()
+        if policy == RESPONSE_CAPTURE_PREVIEW:
+            self.response_preview = body[:preview_chars * 4].decode(errors='replace')[:preview_chars]
+        elif policy == RESPONSE_CAPTURE_FULL:
+            self.response_data = body.decode(errors='replace')
+
+    def to_record(self):
+        """
+        Build the record handed over to the background writer.
+        """
+        return dict(
+            queries=self.queries,
+            request_path=self.request_path,
+            request_method=self.request_method,
+            request_query_string=self.request_query_string,
+            request_authenticated=self.request_authenticated,
+            replay_id=self.replay_id,
+            release=self.release,
+            request_execution_datetime=self.request_execution_datetime,
+            response_status_code=self.response_status_code,
+            response_data=self.response_data,
+            response_size=self.response_size,
+            response_hash=self.response_hash,
+            response_preview=self.response_preview,
+            sample_reason=self.sample_reason,
+            request_finished_datetime=self.request_finished_datetime,
+            request_duration=self.request_duration,
+            render_duration=self.render_duration,
+            profiler_overhead=self.profiler_overhead
+        )
@@ -0,0 +1,88 @@
+from django.conf import settings
+
+# Defaults for the DATABASE_PROFILER setting. Any key can be overridden in core/settings.py.
+DEFAULTS = {
+    # background writer
+    'WRITER_QUEUE_SIZE': 10000,
+    'WRITER_BATCH_SIZE': 200,
+    'WRITER_FLUSH_INTERVAL_SECONDS': 1.0,
+    # one of: drop_oldest, drop_newest, block
+    'WRITER_OVERFLOW_POLICY': 'drop_oldest',
+    'WRITER_SHUTDOWN_TIMEOUT_SECONDS': 5.0,
+    # compact (the SQL text is stored once per fingerprint, durations as integer microseconds)
+    # or expanded (every query with its full SQL text); the views read documents of both formats
+    'STORAGE_FORMAT': 'compact',
+    # store the params of every captured query (compact format only, expanded documents always have them)
+    # and a sample per SQL fingerprint; without them the index advisor EXPLAINs generic plans (PostgreSQL 16+)
+    'CAPTURE_PARAMS': False,
+    # also time reading the rows of every captured query (fetch_duration), not only its execution
+    'MEASURE_FETCH_TIME': False,
+    # record the project frames (at most STACK_DEPTH) that ran each distinct SQL statement of a request
+    'CAPTURE_STACKS': False,
+    'STACK_DEPTH': 5,
+    # number of distinct SQL fingerprints kept in the parse cache
+    'PARSE_CACHE_SIZE': 2048,
+    # sampling: fraction of requests whose queries are captured, optionally per path prefix
+    'SAMPLE_RATE': 1.0,
+    'PATH_SAMPLE_RATES': {},
+    # requests that are not sampled are still recorded (without queries) when slower than
+    # this many seconds or when their status code is at least ERROR_STATUS_THRESHOLD
+    'SLOW_REQUEST_THRESHOLD_SECONDS': None,
+    'ERROR_STATUS_THRESHOLD': 500,
+    # response capture: off, hash, preview (size, hash and a truncated preview) or full
+    'RESPONSE_CAPTURE': 'full',
+    'RESPONSE_PREVIEW_CHARS': 512,
+    # per-minute and per-hour rollup buckets used by the analytics views for aligned ranges
+    'ROLLUPS_ENABLED': True,
+    # minute buckets older than this many days are removed by a partial TTL index (None keeps them
+    # forever); older ranges are answered from the hour buckets, which are kept until removed by hand
+    'MINUTE_ROLLUP_RETENTION_DAYS': 7,
+    # lifetime statistics per SQL fingerprint (QueryFingerprint collection), where the most used queries view
+    # and the release comparison find the normalized SQL of a fingerprint
+    'FINGERPRINT_STATS_ENABLED': True,
+    # create the profiler collections' indexes when the app starts
+    'ENSURE_INDEXES_ON_STARTUP': True,
+    # captured requests older than this many days are removed by a TTL index; None keeps them forever
+    'RETENTION_DAYS': None,
+    # how long the optional total counts of the analytics views are cached
+    'COUNT_CACHE_SECONDS': 60,
+    # number of documents the export endpoint fetches from MongoDB per round trip
+    'EXPORT_BATCH_SIZE': 1000,
+    # index advisor (the run_index_advisor Celery task): the most expensive ADVISOR_MAX_FINGERPRINTS
+    # SELECT fingerprints of the last ADVISOR_LOOKBACK_HOURS are EXPLAINed, plans are cached per fingerprint
+    'ADVISOR_LOOKBACK_HOURS': 24,
+    'ADVISOR_MAX_FINGERPRINTS': 200,
+    'ADVISOR_EXPLAIN_CACHE_SECONDS': 60 * 60 * 6,
+    # a sequential scan gets an index suggestion when the table is larger and the scan more selective
+    # than these thresholds and the statement takes at least ADVISOR_MIN_DURATION_SECONDS on average
+    'ADVISOR_MIN_TABLE_ROWS': 100000,
+    'ADVISOR_MAX_SELECTIVITY': 0.01,
+    'ADVISOR_MIN_DURATION_SECONDS': 0.01,
+    # estimate the plan cost with every suggested index and rank suggestions by cost reduction
+    # times call count; uses HypoPG when the extension is installed, otherwise creates the index
+    # in a rolled-back transaction on ADVISOR_WHAT_IF_DB_ALIAS, a scratch copy of the database
+    # (never the application's database: CREATE INDEX locks the table against writes)
+    'ADVISOR_WHAT_IF': True,
+    'ADVISOR_WHAT_IF_DB_ALIAS': None,
+    # re-run the slowest SELECT of requests slower than SLOW_QUERY_DURATION_THRESHOLD_SECONDS with
+    # EXPLAIN ANALYZE in a Celery worker (in a read-only, rolled-back transaction), at most
+    # EXPLAIN_ANALYZE_MAX_PER_HOUR times per fingerprint and hour; EXPLAIN_ANALYZE_DB_ALIAS can
+    # point to a replica, by default the query's own database is used
+    'EXPLAIN_SLOW_QUERIES': False,
+    'EXPLAIN_ANALYZE_MAX_PER_HOUR': 2,
+    'EXPLAIN_ANALYZE_TIMEOUT_SECONDS': 30,
+    'EXPLAIN_ANALYZE_DB_ALIAS': None,
+    # environment variable holding the release (e.g. the deployed commit) every capture is tagged with
+    'RELEASE_ENV_VAR': 'RELEASE_ID',
+    # the release comparison flags a metric when it changes by more than this fraction,
+    # for endpoints and fingerprints with at least REGRESSION_MIN_SAMPLES samples in both releases
+    'REGRESSION_THRESHOLD': 0.2,
+    'REGRESSION_MIN_SAMPLES': 30,
+}
+
+
+def profiler_setting(name):
+    """
+    Return a database profiler setting, falling back to its default.
+    """
+    return getattr(settings, 'DATABASE_PROFILER', {}).get(name, DEFAULTS[name])
@@ -0,0 +1,92 @@
+import csv
+import json
+from datetime import datetime
+from bson import ObjectId
+from pymongo import ASCENDING
+from pymongo_wrapper.model import Query
+from .conf import profiler_setting
+from .storage import decode_response_data, iter_expanded
+
+CSV_COLUMNS = [
+    'request_id', 'request_path', 'request_execution_datetime', 'response_status_code', 'is_n_plus_one',
+    'query_index', 'sql', 'params', 'fingerprint', 'tables', 'execution_duration', 'execution_time',
+    'rows_affected', 'db_alias',
+]
+
+
+def _json_default(value):
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+class _Echo:
+    """
+    A file-like object whose write just returns the value, for streaming csv.writer output.
+    """
+
+    def write(self, value):
+        return value
+
+
+def export_cursor(spec, batch_size):
+    """
+    Server-side cursor over the Query documents matching spec, fetched batch_size documents at a time.
+    The raw collection is used so documents are exported exactly as stored, without model defaults.
+    """
+    return Query._get_collection().find(
+        spec, sort=[("request_execution_datetime", ASCENDING), ("_id", ASCENDING)], batch_size=batch_size)
+
+
+def _iterate(cursor):
+    """
+    The documents of the cursor in the expanded format, EXPORT_BATCH_SIZE documents at a time.
+    """
+    try:
+        yield from iter_expanded(cursor, profiler_setting('EXPORT_BATCH_SIZE'))
+    finally:
+        cursor.close()
+
+
+def stream_ndjson(cursor):
+    """
+    Yield one JSON line per Query document. The response body is written as JSON, not as JSON text.
+    """
+    for document in _iterate(cursor):
+        if 'response_data' in document:
+            document['response_data'] = decode_response_data(document['response_data'])
+        yield json.dumps(document, default=_json_default) + '\n'
+
+
+def stream_csv(cursor):
+    """
+    Yield CSV lines with one row per captured SQL query (or one row for a request without queries).
+    """
+    writer = csv.writer(_Echo())
+    yield writer.writerow(CSV_COLUMNS)
+    for document in _iterate(cursor):
+        request_columns = [
+            str(document['_id']),
+            document.get('request_path'),
+            _json_default(document['request_execution_datetime']),
+            document.get('response_status_code'),
+            document.get('is_n_plus_one'),
+        ]
+        queries = document.get('queries') or [None]
+        for index, query in enumerate(queries):
+            if query is None:
+                yield writer.writerow(request_columns)
+                continue
+            yield writer.writerow(request_columns + [
+                index,
+                query.get('sql'),
+                json.dumps(query.get('params'), default=_json_default),
+                query.get('fingerprint'),
+                '|'.join(query.get('tables') or []),
+                query.get('execution_duration'),
+                _json_default(query['execution_time']) if query.get('execution_time') else None,
+                query.get('rows_affected'),
+                query.get('db_alias'),
+            ])
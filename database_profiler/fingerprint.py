@@ -0,0 +1,121 @@
+import hashlib
+import logging
+import re
+import threading
+from collections import OrderedDict, namedtuple
+import sqlglot
+from .conf import profiler_setting
+
+logger = logging.getLogger(__name__)
+
+_STRING_LITERAL_RE = re.compile(r"'(?:[^']|'')*'")
+_NAMED_PLACEHOLDER_RE = re.compile(r"%\(\w+\)s")
+_NUMBER_RE = re.compile(r"(?<![\w\"])-?\d+(?:\.\d+)?(?![\w\"])")
+_IN_LIST_RE = re.compile(r"\bIN\s*\(\s*\?(?:\s*,\s*\?)*\s*\)", re.IGNORECASE)
+_WHITESPACE_RE = re.compile(r"\s+")
+# savepoint names carry the thread id and a counter (Django's "s<thread>_x<n>"), in
+# SAVEPOINT, RELEASE SAVEPOINT and ROLLBACK TO SAVEPOINT alike
+_SAVEPOINT_RE = re.compile(r"\bSAVEPOINT\s+(?:\"[^\"]*\"|`[^`]*`|\w+)", re.IGNORECASE)
+
+ParsedSQL = namedtuple('ParsedSQL', ['fingerprint', 'normalized_sql', 'statement_type', 'tables'])
+
+
+def normalize_sql(sql):
+    """
+    Strip literals and placeholders from a SQL statement so that every execution
+    of the same statement shape normalizes to the same text.
+    """
+    sql = _STRING_LITERAL_RE.sub('?', sql)
+    sql = _SAVEPOINT_RE.sub('SAVEPOINT ?', sql)
+    sql = _NAMED_PLACEHOLDER_RE.sub('?', sql)
+    sql = sql.replace('%s', '?')
+    sql = _NUMBER_RE.sub('?', sql)
+    sql = _IN_LIST_RE.sub('IN (?)', sql)
+    return _WHITESPACE_RE.sub(' ', sql).strip()
+
+
+def fingerprint_sql(normalized_sql):
+    """
+    Return the fingerprint (a short hash) of a normalized SQL statement.
+    """
+    return hashlib.blake2b(normalized_sql.encode(), digest_size=8).hexdigest()
+
+
+def _parse(fingerprint, normalized_sql):
+    tables = set()
+    statement_type = normalized_sql.split(' ', 1)[0].upper()
+    try:
+        parsed = sqlglot.parse_one(normalized_sql)
+        statement_type = parsed.key.upper()
+        for table in parsed.find_all(sqlglot.exp.Table):
+            tables.add(table.name)
+    except Exception as e:
+        logger.debug(f"Parsing the SQL of fingerprint {fingerprint} failed: {e}")
+    return ParsedSQL(fingerprint, normalized_sql, statement_type, sorted(tables))
+
+
+class SQLParseCache:
+    """
+    Bounded LRU cache of parsed SQL, keyed by the statement fingerprint.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def parse(self, sql):
+        """
+        Return the ParsedSQL for a statement, parsing it only the first time its fingerprint is seen.
+        """
+        normalized_sql = normalize_sql(sql)
+        fingerprint = fingerprint_sql(normalized_sql)
+        with self._lock:
+            parsed = self._entries.get(fingerprint)
+            if parsed is not None:
+                self._entries.move_to_end(fingerprint)
+                self.hits += 1
+                return parsed
+            self.misses += 1
+        parsed = _parse(fingerprint, normalized_sql)
+        with self._lock:
+            self._entries[fingerprint] = parsed
+            self._entries.move_to_end(fingerprint)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return parsed
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else None,
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+            }
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+_parse_cache = None
+_parse_cache_lock = threading.Lock()
+
+
+def get_parse_cache():
+    """
+    Return the process-wide SQLParseCache, sized from the DATABASE_PROFILER setting.
+    """
+    global _parse_cache
+    if _parse_cache is None:
+        with _parse_cache_lock:
+            if _parse_cache is None:
+                _parse_cache = SQLParseCache(maxsize=profiler_setting('PARSE_CACHE_SIZE'))
+    return _parse_cache
@@ -0,0 +1,85 @@
+from pymongo import UpdateOne
+from pymongo_wrapper.model import QueryFingerprint
+from .fingerprint import get_parse_cache
+
+
+class FingerprintStatsBatch:
+    """
+    Accumulates the per-fingerprint statistics of a batch of analyzed request records in memory,
+    so every fingerprint is written once per batch with a single $inc/$min/$max upsert.
+    Replayed requests are left out, they are not production traffic.
+    """
+
+    def __init__(self):
+        self.fingerprints = {}
+
+    def add(self, record):
+        if record.get('replay_id'):
+            return
+        parse_cache = get_parse_cache()
+        # the request's datetime, like everywhere else in the profiler
+        executed_at = record['request_execution_datetime']
+        for query in record['queries']:
+            duration = query['execution_duration']
+            entry = self.fingerprints.get(query['fingerprint'])
+            if entry is None:
+                parsed = parse_cache.parse(query['sql'])
+                entry = self.fingerprints[query['fingerprint']] = {
+                    'normalized_sql': parsed.normalized_sql,
+                    'statement_type': parsed.statement_type,
+                    'tables': query['tables'],
+                    'call_count': 0,
+                    'total_duration': 0.0,
+                    'min_duration': duration,
+                    'max_duration': duration,
+                    'rows_affected': 0,
+                    'first_seen': executed_at,
+                    'last_seen': executed_at,
+                }
+            entry['call_count'] += 1
+            entry['total_duration'] += duration
+            entry['min_duration'] = min(entry['min_duration'], duration)
+            entry['max_duration'] = max(entry['max_duration'], duration)
+            # drivers report -1 when the row count is unknown
+            if query.get('rows_affected') is not None and query['rows_affected'] > 0:
+                entry['rows_affected'] += query['rows_affected']
+            entry['first_seen'] = min(entry['first_seen'], executed_at)
+            entry['last_seen'] = max(entry['last_seen'], executed_at)
+
+    def operations(self):
+        return [
+            UpdateOne(
+                {'fingerprint': fingerprint},
+                {
+                    '$setOnInsert': {
+                        'normalized_sql': entry['normalized_sql'],
+                        'statement_type': entry['statement_type'],
+                        'tables': entry['tables'],
+                    },
+                    '$inc': {
+                        'call_count': entry['call_count'],
+                        'total_duration': entry['total_duration'],
+                        'rows_affected': entry['rows_affected'],
+                    },
+                    '$min': {'min_duration': entry['min_duration'], 'first_seen': entry['first_seen']},
+                    '$max': {'max_duration': entry['max_duration'], 'last_seen': entry['last_seen']},
+                },
+                upsert=True,
+            )
+            for fingerprint, entry in self.fingerprints.items()
+        ]
+
+    def save(self):
+        operations = self.operations()
+        if operations:
+            QueryFingerprint.bulk_write(operations, ordered=False)
+
+
+def update_fingerprint_stats(records):
+    """
+    Add a batch of analyzed request records to the per-fingerprint statistics.
+    """
+    batch = FingerprintStatsBatch()
+    for record in records:
+        batch.add(record)
+    batch.save()
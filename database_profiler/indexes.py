@@ -0,0 +1,28 @@
+import logging
+from pymongo_wrapper.model import Query, QueryRollup, IndexSuggestion, QueryFingerprint, SqlText
+from .conf import profiler_setting
+
+logger = logging.getLogger(__name__)
+
+
+def ensure_profiler_indexes():
+    """
+    Create the declared indexes of the profiler collections, drop the indexes no longer declared
+    and apply the retention policy.
+    Captured requests older than RETENTION_DAYS are expired by a TTL on request_execution_datetime,
+    minute rollup buckets older than MINUTE_ROLLUP_RETENTION_DAYS by a TTL on their bucket_start.
+    """
+    retention_days = profiler_setting('RETENTION_DAYS')
+    minute_retention_days = profiler_setting('MINUTE_ROLLUP_RETENTION_DAYS')
+    try:
+        Query.ensure_indexes(expire_after_seconds={
+            'request_execution_datetime': int(retention_days * 24 * 60 * 60) if retention_days else None,
+        }, drop_undeclared=True)
+        QueryRollup.ensure_indexes(expire_after_seconds={
+            'minute_bucket_start': int(minute_retention_days * 24 * 60 * 60) if minute_retention_days else None,
+        }, drop_undeclared=True)
+        IndexSuggestion.ensure_indexes(drop_undeclared=True)
+        QueryFingerprint.ensure_indexes(drop_undeclared=True)
+        SqlText.ensure_indexes(drop_undeclared=True)
+    except Exception as e:
+        logger.error(f"Creating the database profiler indexes failed: {e}")
@@ -0,0 +1,66 @@
+import time
+import uuid
+from datetime import datetime
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework_simplejwt.tokens import AccessToken
+from database_profiler.replay import load_workload, build_schedule, replay, replay_captures, compare
+from database_profiler.sampling import get_sampler
+
+
+class Command(BaseCommand):
+    help = ("Replay the requests captured by the database profiler in a time window against a target "
+            "and compare latency and query counts with the original capture.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('target', help="Base URL of the target, e.g. http://localhost:8000")
+        parser.add_argument('--from', dest='from_date', required=True, type=datetime.fromisoformat,
+                            help="Start of the captured window (ISO datetime)")
+        parser.add_argument('--to', dest='to_date', required=True, type=datetime.fromisoformat,
+                            help="End of the captured window (ISO datetime)")
+        parser.add_argument('--speed', type=float, default=1.0,
+                            help="Replay speed relative to the capture, 0 replays as fast as possible")
+        parser.add_argument('--concurrency', type=int, default=10)
+        parser.add_argument('--path-prefix', help="Only replay requests whose path starts with this prefix")
+        parser.add_argument('--limit', type=int, help="Replay at most this many captured requests")
+        parser.add_argument('--token', help="Bearer token sent with the requests that were authenticated")
+        parser.add_argument('--as-user', help="Email of a user to issue a stand-in access token for; "
+                                              "the target must share this project's signing key")
+        parser.add_argument('--timeout', type=float, default=30.0)
+        parser.add_argument('--wait', type=float, default=5.0,
+                            help="Seconds to wait for the target's profiler to store the replayed requests")
+
+    def handle(self, *args, **options):
+        token = options['token']
+        if options['as_user']:
+            user = get_user_model().objects.filter(email=options['as_user']).first()
+            if user is None:
+                raise CommandError(f"No user with email {options['as_user']}")
+            token = str(AccessToken.for_user(user))
+
+        records = load_workload(options['from_date'], options['to_date'], options['path_prefix'], options['limit'])
+        schedule, skipped = build_schedule(records, get_sampler())
+        if not schedule:
+            raise CommandError("No replayable requests were captured in this window.")
+        replay_run_id = uuid.uuid4().hex
+        self.stdout.write(f"Replaying {len(schedule)} requests ({len(records)} captured, {skipped} skipped for "
+                          f"their method) against {options['target']} as run {replay_run_id}")
+
+        results = replay(schedule, options['target'], replay_run_id, speed=options['speed'],
+                         concurrency=options['concurrency'], token=token, timeout=options['timeout'])
+        time.sleep(options['wait'])
+        rows = compare(results, replay_captures(replay_run_id))
+
+        self.stdout.write(f"{'endpoint':<50} {'count':>6} {'errors':>6} {'status':>6} "
+                          f"{'p50 orig':>9} {'p50 now':>9} {'p95 orig':>9} {'p95 now':>9} "
+                          f"{'queries orig':>12} {'queries now':>12}")
+        for row in rows:
+            self.stdout.write(f"{row['request_path']:<50} {row['count']:>6} {row['errors']:>6} "
+                              f"{row['status_changes']:>6} {_format(row['original_p50'])} "
+                              f"{_format(row['replay_p50'])} {_format(row['original_p95'])} "
+                              f"{_format(row['replay_p95'])} {_format(row['original_queries'], 12)} "
+                              f"{_format(row['replay_queries'], 12)}")
+
+
+def _format(value, width=9):
+    return f"{value:>{width}.3f}" if value is not None else f"{'-':>{width}}"
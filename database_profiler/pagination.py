@@ -0,0 +1,100 @@
+import base64
+import hashlib
+from datetime import datetime, timedelta
+from bson import json_util, ObjectId
+from django.core.cache import cache
+from .conf import profiler_setting
+
+# the only values a cursor may hold: anything else (e.g. {"$ne": null}) would end up as an operator in keyset_match
+CURSOR_VALUE_TYPES = (bool, int, float, str, datetime, ObjectId, type(None))
+
+
+def encode_cursor(values):
+    """
+    Encode the sort values of the last returned row into an opaque cursor.
+    """
+    return base64.urlsafe_b64encode(json_util.dumps(values).encode()).decode()
+
+
+def decode_cursor(cursor, length=None):
+    """
+    Decode a cursor created by encode_cursor, holding length sort values.
+    Raises ValueError for anything else.
+    """
+    try:
+        values = json_util.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except Exception:
+        raise ValueError("Invalid cursor.")
+    if not isinstance(values, list) or not all(isinstance(value, CURSOR_VALUE_TYPES) for value in values):
+        raise ValueError("Invalid cursor.")
+    if length is not None and len(values) != length:
+        raise ValueError("Invalid cursor.")
+    return values
+
+
+def keyset_match(sort_fields, values):
+    """
+    Build the filter selecting the rows that come after values in the given sort order.
+    For [(a, -1), (b, -1)] that is: a < va OR (a == va AND b < vb).
+    """
+    clauses = []
+    for position, (field, direction) in enumerate(sort_fields):
+        clause = {previous: values[index] for index, (previous, _) in enumerate(sort_fields[:position])}
+        clause[field] = {"$lt" if direction < 0 else "$gt": values[position]}
+        clauses.append(clause)
+    return {"$or": clauses}
+
+
+def paginate(collection, pipeline, sort_fields, cursor, limit, page_stages=None):
+    """
+    Run pipeline and return one keyset page of it as (results, next_cursor).
+
+    sort_fields is the full sort order and must end with a unique field (usually _id), so every
+    row has a distinct position. page_stages run on the returned page only.
+    next_cursor is None on the last page.
+    """
+    stages = list(pipeline)
+    if cursor is not None:
+        if len(cursor) != len(sort_fields):
+            raise ValueError("Invalid cursor.")
+        stages.append({"$match": keyset_match(sort_fields, cursor)})
+    stages.append({"$sort": dict(sort_fields)})
+    stages.append({"$limit": limit + 1})
+    results = list(collection.aggregate(stages + (page_stages or [])))
+
+    next_cursor = None
+    if len(results) > limit:
+        results = results[:limit]
+        next_cursor = encode_cursor([results[-1].get(field) for field, _ in sort_fields])
+    return results, next_cursor
+
+
+def _count_key_values(value, seconds):
+    """
+    The pipeline as it is hashed into the count cache key: datetimes of the last seconds (a
+    to_date defaulting to the request time) are all the same "now", so they share one count.
+    """
+    if isinstance(value, dict):
+        return {key: _count_key_values(item, seconds) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_count_key_values(item, seconds) for item in value]
+    if isinstance(value, datetime) and value >= datetime.now(value.tzinfo) - timedelta(seconds=seconds):
+        return 'now'
+    return value
+
+
+def cached_count(collection, pipeline):
+    """
+    Count the rows produced by pipeline.
+    The count is cached for COUNT_CACHE_SECONDS, so it is an estimate while new captures arrive.
+    """
+    seconds = profiler_setting('COUNT_CACHE_SECONDS')
+    key_pipeline = json_util.dumps(_count_key_values(pipeline, seconds))
+    cache_key = 'database_profiler:count:{}:{}'.format(
+        collection._get_name(), hashlib.md5(key_pipeline.encode()).hexdigest())
+    count = cache.get(cache_key)
+    if count is None:
+        result = list(collection.aggregate(list(pipeline) + [{"$count": "total"}]))
+        count = result[0]["total"] if result else 0
+        cache.set(cache_key, count, seconds)
+    return count
@@ -0,0 +1,66 @@
+import json
+import os
+from datetime import datetime as dt
+from django.core.cache import cache
+from django.db import connections, transaction
+from .conf import profiler_setting
+from .fingerprint import get_parse_cache
+
+
+def slow_request_threshold():
+    """
+    The total query duration in seconds from which a request counts as slow (as in the slow queries view).
+    """
+    threshold = os.getenv('SLOW_QUERY_DURATION_THRESHOLD_SECONDS')
+    return float(threshold) if threshold else None
+
+
+def slow_statement(record, threshold):
+    """
+    The slowest query of an analyzed request record that is worth an EXPLAIN ANALYZE, or None.
+    Only SELECTs are explained: EXPLAIN ANALYZE runs the statement.
+    """
+    if not record['queries'] or record['total_duration'] < threshold:
+        return None
+    query = record['queries'][record['slowest_query_index']]
+    if get_parse_cache().parse(query['sql']).statement_type != 'SELECT':
+        return None
+    return query
+
+
+def claim_explain_slot(fingerprint, now=None):
+    """
+    Count an EXPLAIN ANALYZE run of a fingerprint in the current hour.
+    Returns False once EXPLAIN_ANALYZE_MAX_PER_HOUR runs of the fingerprint were claimed.
+    """
+    now = now or dt.now()
+    cache_key = f'database_profiler:explain_analyze:{fingerprint}:{now:%Y%m%d%H}'
+    cache.add(cache_key, 0, 60 * 60)
+    try:
+        runs = cache.incr(cache_key)
+    except ValueError:
+        # the key expired between add and incr
+        cache.set(cache_key, 1, 60 * 60)
+        runs = 1
+    return runs <= profiler_setting('EXPLAIN_ANALYZE_MAX_PER_HOUR')
+
+
+def explain_analyze(db_alias, sql, params, timeout):
+    """
+    Run a statement under EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) and return the plan, with the
+    planning and execution times. The statement runs in a read-only transaction that is rolled
+    back and cancelled after timeout seconds.
+    """
+    connection = connections[db_alias]
+    if connection.vendor != 'postgresql':
+        raise ValueError(f"EXPLAIN ANALYZE is only supported on PostgreSQL, not on {connection.vendor}.")
+    with transaction.atomic(using=db_alias):
+        with connection.cursor() as cursor:
+            cursor.execute("SET TRANSACTION READ ONLY")
+            cursor.execute("SELECT set_config('statement_timeout', %s, true)", [str(int(timeout * 1000))])
+            cursor.execute(f"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {sql}", params)
+            plan_data = cursor.fetchall()[0][0]
+        transaction.set_rollback(True, using=db_alias)
+    if isinstance(plan_data, str):
+        plan_data = json.loads(plan_data)
+    return plan_data[0]
@@ -0,0 +1,109 @@
+from pymongo_wrapper.model import QueryRollup, QueryFingerprint
+from .rollups import bucket_percentiles, covering_buckets_match, minute_buckets_since, ENDPOINT, FINGERPRINT
+
+NEW = 'new'
+REMOVED = 'removed'
+COMMON = 'common'
+
+
+def release_percentiles(release, dimension, from_date, to_date):
+    """
+    The merged rollup percentiles of one release in [from_date, to_date), keyed by endpoint or fingerprint.
+    """
+    match = covering_buckets_match(from_date, to_date, dimension, minute_buckets_since())
+    match['release'] = release
+    buckets = QueryRollup.aggregate([
+        {"$match": match},
+        {
+            "$project": {
+                "_id": 0,
+                "key": 1,
+                "count": 1,
+                "latency_sketch": 1,
+                "query_count_sketch": 1
+            }
+        },
+    ])
+    return {row['key']: row for row in bucket_percentiles(buckets)}
+
+
+def compare_metric(base, target, threshold):
+    """
+    Return (relative change, flag) of a metric between two releases. The flag is 'regression' or
+    'improvement' when the metric grew or shrank by more than threshold, otherwise None.
+    """
+    if base is None or target is None:
+        return None, None
+    change = (target - base) / base if base else (0.0 if target == base else None)
+    if target > base * (1 + threshold):
+        return change, 'regression'
+    if target < base * (1 - threshold):
+        return change, 'improvement'
+    return change, None
+
+
+def diff_rows(base_rows, target_rows, metrics, threshold, min_samples):
+    """
+    Diff the percentile rows of two releases key by key.
+
+    metrics maps a metric name to a function computing it from a row. Metrics are only flagged
+    when the key has at least min_samples samples in both releases; keys seen in one release
+    only are new or removed.
+    """
+    rows = []
+    for key in base_rows.keys() | target_rows.keys():
+        base, target = base_rows.get(key), target_rows.get(key)
+        row = {
+            'key': key,
+            'status': COMMON if base and target else (NEW if target else REMOVED),
+            'base_count': base['count'] if base else 0,
+            'target_count': target['count'] if target else 0,
+            'is_significant': bool(base and target and base['sample_count'] >= min_samples
+                                   and target['sample_count'] >= min_samples),
+            'regressions': [],
+            'improvements': [],
+        }
+        for name, metric in metrics.items():
+            base_value = metric(base) if base else None
+            target_value = metric(target) if target else None
+            change, flag = compare_metric(base_value, target_value, threshold)
+            row.update({f'base_{name}': base_value, f'target_{name}': target_value, f'{name}_change': change})
+            if flag and row['is_significant']:
+                row[f'{flag}s'].append(name)
+        rows.append(row)
+    # regressions first, then new and removed keys, then by traffic
+    rows.sort(key=lambda row: (bool(row['regressions']), row['status'] != COMMON, row['target_count']), reverse=True)
+    return rows
+
+
+def compare_releases(base_release, target_release, from_date, to_date, threshold, min_samples):
+    """
+    Diff two releases by endpoint (queries per request, p95 latency) and by SQL fingerprint
+    (executions per request, p95 latency), from the rollup buckets of both releases.
+    """
+    base_endpoints = release_percentiles(base_release, ENDPOINT, from_date, to_date)
+    target_endpoints = release_percentiles(target_release, ENDPOINT, from_date, to_date)
+    endpoints = diff_rows(base_endpoints, target_endpoints, {
+        'queries_per_request': lambda row: row['query_count_mean'],
+        'p95': lambda row: row['p95'],
+    }, threshold, min_samples)
+
+    # executions per request are relative to the requests whose queries were captured
+    fingerprint_rows = []
+    for release, endpoint_rows in ((base_release, base_endpoints), (target_release, target_endpoints)):
+        requests = sum(row['sample_count'] for row in endpoint_rows.values())
+        rows = release_percentiles(release, FINGERPRINT, from_date, to_date)
+        for row in rows.values():
+            row['executions_per_request'] = row['count'] / requests if requests else None
+        fingerprint_rows.append(rows)
+    fingerprints = diff_rows(*fingerprint_rows, {
+        'executions_per_request': lambda row: row['executions_per_request'],
+        'p95': lambda row: row['p95'],
+    }, threshold, min_samples)
+
+    statistics = QueryFingerprint._get_collection().find(
+        {'fingerprint': {'$in': [row['key'] for row in fingerprints]}}, {'fingerprint': 1, 'normalized_sql': 1})
+    queries = {document['fingerprint']: document['normalized_sql'] for document in statistics}
+    for row in fingerprints:
+        row['query'] = queries.get(row['key'])
+    return endpoints, fingerprints
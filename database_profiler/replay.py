@@ -0,0 +1,170 @@
+import random
+import re
+import time
+import urllib.error
+import urllib.request
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from pymongo import ASCENDING
+from pymongo_wrapper.model import Query
+from .capture import REPLAY_ID_HEADER
+from .sampling import SAMPLED
+from .sketches import LogHistogram
+
+# only requests without side effects are replayed: the profiler does not capture request bodies
+REPLAYABLE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+ReplayRequest = namedtuple('ReplayRequest', ['offset', 'record'])
+ReplayResult = namedtuple('ReplayResult', ['record', 'status_code', 'duration'])
+
+
+def load_workload(from_date, to_date, path_prefix=None, limit=None):
+    """
+    The sampled requests captured in [from_date, to_date), oldest first.
+    Slow and error requests kept by tail sampling are left out, they would skew the mix.
+    """
+    spec = {
+        "request_execution_datetime": {"$gte": from_date, "$lt": to_date},
+        "sample_reason": {"$in": [None, SAMPLED]},
+        "replay_id": None,
+    }
+    if path_prefix:
+        spec["request_path"] = {"$regex": "^" + re.escape(path_prefix)}
+    cursor = Query._get_collection().find(spec, {
+        "request_path": 1, "request_method": 1, "request_query_string": 1, "request_authenticated": 1,
+        "request_execution_datetime": 1, "request_duration": 1, "query_count": 1, "response_status_code": 1,
+    }, sort=[("request_execution_datetime", ASCENDING)])
+    if limit:
+        cursor = cursor.limit(limit)
+    return list(cursor)
+
+
+def build_schedule(records, sampler, rng=random):
+    """
+    Turn captured requests into a replay schedule of (offset in seconds, record).
+
+    Paths sampled at a rate below 1 are repeated 1/rate times on average (with the current
+    sampling settings), so the schedule has the real request frequencies.
+    Returns the schedule and the number of requests skipped because of their method.
+    """
+    schedule = []
+    skipped = 0
+    if not records:
+        return schedule, skipped
+    start = records[0]['request_execution_datetime']
+    for record in records:
+        if (record.get('request_method') or 'GET') not in REPLAYABLE_METHODS:
+            skipped += 1
+            continue
+        rate = sampler.rate_for(record['request_path'])
+        weight = 1 / rate if rate > 0 else 1
+        copies = int(weight) + (1 if rng.random() < weight - int(weight) else 0)
+        offset = (record['request_execution_datetime'] - start).total_seconds()
+        schedule.extend(ReplayRequest(offset, record) for _ in range(copies))
+    return schedule, skipped
+
+
+def send(base_url, record, replay_run_id, token, timeout):
+    """
+    Send one replayed request and return its ReplayResult. Connection errors have no status code.
+    """
+    url = base_url.rstrip('/') + record['request_path']
+    if record.get('request_query_string'):
+        url += '?' + record['request_query_string']
+    headers = {REPLAY_ID_HEADER: f"{replay_run_id}:{record['_id']}"}
+    if token and record.get('request_authenticated'):
+        headers['Authorization'] = f'Bearer {token}'
+    request = urllib.request.Request(url, headers=headers, method=record.get('request_method') or 'GET')
+    start_time = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            response.read()
+            status_code = response.status
+    except urllib.error.HTTPError as e:
+        status_code = e.code
+    except (urllib.error.URLError, OSError):
+        status_code = None
+    return ReplayResult(record, status_code, time.perf_counter() - start_time)
+
+
+def replay(schedule, base_url, replay_run_id, speed=1.0, concurrency=10, token=None, timeout=30):
+    """
+    Replay a schedule against base_url, keeping the captured spacing of the requests divided by
+    speed (0 sends them as fast as the workers allow). Returns the ReplayResults.
+    """
+    start = time.monotonic()
+    futures = []
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for item in schedule:
+            if speed > 0:
+                delay = start + item.offset / speed - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            futures.append(executor.submit(send, base_url, item.record, replay_run_id, token, timeout))
+    return [future.result() for future in futures]
+
+
+def replay_captures(replay_run_id):
+    """
+    The captures the target recorded for a replay run, keyed by the id of the replayed document.
+    Only available when the target profiles into the same MongoDB.
+    """
+    captures = {}
+    cursor = Query._get_collection().find(
+        {"replay_id": {"$type": "string", "$regex": f"^{replay_run_id}:"}},
+        {"replay_id": 1, "query_count": 1, "request_duration": 1})
+    for document in cursor:
+        captures.setdefault(document['replay_id'].split(':', 1)[1], []).append(document)
+    return captures
+
+
+def compare(results, captures):
+    """
+    Per endpoint, the latency and query count of the original capture next to the replay's.
+    Replay latencies are measured by the client, so they include the network round trip.
+    """
+    endpoints = {}
+    compared_records = set()
+    for result in results:
+        record = result.record
+        endpoint = endpoints.setdefault(record['request_path'], {
+            'count': 0, 'errors': 0, 'status_changes': 0,
+            'original_latency': LogHistogram(), 'replay_latency': LogHistogram(),
+            'original_queries': [], 'replay_queries': [],
+        })
+        endpoint['count'] += 1
+        if result.status_code is None or result.status_code >= 500:
+            endpoint['errors'] += 1
+        if result.status_code != record.get('response_status_code'):
+            endpoint['status_changes'] += 1
+        if record.get('request_duration') is not None:
+            endpoint['original_latency'].add(record['request_duration'])
+        endpoint['replay_latency'].add(result.duration)
+        if record['_id'] in compared_records:
+            # a record replayed several times to restore its path's frequency
+            continue
+        compared_records.add(record['_id'])
+        if record.get('query_count') is not None:
+            endpoint['original_queries'].append(record['query_count'])
+        endpoint['replay_queries'].extend(
+            capture['query_count'] for capture in captures.get(str(record['_id']), []))
+
+    rows = []
+    for path, endpoint in sorted(endpoints.items(), key=lambda item: item[1]['count'], reverse=True):
+        rows.append({
+            'request_path': path,
+            'count': endpoint['count'],
+            'errors': endpoint['errors'],
+            'status_changes': endpoint['status_changes'],
+            'original_p50': endpoint['original_latency'].quantile(0.5),
+            'original_p95': endpoint['original_latency'].quantile(0.95),
+            'replay_p50': endpoint['replay_latency'].quantile(0.5),
+            'replay_p95': endpoint['replay_latency'].quantile(0.95),
+            'original_queries': _mean(endpoint['original_queries']),
+            'replay_queries': _mean(endpoint['replay_queries']),
+        })
+    return rows
+
+
+def _mean(values):
+    return sum(values) / len(values) if values else None
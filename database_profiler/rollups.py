@@ -0,0 +1,275 @@
+from datetime import datetime as dt, timedelta, timezone
+from pymongo import UpdateOne
+from pymongo_wrapper.model import QueryRollup
+from .conf import profiler_setting
+from .sampling import SAMPLED
+from .sketches import sketch_bucket, CountHistogram, LogHistogram
+
+MINUTE = 'minute'
+HOUR = 'hour'
+GRANULARITIES = (MINUTE, HOUR)
+
+ENDPOINT = 'endpoint'
+TABLE = 'table'
+FINGERPRINT = 'fingerprint'
+
+
+def bucket_start(value, granularity):
+    """
+    Floor a datetime to the start of its minute or hour bucket.
+    """
+    value = value.replace(second=0, microsecond=0)
+    if granularity == HOUR:
+        value = value.replace(minute=0)
+    return value
+
+
+def aligned_granularity(from_date, to_date):
+    """
+    Return the coarsest bucket granularity both range bounds line up with, or None
+    when the range has to be answered from the raw Query documents.
+    """
+    for granularity in (HOUR, MINUTE):
+        if bucket_start(from_date, granularity) == from_date and bucket_start(to_date, granularity) == to_date:
+            return granularity
+    return None
+
+
+def minute_buckets_since():
+    """
+    The oldest bucket start the minute buckets still cover, or None when they are kept forever.
+    Naive UTC, like the clock of the TTL index removing them.
+    """
+    retention_days = profiler_setting('MINUTE_ROLLUP_RETENTION_DAYS')
+    if not retention_days:
+        return None
+    now = dt.now(timezone.utc).replace(tzinfo=None)
+    return bucket_start(now - timedelta(days=retention_days), HOUR) + timedelta(hours=1)
+
+
+def _is_before(value, since):
+    """
+    Compare a request parameter, naive or timezone-aware, with a naive UTC datetime.
+    """
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value < since
+
+
+def rollup_granularity(from_date, to_date):
+    """
+    The bucket granularity a range is answered from, or None when it has to be answered from the
+    raw Query documents: rollups are disabled, the range is not aligned, or it is minute-aligned
+    but starts before the minute buckets still kept.
+    """
+    if not profiler_setting('ROLLUPS_ENABLED'):
+        return None
+    granularity = aligned_granularity(from_date, to_date)
+    if granularity == MINUTE:
+        minute_since = minute_buckets_since()
+        if minute_since and _is_before(from_date, minute_since):
+            return None
+    return granularity
+
+
+def _bucket_end(value, granularity):
+    """
+    Ceil a datetime to the start of the next bucket, unless it already is a bucket start.
+    """
+    start = bucket_start(value, granularity)
+    if start == value:
+        return start
+    return start + (timedelta(hours=1) if granularity == HOUR else timedelta(minutes=1))
+
+
+def covering_buckets_match(from_date, to_date, dimension, minute_since=None):
+    """
+    The $match stage selecting the buckets of a dimension that cover [from_date, to_date):
+    hour buckets for the whole hours inside the range and minute buckets for the edges.
+    The range is widened to whole minutes, edges before minute_since (minute buckets that
+    expired) to whole hours.
+    """
+    first_hour = _bucket_end(from_date, HOUR)
+    last_hour = bucket_start(to_date, HOUR)
+    if minute_since and _is_before(from_date, minute_since):
+        first_hour = bucket_start(from_date, HOUR)
+    if minute_since and _is_before(to_date, minute_since):
+        last_hour = _bucket_end(to_date, HOUR)
+    if first_hour >= last_hour:
+        ranges = [(MINUTE, bucket_start(from_date, MINUTE), _bucket_end(to_date, MINUTE))]
+    else:
+        ranges = [
+            (MINUTE, bucket_start(from_date, MINUTE), first_hour),
+            (HOUR, first_hour, last_hour),
+            (MINUTE, last_hour, _bucket_end(to_date, MINUTE)),
+        ]
+    return {
+        "dimension": dimension,
+        "$or": [
+            {"granularity": granularity, "bucket_start": {"$gte": start, "$lt": end}}
+            for granularity, start, end in ranges if start < end
+        ],
+    }
+
+
+def bucket_range_match(from_date, to_date, granularity, dimension):
+    """
+    The $match stage selecting the buckets of a dimension that fall into [from_date, to_date).
+    """
+    return {
+        "granularity": granularity,
+        "dimension": dimension,
+        "bucket_start": {"$gte": from_date, "$lt": to_date},
+    }
+
+
+def request_range_match(from_date, to_date, **conditions):
+    """
+    The $match stage selecting the captured requests of [from_date, to_date) from the raw Query
+    documents, the counterpart of bucket_range_match. Replayed requests are left out, like in the buckets.
+    """
+    match = {
+        "request_execution_datetime": {"$gte": from_date, "$lt": to_date},
+        "replay_id": None,
+    }
+    match.update(conditions)
+    return match
+
+
+def bucket_percentiles(buckets):
+    """
+    Merge the sketches of rollup buckets per key and return one row of percentiles per key.
+    """
+    merged = {}
+    for bucket in buckets:
+        latency, query_count, row = merged.setdefault(
+            bucket['key'], (LogHistogram(), CountHistogram(), {'key': bucket['key'], 'count': 0}))
+        latency.merge(bucket.get('latency_sketch') or {})
+        query_count.merge(bucket.get('query_count_sketch') or {})
+        row['count'] += bucket['count']
+
+    rows = []
+    for latency, query_count, row in merged.values():
+        row.update({
+            'sample_count': latency.total,
+            'p50': latency.quantile(0.5),
+            'p95': latency.quantile(0.95),
+            'p99': latency.quantile(0.99),
+            # the upper bound of the highest sketch bucket, not the observed maximum
+            'max_estimate': latency.quantile(1),
+            'query_count_p50': query_count.quantile(0.5),
+            'query_count_p95': query_count.quantile(0.95),
+            'query_count_max': query_count.max(),
+            'query_count_mean': query_count.mean(),
+        })
+        rows.append(row)
+    return rows
+
+
+class RollupBatch:
+    """
+    Accumulates the rollup increments of a batch of analyzed request records in memory,
+    so every bucket is written once per batch with a single $inc/$max upsert.
+    The buckets of every release are kept apart, a batch holds the records of one release.
+    Replayed requests are left out, they are not production traffic.
+    """
+
+    def __init__(self, release=None):
+        self.release = release
+        self.buckets = {}
+
+    def _add(self, bucket, dimension, key, duration, status_code, latency=None, query_count=None, timings=None):
+        status_code = str(status_code)
+        latency_bucket = sketch_bucket(latency) if latency is not None else None
+        for granularity in GRANULARITIES:
+            entry = self.buckets.setdefault((granularity, bucket_start(bucket, granularity), dimension, key), {
+                'count': 0,
+                'total_duration': 0.0,
+                'max_duration': 0.0,
+                'status_codes': {},
+                'latency_sketch': {},
+                'query_count_sketch': {},
+                'timings': {},
+            })
+            entry['count'] += 1
+            entry['total_duration'] += duration
+            entry['max_duration'] = max(entry['max_duration'], duration)
+            entry['status_codes'][status_code] = entry['status_codes'].get(status_code, 0) + 1
+            if latency_bucket is not None:
+                entry['latency_sketch'][latency_bucket] = entry['latency_sketch'].get(latency_bucket, 0) + 1
+            if query_count is not None:
+                query_count_bucket = str(query_count)
+                entry['query_count_sketch'][query_count_bucket] = \
+                    entry['query_count_sketch'].get(query_count_bucket, 0) + 1
+            if timings is not None:
+                for name, value in timings.items():
+                    entry['timings'][name] = entry['timings'].get(name, 0) + value
+
+    def add(self, record):
+        if record.get('replay_id'):
+            return
+        bucket = record['request_execution_datetime']
+        status_code = record['response_status_code']
+        request_duration = 0.0
+        for query in record['queries']:
+            duration = query['execution_duration']
+            request_duration += duration
+            self._add(bucket, FINGERPRINT, query['fingerprint'], duration, status_code, latency=duration)
+            for table in query['tables']:
+                self._add(bucket, TABLE, table, duration, status_code)
+        # slow and error requests are kept even when they were not sampled, so only the sampled
+        # ones go into the sketches, otherwise the percentiles would be skewed towards them
+        is_sampled = record.get('sample_reason') in (None, SAMPLED)
+        timings = None
+        if is_sampled and record.get('request_duration') is not None:
+            timings = {
+                'count': 1,
+                'request': record['request_duration'],
+                'db': request_duration + sum(query.get('fetch_duration') or 0.0 for query in record['queries']),
+                'render': record.get('render_duration') or 0.0,
+            }
+        self._add(bucket, ENDPOINT, record['request_path'], request_duration, status_code,
+                  latency=(record.get('request_duration') or request_duration) if is_sampled else None,
+                  query_count=len(record['queries']) if is_sampled else None,
+                  timings=timings)
+
+    def operations(self):
+        operations = []
+        for (granularity, start, dimension, key), entry in self.buckets.items():
+            increments = {
+                'count': entry['count'],
+                'total_duration': entry['total_duration'],
+            }
+            for status_code, count in entry['status_codes'].items():
+                increments[f'status_codes.{status_code}'] = count
+            for sketch in ('latency_sketch', 'query_count_sketch'):
+                for sketch_bucket_key, count in entry[sketch].items():
+                    increments[f'{sketch}.{sketch_bucket_key}'] = count
+            for name, value in entry['timings'].items():
+                increments[f'timings.{name}'] = value
+            operations.append(UpdateOne(
+                {'granularity': granularity, 'bucket_start': start, 'dimension': dimension, 'key': key,
+                 'release': self.release},
+                {'$inc': increments, '$max': {'max_duration': entry['max_duration']}},
+                upsert=True,
+            ))
+        return operations
+
+    def save(self):
+        operations = self.operations()
+        if operations:
+            QueryRollup.bulk_write(operations, ordered=False)
+
+
+def rollup_records(records):
+    """
+    Add a batch of analyzed request records to the per-minute and per-hour rollup buckets.
+    """
+    batches = {}
+    for record in records:
+        release = record.get('release')
+        if release not in batches:
+            batches[release] = RollupBatch(release)
+        batches[release].add(record)
+    for batch in batches.values():
+        batch.save()
@@ -0,0 +1,58 @@
+import random
+from .conf import profiler_setting
+
+SAMPLED = 'sampled'
+SLOW = 'slow'
+ERROR = 'error'
+
+
+class Sampler:
+    """
+    Decides which requests the profiler records.
+
+    The head decision (should_capture) is taken before the view runs, from a fixed
+    rate or a per-path rate; only those requests get their queries captured.
+    The tail decision (keep_reason) is taken once the response is known, so slow
+    requests and error responses are always kept, with or without their queries.
+    """
+
+    def __init__(self, rate, path_rates, slow_request_threshold, error_status_threshold):
+        self.rate = rate
+        # longest prefix first, so the most specific path rate wins
+        self.path_rates = sorted(path_rates.items(), key=lambda item: len(item[0]), reverse=True)
+        self.slow_request_threshold = slow_request_threshold
+        self.error_status_threshold = error_status_threshold
+
+    def rate_for(self, path):
+        for prefix, rate in self.path_rates:
+            if path.startswith(prefix):
+                return rate
+        return self.rate
+
+    def should_capture(self, path):
+        rate = self.rate_for(path)
+        if rate >= 1:
+            return True
+        return rate > 0 and random.random() < rate
+
+    def keep_reason(self, captured, request_duration, status_code):
+        """
+        Return why a finished request should be recorded, or None to discard it.
+        """
+        if captured:
+            return SAMPLED
+        if self.error_status_threshold is not None and status_code is not None \
+                and status_code >= self.error_status_threshold:
+            return ERROR
+        if self.slow_request_threshold is not None and request_duration >= self.slow_request_threshold:
+            return SLOW
+        return None
+
+
+def get_sampler():
+    return Sampler(
+        rate=profiler_setting('SAMPLE_RATE'),
+        path_rates=profiler_setting('PATH_SAMPLE_RATES'),
+        slow_request_threshold=profiler_setting('SLOW_REQUEST_THRESHOLD_SECONDS'),
+        error_status_threshold=profiler_setting('ERROR_STATUS_THRESHOLD'),
+    )
@@ -1,22 +1,32 @@
 from rest_framework import serializers
 from datetime import datetime as dt
+from .pagination import decode_cursor
+from .storage import decode_response_data
 
 
-class QueriesRequestBaseSerializer(serializers.Serializer):
+class CursorPaginationRequestSerializer(serializers.Serializer):
+    # number of sort fields of the paginated views: a sort value and a unique tiebreaker
+    cursor_length = 2
+
     limit = serializers.IntegerField(default=10)
-    skip = serializers.IntegerField(default=0)
-    from_date = serializers.DateTimeField(default=dt(1900, 1, 1))
-    to_date = serializers.DateTimeField(default=dt.now())
+    cursor = serializers.CharField(required=False)
+    with_count = serializers.BooleanField(default=False)
 
     def validate_limit(self, value):
         if not isinstance(value, int) or value <= 0:
             raise serializers.ValidationError("Limit must be a positive integer.")
         return value
 
-    def validate_skip(self, value):
-        if not isinstance(value, int) or value < 0:
-            raise serializers.ValidationError("Skip must be a non-negative integer.")
-        return value
+    def validate_cursor(self, value):
+        try:
+            return decode_cursor(value, self.cursor_length)
+        except ValueError as e:
+            raise serializers.ValidationError(str(e))
+
+
+class QueriesRequestBaseSerializer(CursorPaginationRequestSerializer):
+    from_date = serializers.DateTimeField(default=dt(1900, 1, 1))
+    to_date = serializers.DateTimeField(default=dt.now)
 
 
 class QueriesRequestSerializer(QueriesRequestBaseSerializer):
@@ -29,22 +39,100 @@ class QueriesRequestSerializer(QueriesRequestBaseSerializer):
     )
 
 
+class PercentilesRequestSerializer(serializers.Serializer):
+    limit = serializers.IntegerField(default=10, min_value=1)
+    from_date = serializers.DateTimeField(default=dt(1900, 1, 1))
+    to_date = serializers.DateTimeField(default=dt.now)
+    group_by = serializers.ChoiceField(
+        choices=["endpoint", "fingerprint"],
+        default="endpoint",
+        error_messages={
+            "invalid_choice": "Invalid choice. Allowed values are: endpoint, fingerprint."
+        }
+    )
+    sort_by = serializers.ChoiceField(
+        choices=["count", "p50", "p95", "p99", "max_estimate"],
+        default="p95",
+        error_messages={
+            "invalid_choice": "Invalid choice. Allowed values are: count, p50, p95, p99, max_estimate."
+        }
+    )
+
+
+class ResponseDataField(serializers.JSONField):
+    """
+    The profiler stores captured response bodies as JSON text, older records hold the decoded data.
+    """
+
+    def to_representation(self, value):
+        return super().to_representation(decode_response_data(value))
+
+
+class QueriesExportRequestSerializer(serializers.Serializer):
+    from_date = serializers.DateTimeField(default=dt(1900, 1, 1))
+    to_date = serializers.DateTimeField(default=dt.now)
+    request_path = serializers.CharField(required=False)
+    is_n_plus_one = serializers.BooleanField(required=False, allow_null=True, default=None)
+    export_format = serializers.ChoiceField(
+        choices=["ndjson", "csv"],
+        default="ndjson",
+        error_messages={
+            "invalid_choice": "Invalid choice. Allowed values are: ndjson, csv."
+        }
+    )
+
+
 class QueriesSerializer(serializers.Serializer):
     queries = serializers.ListField()
     request_path = serializers.CharField()
+    request_method = serializers.CharField(allow_null=True, required=False)
+    request_query_string = serializers.CharField(allow_null=True, required=False)
+    replay_id = serializers.CharField(allow_null=True, required=False)
+    release = serializers.CharField(allow_null=True, required=False)
     request_execution_datetime = serializers.DateTimeField()
     response_status_code = serializers.IntegerField()
-    response_data = serializers.JSONField()
+    response_data = ResponseDataField()
+    response_size = serializers.IntegerField(allow_null=True)
+    response_hash = serializers.CharField(allow_null=True)
+    response_preview = serializers.CharField(allow_null=True)
     is_n_plus_one = serializers.BooleanField()
-    n_plus_one_suggestion = serializers.CharField()
+    n_plus_one_suggestion = serializers.CharField(allow_null=True)
+    n_plus_one_groups = serializers.ListField(required=False)
+    sample_reason = serializers.CharField(allow_null=True)
+    request_finished_datetime = serializers.DateTimeField(allow_null=True)
+    request_duration = serializers.FloatField(allow_null=True)
+    render_duration = serializers.FloatField(allow_null=True)
+    app_duration = serializers.FloatField(allow_null=True)
+    total_duration = serializers.FloatField(allow_null=True)
+    total_fetch_duration = serializers.FloatField(allow_null=True)
+    profiler_overhead = serializers.FloatField(allow_null=True)
+    query_count = serializers.IntegerField(allow_null=True)
+    max_query_duration = serializers.FloatField(allow_null=True)
+    slowest_query_index = serializers.IntegerField(allow_null=True)
+
+
+class NPlusOneGroupSerializer(serializers.Serializer):
+    fingerprint = serializers.CharField()
+    sql = serializers.CharField()
+    table = serializers.CharField()
+    parent_table = serializers.CharField()
+    count = serializers.IntegerField()
+    first_query_index = serializers.IntegerField()
+    call_site = serializers.ListField(child=serializers.CharField(), allow_null=True, required=False)
+    suggestion = serializers.CharField()
+
+
+class NPlusOneQueriesSerializer(QueriesSerializer):
+    n_plus_one_groups = NPlusOneGroupSerializer(many=True, required=False)
 
 
 class SlowQueriesSerializer(QueriesSerializer):
-    total_duration = serializers.DecimalField(max_digits=20, decimal_places=20, coerce_to_string=False)
+    total_duration = serializers.FloatField()
+    explain_plan = serializers.JSONField(allow_null=True, required=False)
 
 
 class MostSlowQueriesSerializer(QueriesSerializer):
-    total_duration = serializers.DecimalField(max_digits=20, decimal_places=20, coerce_to_string=False)
+    total_duration = serializers.FloatField()
 
 
 class MostUsedEndpointsSerializer(serializers.Serializer):
@@ -59,4 +147,99 @@ class MostUsedTablesSerializer(serializers.Serializer):
 
 class MostUsedQueriesSerializer(serializers.Serializer):
     total_usage = serializers.IntegerField()
-    query = serializers.CharField()
+    query = serializers.CharField(allow_null=True)
+    fingerprint = serializers.CharField()
+    tables = serializers.ListField(child=serializers.CharField(), allow_null=True, required=False)
+    total_duration = serializers.FloatField()
+    min_duration = serializers.FloatField(allow_null=True, required=False)
+    max_duration = serializers.FloatField(allow_null=True)
+    rows_affected = serializers.IntegerField(allow_null=True, required=False)
+    first_seen = serializers.DateTimeField(allow_null=True, required=False)
+    last_seen = serializers.DateTimeField(allow_null=True, required=False)
+
+
+class PercentilesSerializer(serializers.Serializer):
+    key = serializers.CharField()
+    count = serializers.IntegerField()
+    sample_count = serializers.IntegerField()
+    p50 = serializers.FloatField(allow_null=True)
+    p95 = serializers.FloatField(allow_null=True)
+    p99 = serializers.FloatField(allow_null=True)
+    max_estimate = serializers.FloatField(allow_null=True)
+    query_count_p50 = serializers.IntegerField(allow_null=True)
+    query_count_p95 = serializers.IntegerField(allow_null=True)
+    query_count_max = serializers.IntegerField(allow_null=True)
+    query_count_mean = serializers.FloatField(allow_null=True)
+
+
+class AppTimeEndpointsSerializer(serializers.Serializer):
+    request_path = serializers.CharField()
+    request_count = serializers.IntegerField()
+    total_app_duration = serializers.FloatField()
+    avg_request_duration = serializers.FloatField()
+    avg_db_duration = serializers.FloatField()
+    avg_render_duration = serializers.FloatField()
+    avg_app_duration = serializers.FloatField()
+    app_share = serializers.FloatField()
+
+
+class IndexSuggestionsRequestSerializer(CursorPaginationRequestSerializer):
+    with_empty = serializers.BooleanField(default=False)
+    sort_by = serializers.ChoiceField(
+        choices=["estimated_benefit", "total_duration"],
+        default="estimated_benefit",
+        error_messages={
+            "invalid_choice": "Invalid choice. Allowed values are: estimated_benefit, total_duration."
+        }
+    )
+
+
+class IndexSuggestionsSerializer(serializers.Serializer):
+    fingerprint = serializers.CharField()
+    sql = serializers.CharField()
+    tables = serializers.ListField(child=serializers.CharField())
+    db_alias = serializers.CharField(allow_null=True)
+    call_count = serializers.IntegerField()
+    total_duration = serializers.FloatField()
+    suggestions = serializers.ListField()
+    estimated_benefit = serializers.FloatField()
+    what_if_method = serializers.CharField(allow_null=True)
+    analyzed_at = serializers.DateTimeField(allow_null=True)
+
+
+class ReleaseComparisonRequestSerializer(serializers.Serializer):
+    base_release = serializers.CharField()
+    target_release = serializers.CharField()
+    from_date = serializers.DateTimeField(default=dt(1900, 1, 1))
+    to_date = serializers.DateTimeField(default=dt.now)
+    threshold = serializers.FloatField(required=False, min_value=0)
+    min_samples = serializers.IntegerField(required=False, min_value=1)
+    only_changes = serializers.BooleanField(default=False)
+    limit = serializers.IntegerField(default=50, min_value=1)
+
+
+class ReleaseDiffSerializer(serializers.Serializer):
+    status = serializers.CharField()
+    base_count = serializers.IntegerField()
+    target_count = serializers.IntegerField()
+    is_significant = serializers.BooleanField()
+    regressions = serializers.ListField(child=serializers.CharField())
+    improvements = serializers.ListField(child=serializers.CharField())
+    base_p95 = serializers.FloatField(allow_null=True)
+    target_p95 = serializers.FloatField(allow_null=True)
+    p95_change = serializers.FloatField(allow_null=True)
+
+
+class ReleaseEndpointDiffSerializer(ReleaseDiffSerializer):
+    request_path = serializers.CharField(source='key')
+    base_queries_per_request = serializers.FloatField(allow_null=True)
+    target_queries_per_request = serializers.FloatField(allow_null=True)
+    queries_per_request_change = serializers.FloatField(allow_null=True)
+
+
+class ReleaseFingerprintDiffSerializer(ReleaseDiffSerializer):
+    fingerprint = serializers.CharField(source='key')
+    query = serializers.CharField(allow_null=True)
+    base_executions_per_request = serializers.FloatField(allow_null=True)
+    target_executions_per_request = serializers.FloatField(allow_null=True)
+    executions_per_request_change = serializers.FloatField(allow_null=True)
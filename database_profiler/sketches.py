@@ -0,0 +1,102 @@
+import math
+
+# relative accuracy of the latency sketches: every quantile is within 1% of the true value
+RELATIVE_ACCURACY = 0.01
+_GAMMA = (1 + RELATIVE_ACCURACY) / (1 - RELATIVE_ACCURACY)
+_LOG_GAMMA = math.log(_GAMMA)
+# durations below a microsecond all land in the zero bucket
+MIN_VALUE = 1e-6
+ZERO_BUCKET = 'z'
+
+
+def sketch_bucket(value):
+    """
+    Return the sketch bucket of a positive duration, as a string so it can be a MongoDB field name.
+    Bucket i holds the values in (gamma^(i-1), gamma^i].
+    """
+    if value < MIN_VALUE:
+        return ZERO_BUCKET
+    return str(math.ceil(math.log(value) / _LOG_GAMMA))
+
+
+class LogHistogram:
+    """
+    A mergeable, log-bucketed latency sketch (in the style of DDSketch/HDR histograms).
+
+    The sketch is a plain {bucket: count} mapping, so sketches of different rollup buckets
+    are merged by adding their counts, which MongoDB does with $inc.
+    """
+
+    def __init__(self, counts=None):
+        self.counts = {}
+        if counts:
+            self.merge(counts)
+
+    def add(self, value, count=1):
+        bucket = sketch_bucket(value)
+        self.counts[bucket] = self.counts.get(bucket, 0) + count
+
+    def merge(self, counts):
+        for bucket, count in counts.items():
+            self.counts[bucket] = self.counts.get(bucket, 0) + count
+
+    @property
+    def total(self):
+        return sum(self.counts.values())
+
+    def quantile(self, q):
+        """
+        Return the estimated q-quantile (0 <= q <= 1), or None for an empty sketch.
+        """
+        total = self.total
+        if not total:
+            return None
+        rank = q * (total - 1)
+        seen = self.counts.get(ZERO_BUCKET, 0)
+        if rank < seen:
+            return 0.0
+        for bucket in sorted(int(bucket) for bucket in self.counts if bucket != ZERO_BUCKET):
+            seen += self.counts[str(bucket)]
+            if rank < seen:
+                return 2 * _GAMMA ** bucket / (_GAMMA + 1)
+        return 2 * _GAMMA ** bucket / (_GAMMA + 1)
+
+
+class CountHistogram:
+    """
+    Exact histogram of small integers (e.g. the number of queries per request), mergeable like LogHistogram.
+    """
+
+    def __init__(self, counts=None):
+        self.counts = {}
+        if counts:
+            self.merge(counts)
+
+    def add(self, value, count=1):
+        bucket = str(value)
+        self.counts[bucket] = self.counts.get(bucket, 0) + count
+
+    def merge(self, counts):
+        for bucket, count in counts.items():
+            self.counts[bucket] = self.counts.get(bucket, 0) + count
+
+    def quantile(self, q):
+        total = sum(self.counts.values())
+        if not total:
+            return None
+        rank = q * (total - 1)
+        seen = 0
+        for value in sorted(int(bucket) for bucket in self.counts):
+            seen += self.counts[str(value)]
+            if rank < seen:
+                return value
+        return value
+
+    def max(self):
+        return max((int(bucket) for bucket in self.counts), default=None)
+
+    def mean(self):
+        total = sum(self.counts.values())
+        if not total:
+            return None
+        return sum(int(bucket) * count for bucket, count in self.counts.items()) / total
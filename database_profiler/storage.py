@@ -0,0 +1,251 @@
+import json
+from collections import Counter
+from datetime import timedelta
+from bson.errors import InvalidDocument
+from pymongo import UpdateOne
+from pymongo_wrapper.model import SqlText
+from utils.helpers import convert_to_bson_safe
+
+# storage formats of the Query documents: every query with its full SQL text (the format of
+# older documents), or a reference to the SQL text stored once per fingerprint in SqlText
+EXPANDED = 'expanded'
+COMPACT = 'compact'
+STORAGE_FORMATS = (EXPANDED, COMPACT)
+
+# the top level fields only compact documents have, removed again when a document is expanded
+_COMPACT_FIELDS = ('storage_format', 'db_alias', 'db_vendor', 'first_query_time', 'table_counts')
+
+
+def _microseconds(seconds):
+    return int(round(seconds * 1000000))
+
+
+def compact_record(record, capture_params=False):
+    """
+    Return the compact form of an analyzed request record; the record itself is left unchanged.
+
+    Every query keeps its fingerprint, which references the SQL text and table list in SqlText.
+    The database vendor and the request's most used alias are stored once at the top level,
+    durations are integer microseconds and execution times microsecond offsets from the first
+    query. Params are only kept with capture_params, flags only when they are set.
+    """
+    queries = record['queries']
+    db_alias = Counter(query['db_alias'] for query in queries).most_common(1)[0][0] if queries else None
+    first_query_time = queries[0]['execution_time'] if queries else None
+    table_counts = Counter()
+    compact_queries = []
+    for query in queries:
+        compact_query = {
+            'fingerprint': query['fingerprint'],
+            'duration_us': _microseconds(query['execution_duration']),
+            'offset_us': _microseconds((query['execution_time'] - first_query_time).total_seconds()),
+            'rows_affected': query['rows_affected'],
+        }
+        if query['db_alias'] != db_alias:
+            compact_query['db_alias'] = query['db_alias']
+        if query['is_in_transaction']:
+            compact_query['is_in_transaction'] = True
+        if query['needs_rollback']:
+            compact_query['needs_rollback'] = True
+        if capture_params:
+            compact_query['params'] = query['params']
+        if query.get('call_site'):
+            compact_query['call_site'] = query['call_site']
+        if query.get('fetch_duration') is not None:
+            compact_query['fetch_duration_us'] = _microseconds(query['fetch_duration'])
+        table_counts.update(query['tables'])
+        compact_queries.append(compact_query)
+
+    compacted = dict(record)
+    compacted.update(
+        queries=compact_queries,
+        storage_format=COMPACT,
+        db_alias=db_alias,
+        db_vendor=queries[0]['db_vendor'] if queries else None,
+        first_query_time=first_query_time,
+        # a list rather than a {table: count} object: table names may contain dots
+        table_counts=[{'table': table, 'count': count} for table, count in table_counts.items()],
+    )
+    return compacted
+
+
+class SqlTextStore:
+    """
+    Writes the SQL text of every fingerprint once, the first time a compact document references it.
+
+    The fingerprints already stored are remembered (up to max_size of them), so a batch of
+    requests running known statements costs no SqlText write at all. A sample of the params is
+    only kept with capture_params, like in the compact documents.
+    """
+
+    def __init__(self, max_size, capture_params=False):
+        self.max_size = max_size
+        self.capture_params = capture_params
+        self.stored = set()
+
+    def save(self, records):
+        texts = {}
+        for record in records:
+            for query in record['queries']:
+                if query['fingerprint'] not in self.stored and query['fingerprint'] not in texts:
+                    texts[query['fingerprint']] = {
+                        'sql': query['sql'],
+                        # the index advisor EXPLAINs the statement with the sample, or a generic plan without it
+                        'params': convert_to_bson_safe(query['params']) if self.capture_params else None,
+                        'tables': query['tables'],
+                        'first_seen': record['request_execution_datetime'],
+                    }
+        if not texts:
+            return
+        try:
+            self._write(texts)
+        except InvalidDocument:
+            # the SQL text is what compact documents depend on, the sample params can go
+            for text in texts.values():
+                text['params'] = None
+            self._write(texts)
+        if len(self.stored) + len(texts) > self.max_size:
+            self.stored.clear()
+        self.stored.update(texts)
+
+    @staticmethod
+    def _write(texts):
+        SqlText.bulk_write([
+            UpdateOne({'fingerprint': fingerprint}, {'$setOnInsert': text}, upsert=True)
+            for fingerprint, text in texts.items()
+        ], ordered=False)
+
+
+def decode_response_data(value):
+    """
+    The captured response body of a Query document: the profiler stores it as JSON text,
+    older documents hold the decoded data. Text that is not JSON is returned as is.
+    """
+    if isinstance(value, str):
+        try:
+            return json.loads(value)
+        except ValueError:
+            return value
+    return value
+
+
+def sql_texts(fingerprints):
+    """
+    The SqlText documents of the given fingerprints, keyed by fingerprint.
+    """
+    if not fingerprints:
+        return {}
+    cursor = SqlText._get_collection().find({'fingerprint': {'$in': list(fingerprints)}}, {'_id': 0})
+    return {text['fingerprint']: text for text in cursor}
+
+
+def _expand_queries(document, texts):
+    first_query_time = document.get('first_query_time')
+    queries = []
+    for compact_query in document['queries']:
+        text = texts.get(compact_query['fingerprint']) or {}
+        query = {
+            'sql': text.get('sql'),
+            'params': compact_query.get('params'),
+            'execution_duration': compact_query['duration_us'] / 1000000,
+            'execution_time': first_query_time + timedelta(microseconds=compact_query['offset_us']),
+            'is_in_transaction': compact_query.get('is_in_transaction', False),
+            'db_alias': compact_query.get('db_alias', document.get('db_alias')),
+            'rows_affected': compact_query.get('rows_affected'),
+            'db_vendor': document.get('db_vendor'),
+            'needs_rollback': compact_query.get('needs_rollback', False),
+        }
+        if 'call_site' in compact_query:
+            query['call_site'] = compact_query['call_site']
+        if 'fetch_duration_us' in compact_query:
+            query['fetch_duration'] = compact_query['fetch_duration_us'] / 1000000
+        query['fingerprint'] = compact_query['fingerprint']
+        query['tables'] = list(text.get('tables') or [])
+        queries.append(query)
+    return queries
+
+
+def expand_records(documents):
+    """
+    Bring compact Query documents back to the expanded form, in place, so they look exactly like
+    the documents of the expanded format. Expanded documents are left as they are.
+    Returns the documents.
+    """
+    compact_documents = [document for document in documents if document.get('storage_format') == COMPACT]
+    texts = sql_texts({query['fingerprint'] for document in compact_documents for query in document['queries']})
+    for document in documents:
+        if document.get('storage_format') == COMPACT:
+            document['queries'] = _expand_queries(document, texts)
+        for field in _COMPACT_FIELDS:
+            if field in document:
+                del document[field]
+    return documents
+
+
+def iter_expanded(documents, chunk_size):
+    """
+    Expand an iterable of Query documents chunk_size documents at a time, e.g. a server-side cursor.
+    """
+    chunk = []
+    for document in documents:
+        chunk.append(document)
+        if len(chunk) >= chunk_size:
+            yield from expand_records(chunk)
+            chunk = []
+    yield from expand_records(chunk)
+
+
+def max_query_field(field):
+    """
+    Aggregation expression for the largest value of a query field in a Query document of either format.
+    """
+    if field == 'execution_duration':
+        return {"$ifNull": [
+            {"$max": "$queries.execution_duration"},
+            {"$divide": [{"$max": "$queries.duration_us"}, 1000000]},
+        ]}
+    if field == 'execution_time':
+        return {"$cond": [
+            {"$eq": ["$storage_format", COMPACT]},
+            {"$add": ["$first_query_time", {"$divide": [{"$max": "$queries.offset_us"}, 1000]}]},
+            {"$max": "$queries.execution_time"},
+        ]}
+    return {"$max": f"$queries.{field}"}
+
+
+def table_usage_stages():
+    """
+    Aggregation stages producing one {_id: table, total_usage: n} row per table from Query documents
+    of either format. Both count one use per query referencing the table: compact documents carry
+    these counts in table_counts, expanded ones are counted from the tables of their queries.
+    """
+    return [
+        {
+            "$project": {
+                "table_counts": {
+                    "$ifNull": [
+                        "$table_counts",
+                        {
+                            "$reduce": {
+                                "input": "$queries.tables",
+                                "initialValue": [],
+                                "in": {
+                                    "$concatArrays": [
+                                        "$$value",
+                                        {"$map": {"input": "$$this", "as": "table", "in": {"table": "$$table", "count": 1}}}
+                                    ]
+                                }
+                            }
+                        }
+                    ]
+                }
+            }
+        },
+        {"$unwind": "$table_counts"},
+        {
+            "$group": {
+                "_id": "$table_counts.table",
+                "total_usage": {"$sum": "$table_counts.count"}
+            }
+        },
+    ]
@@ -1,99 +1,124 @@
+from bson import ObjectId
 from celery import shared_task
-from django.db import connection
-from pymongo_wrapper.model import Query
-import sqlglot
-from sqlglot import exp
-from bson.objectid import ObjectId
-from datetime import datetime
-import json
+from pymongo_wrapper.model import Query, QueryRollup, QueryFingerprint
+from datetime import datetime, timedelta
+from .advisor import advise_workload
+from .conf import profiler_setting
+from .fingerprint import get_parse_cache
+from .fingerprint_stats import FingerprintStatsBatch
+from .plans import explain_analyze
+from .rollups import bucket_start, rollup_records, HOUR
+from .storage import iter_expanded
 
 
 @shared_task
-def analyze_query_for_indexing(query_id):
-    try:
-        query_record = Query.find_one({"_id": ObjectId(query_id)})
-        if not query_record:
-            print(f"No query record found for ID: {query_id}")
-            return
-
-        suggestions = []
-        for query in query_record["queries"]:
-            sql = query["sql"]
-            params = query["params"]
-            tables = query["tables"]
-            execution_duration = query["execution_duration"]
-
-            if not sql.strip().upper().startswith("SELECT") or len(tables) > 1:
-                continue
+def run_index_advisor():
+    """
+    Periodic index advisor: EXPLAINs the distinct SQL fingerprints of the recent workload
+    and stores the index suggestions per fingerprint.
+    """
+    analyzed = advise_workload()
+    print(f"Index advisor analyzed {analyzed} fingerprints")
 
-            with connection.cursor() as cursor:
-                try:
-                    cursor.execute(f"EXPLAIN (FORMAT JSON) {sql}", params)
-                    plan = cursor.fetchall()
-                    plan_data = plan[0][0]
-                    if isinstance(plan_data, str):
-                        plan_json = json.loads(plan_data)
-                    elif isinstance(plan_data, list):
-                        plan_json = plan_data
-                    else:
-                        print(f"Unexpected plan_data type: {type(plan_data)}")
-                        continue
 
-                    # Find Seq Scan nodes
-                    seq_scan_nodes = find_seq_scan_nodes(plan_json[0]["Plan"])
-                    print(f"Found {len(seq_scan_nodes)} Seq Scan nodes for query: {sql}")
-                    for node in seq_scan_nodes:
-                        table = node.get("Relation Name", tables[0])
-                        cursor.execute(f"SELECT reltuples FROM pg_class WHERE relname = %s", [table])
-                        total_rows = cursor.fetchone()[0] or 0
-
-                        estimated_rows = node.get("Plan Rows", 0)
-                        selectivity = estimated_rows / total_rows if total_rows > 0 else 1.0
-                        print(
-                            f"Table: {table}, Total Rows: {total_rows}, Estimated Rows: {estimated_rows}, Selectivity: {selectivity}")
+@shared_task
+def explain_slow_query(query_id, query_index, fingerprint, db_alias, sql, params):
+    """
+    EXPLAIN ANALYZE the slowest statement of a slow request and store the plan on its Query document.
+    """
+    explain_plan = {
+        'query_index': query_index,
+        'fingerprint': fingerprint,
+        'explained_at': datetime.now(),
+        'plan': None,
+        'error': None,
+    }
+    try:
+        explain_plan['plan'] = explain_analyze(profiler_setting('EXPLAIN_ANALYZE_DB_ALIAS') or db_alias, sql, params,
+                                               profiler_setting('EXPLAIN_ANALYZE_TIMEOUT_SECONDS'))
+    except Exception as e:
+        print(f"EXPLAIN ANALYZE of fingerprint {fingerprint} failed: {e}")
+        explain_plan['error'] = str(e)
+    Query.update({"_id": ObjectId(query_id)}, {"$set": {"explain_plan": explain_plan}})
 
-                        if total_rows > 100000 and selectivity < 0.01 and execution_duration > 0.01:
-                            parsed = sqlglot.parse_one(sql)
-                            cols = set(
-                                col.name for col in parsed.find_all(exp.Column)
-                                if col.find_ancestor((exp.Where, exp.Join, exp.Order, exp.Group))
-                            )
-                            if cols:
-                                existing_indexes = check_existing_indexes(cursor, table, cols)
-                                missing_cols = cols - existing_indexes
-                                if missing_cols:
-                                    suggestion = f"CREATE INDEX ON {table}({', '.join(missing_cols)})"
-                                    suggestions.append(suggestion)
-                                    print(f"Suggested: {suggestion}")
-                except Exception as e:
-                    print(f"Error analyzing query {sql}: {e}")
-                    continue
 
-        query_record.update(index_suggestion="; ".join(suggestions) if suggestions else None)
-        print(f"Updated query {query_id} with index_suggestion: {'; '.join(suggestions) if suggestions else None}")
+@shared_task
+def backfill_query_rollups(from_date, to_date, batch_size=1000):
+    """
+    Rebuild the rollup buckets of [from_date, to_date) from the raw Query documents,
+    e.g. for history captured before rollups were enabled. Both bounds are ISO datetimes
+    and are widened to whole hours, so no bucket is ever partially rebuilt.
+    """
+    from_date = bucket_start(datetime.fromisoformat(from_date), HOUR)
+    to_date = datetime.fromisoformat(to_date)
+    if bucket_start(to_date, HOUR) != to_date:
+        to_date = bucket_start(to_date, HOUR) + timedelta(hours=1)
 
-    except Exception as e:
-        print(f"Error in analyze_query_for_indexing: {e}")
-        raise
+    QueryRollup.remove({"bucket_start": {"$gte": from_date, "$lt": to_date}}, multi=True)
+    parse_cache = get_parse_cache()
+    batch = []
+    processed = 0
+    for query_record in iter_expanded(
+            Query.find({"request_execution_datetime": {"$gte": from_date, "$lt": to_date}}), batch_size):
+        for query in query_record["queries"]:
+            if "fingerprint" not in query:
+                query["fingerprint"] = parse_cache.parse(query["sql"]).fingerprint
+        batch.append(query_record)
+        processed += 1
+        if processed % batch_size == 0:
+            rollup_records(batch)
+            batch = []
+    rollup_records(batch)
+    print(f"Rebuilt rollups from {processed} query records between {from_date} and {to_date}")
 
 
-def find_seq_scan_nodes(plan):
-    """Recursively find all Seq Scan nodes in the query plan."""
-    nodes = []
-    if plan.get("Node Type") == "Seq Scan":
-        nodes.append(plan)
-    for subplan in plan.get("Plans", []):
-        nodes.extend(find_seq_scan_nodes(subplan))
-    return nodes
+@shared_task
+def backfill_fingerprint_stats(batch_size=1000):
+    """
+    Rebuild the per-fingerprint statistics from all stored Query documents.
+    """
+    QueryFingerprint.remove({}, multi=True)
+    parse_cache = get_parse_cache()
+    batch = FingerprintStatsBatch()
+    processed = 0
+    for query_record in iter_expanded(Query.find(), batch_size):
+        for query in query_record["queries"]:
+            if "fingerprint" not in query or "tables" not in query:
+                parsed = parse_cache.parse(query["sql"])
+                query["fingerprint"] = parsed.fingerprint
+                query["tables"] = list(parsed.tables)
+        batch.add(query_record)
+        processed += 1
+        if processed % batch_size == 0:
+            batch.save()
+            batch = FingerprintStatsBatch()
+    batch.save()
+    print(f"Rebuilt fingerprint statistics from {processed} query records")
 
 
-def check_existing_indexes(cursor, table, columns):
-    """Check existing indexes on the table, return indexed columns."""
-    cursor.execute("SELECT indexdef FROM pg_indexes WHERE tablename = %s", [table])
-    indexed_cols = set()
-    for row in cursor.fetchall():
-        index_def = row[0].lower()
-        for col in columns:
-            if f" {col.lower()} " in index_def or f"({col.lower()})" in index_def:
-                indexed_cols.add(col)
-    return indexed_cols
+@shared_task
+def backfill_request_aggregates():
+    """
+    Store the per-request aggregates on Query documents captured before they existed.
+    """
+    result = Query.update(
+        {"total_duration": {"$exists": False}},
+        [
+            {
+                "$set": {
+                    "total_duration": {"$sum": "$queries.execution_duration"},
+                    "query_count": {"$size": "$queries"},
+                    "max_query_duration": {"$ifNull": [{"$max": "$queries.execution_duration"}, 0.0]},
+                    "slowest_query_index": {
+                        "$cond": [
+                            {"$gt": [{"$size": "$queries"}, 0]},
+                            {"$indexOfArray": ["$queries.execution_duration", {"$max": "$queries.execution_duration"}]},
+                            None
+                        ]
+                    },
+                }
+            }
+        ],
+        multi=True
+    )
+    print(f"Stored request aggregates on {result.modified_count} query records")
@@ -1,3 +1,1088 @@
-from django.test import TestCase
+from bson import ObjectId
+import csv
+import json
+from collections import Counter
+from datetime import datetime as dt, timedelta, timezone
+from django.db import connection
+from django.db.backends.utils import CursorWrapper
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from asgiref.sync import sync_to_async
+from django.test import AsyncRequestFactory, RequestFactory, SimpleTestCase, override_settings
+from .advisor import evaluate_suggestions, explain, index_key_columns, propose_index, suggest_indexes, IndexInfo, HYPOPG
+from .analysis import analyze_record, find_n_plus_one_groups
+import os
+import django
+from django.conf import settings
+from pymongo import ASCENDING, IndexModel
+from pymongo_wrapper.model import Model, Query, QueryRollup, SqlText
+from rest_framework.renderers import JSONRenderer
+from rest_framework.response import Response
+from rest_framework.test import APIRequestFactory
+from .capture import RequestCapture, _is_project_file, RESPONSE_CAPTURE_FULL, RESPONSE_CAPTURE_HASH, \
+    RESPONSE_CAPTURE_OFF, RESPONSE_CAPTURE_PREVIEW
+from .export import stream_csv, stream_ndjson, CSV_COLUMNS
+from .fingerprint import normalize_sql, SQLParseCache
+from .fingerprint_stats import FingerprintStatsBatch
+from .indexes import ensure_profiler_indexes
+from .middleware import DatabaseMonitoringMiddleware
+from .releases import compare_metric, diff_rows, COMMON, NEW, REMOVED
+from .replay import build_schedule, compare, ReplayResult
+from .pagination import cached_count, decode_cursor, encode_cursor, keyset_match
+from .plans import claim_explain_slot, slow_statement
+from .rollups import aligned_granularity, bucket_percentiles, bucket_start, covering_buckets_match, \
+    request_range_match, rollup_granularity, RollupBatch, HOUR, MINUTE, ENDPOINT, TABLE
+from .sampling import Sampler, SAMPLED, SLOW, ERROR
+from .serializers import PercentilesRequestSerializer, PercentilesSerializer, QueriesExportRequestSerializer, \
+    QueriesRequestBaseSerializer, ReleaseComparisonRequestSerializer
+from .sketches import CountHistogram, LogHistogram, RELATIVE_ACCURACY
+from .storage import compact_record, expand_records, SqlTextStore, COMPACT, EXPANDED
+from .views import MostUsedEndpointsView, MostUsedQueriesView
+from .writer import QueryWriter, BLOCK, DROP_NEWEST, DROP_OLDEST
+from bson.errors import InvalidDocument
+from decimal import Decimal
+import threading
+import time
+from unittest import mock
 
-# Create your tests here.
+
+class _Connection:
+    in_atomic_block = False
+    alias = 'default'
+    needs_rollback = False
+
+
+class _Cursor:
+    rowcount = 2
+
+    def __getattr__(self, name):
+        # like Django's CursorWrapper, which resolves the fetch methods on the driver cursor
+        return lambda *args: [(1,), (2,)]
+
+
+class RequestCaptureTest(SimpleTestCase):
+    def test_execute_and_fetch_are_timed_separately(self):
+        capture = RequestCapture('/film/films/', True, measure_fetch_time=True)
+        cursor = _Cursor()
+        result = capture(lambda *args: 'executed', 'SELECT 1', None, False,
+                         {'connection': _Connection(), 'cursor': cursor})
+        self.assertEqual(result, 'executed')
+        self.assertEqual(cursor.fetchall(), [(1,), (2,)])
+        [query] = capture.queries
+        self.assertEqual(query['params'], ())
+        self.assertGreater(query['fetch_duration'], 0)
+        self.assertGreater(capture.profiler_overhead, 0)
+
+    def test_call_site_is_captured_once_per_statement(self):
+        capture = RequestCapture('/film/films/', True, stack_depth=5)
+        context = {'connection': _Connection(), 'cursor': _Cursor()}
+        for film_id in (1, 2):
+            capture(lambda *args: None, 'SELECT * FROM "film" WHERE "film"."film_id" = %s', (film_id,), False, context)
+        self.assertIn('call_site', capture.queries[0])
+        self.assertNotIn('call_site', capture.queries[1])
+
+    def test_only_project_frames_are_kept(self):
+        self.assertTrue(_is_project_file(os.path.join(settings.BASE_DIR, 'film', 'views.py')))
+        self.assertFalse(_is_project_file(os.path.join(settings.BASE_DIR, 'database_profiler', 'middleware.py')))
+        self.assertFalse(_is_project_file(django.__file__))
+
+    def _json_response(self, data):
+        response = Response(data)
+        response.accepted_renderer = JSONRenderer()
+        response.accepted_media_type = 'application/json'
+        response.renderer_context = {}
+        return response.render()
+
+    def _captured(self, response, policy):
+        capture = RequestCapture('/film/films/', True)
+        capture.capture_response(response, policy, preview_chars=10)
+        return {field: getattr(capture, field) for field in (
+            'response_status_code', 'response_size', 'response_hash', 'response_preview', 'response_data')}
+
+    def test_response_capture_policies(self):
+        response = self._json_response({'title': 'ACADEMY DINOSAUR'})
+        body = b'{"title":"ACADEMY DINOSAUR"}'
+        self.assertEqual(self._captured(response, RESPONSE_CAPTURE_OFF), {
+            'response_status_code': 200, 'response_size': None, 'response_hash': None,
+            'response_preview': None, 'response_data': None})
+        hashed = self._captured(response, RESPONSE_CAPTURE_HASH)
+        self.assertEqual((hashed['response_size'], hashed['response_preview'], hashed['response_data']),
+                         (len(body), None, None))
+        self.assertEqual(len(hashed['response_hash']), 32)
+        preview = self._captured(response, RESPONSE_CAPTURE_PREVIEW)
+        self.assertEqual((preview['response_hash'], preview['response_preview'], preview['response_data']),
+                         (hashed['response_hash'], '{"title":"', None))
+        # the full body is stored as JSON text
+        full = self._captured(response, RESPONSE_CAPTURE_FULL)
+        self.assertEqual((full['response_hash'], full['response_preview'], full['response_data']),
+                         (hashed['response_hash'], None, body.decode()))
+
+    def test_non_json_and_streaming_responses_are_not_captured(self):
+        unserializable = Response({'value': object()}, content_type='text/plain')
+        streaming = StreamingHttpResponse(iter([b'{}']))
+        streaming.data = {}
+        for response in (HttpResponse('<p>films</p>'), unserializable, streaming):
+            for policy in (RESPONSE_CAPTURE_HASH, RESPONSE_CAPTURE_PREVIEW, RESPONSE_CAPTURE_FULL):
+                captured = self._captured(response, policy)
+                self.assertEqual(captured['response_status_code'], 200)
+                self.assertEqual((captured['response_size'], captured['response_data']), (None, None))
+
+
+def _run_query(sql):
+    """
+    Run a statement through the execute wrappers of this thread's connection, like the ORM does,
+    on a cursor that never reaches the database.
+    """
+    CursorWrapper(_Cursor(), connection).execute(sql, ())
+
+
+class MiddlewareTest(SimpleTestCase):
+    def setUp(self):
+        self.writer = mock.Mock(overflow_policy=DROP_OLDEST)
+        patcher = mock.patch('database_profiler.middleware.get_writer', return_value=self.writer)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _submitted(self):
+        return {record['request_path']: [query['sql'] for query in record['queries']]
+                for (record,), _ in self.writer.submit.call_args_list}
+
+    def test_concurrent_requests_keep_their_own_queries(self):
+        first_ran, second_ran = threading.Event(), threading.Event()
+
+        def view(request):
+            if request.path == '/first/':
+                _run_query('SELECT 1')
+                first_ran.set()
+                second_ran.wait(5)
+                _run_query('SELECT 3')
+            else:
+                first_ran.wait(5)
+                _run_query('SELECT 2')
+                second_ran.set()
+            return JsonResponse({})
+
+        middleware = DatabaseMonitoringMiddleware(view)
+        threads = [threading.Thread(target=middleware, args=(RequestFactory().get(path),))
+                   for path in ('/first/', '/second/')]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(self._submitted(), {'/first/': ['SELECT 1', 'SELECT 3'], '/second/': ['SELECT 2']})
+
+    def test_execute_wrapper_is_removed_after_an_exception(self):
+        def view(request):
+            _run_query('SELECT 1')
+            raise RuntimeError('view failed')
+
+        with self.assertRaises(RuntimeError):
+            DatabaseMonitoringMiddleware(view)(RequestFactory().get('/film/films/'))
+        self.assertEqual(connection.execute_wrappers, [])
+        self.writer.submit.assert_not_called()
+
+    def test_failed_hand_off_is_logged(self):
+        self.writer.submit.side_effect = RuntimeError('writer failed')
+        with self.assertLogs('database_profiler.middleware', 'ERROR'):
+            response = DatabaseMonitoringMiddleware(lambda request: JsonResponse({}))(RequestFactory().get('/film/'))
+        self.assertEqual(response.status_code, 200)
+
+    def _async_middleware(self, view):
+        # like Django's ASGI handler, which runs sync views in the thread-sensitive executor
+        async def get_response(request):
+            return await sync_to_async(view)(request)
+        return DatabaseMonitoringMiddleware(get_response)
+
+    async def test_queries_of_sync_views_are_captured_under_asgi(self):
+        def view(request):
+            _run_query('SELECT 1')
+            return JsonResponse({})
+
+        for overflow_policy in (DROP_OLDEST, BLOCK):
+            self.writer.overflow_policy = overflow_policy
+            self.writer.submit.reset_mock()
+            response = await self._async_middleware(view)(AsyncRequestFactory().get('/film/films/'))
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(self._submitted(), {'/film/films/': ['SELECT 1']})
+            self.assertEqual(await sync_to_async(lambda: list(connection.execute_wrappers))(), [])
+
+    async def test_execute_wrapper_is_removed_after_an_exception_under_asgi(self):
+        def view(request):
+            raise RuntimeError('view failed')
+
+        with self.assertRaises(RuntimeError):
+            await self._async_middleware(view)(AsyncRequestFactory().get('/film/films/'))
+        self.assertEqual(await sync_to_async(lambda: list(connection.execute_wrappers))(), [])
+
+
+class QueryWriterTest(SimpleTestCase):
+    def _writer(self, overflow_policy=DROP_OLDEST, queue_size=2, batch_size=10, flush_interval=60):
+        writer = QueryWriter(queue_size, batch_size, flush_interval, overflow_policy, shutdown_timeout=5,
+                             storage_format=EXPANDED)
+        self.addCleanup(writer.stop)
+        return writer
+
+    def _record(self, path='/film/films/', duration=0.1):
+        return {
+            'queries': [{'sql': 'SELECT "film"."title" FROM "film"', 'params': (), 'execution_duration': duration}],
+            'request_path': path,
+            'request_execution_datetime': dt(2025, 1, 1, 10),
+            'response_status_code': 200,
+        }
+
+    def test_invalid_policies_are_rejected(self):
+        with self.assertRaises(ValueError):
+            QueryWriter(2, 10, 60, 'drop_everything', 5)
+        with self.assertRaises(ValueError):
+            QueryWriter(2, 10, 60, DROP_OLDEST, 5, storage_format='tiny')
+
+    def test_overflow_policies(self):
+        for policy, kept in ((DROP_NEWEST, [1, 2]), (DROP_OLDEST, [2, 3])):
+            writer = self._writer(policy)
+            # a worker that never consumes, so the queue fills up
+            with mock.patch.object(QueryWriter, '_run', lambda self: self._stop_event.wait()):
+                for number in (1, 2, 3):
+                    writer.submit(number)
+            self.assertEqual(writer.dropped, 1)
+            self.assertEqual([writer._queue.get_nowait() for _ in kept], kept)
+
+    def test_block_policy_waits_for_the_worker(self):
+        writer = self._writer(BLOCK, queue_size=1, batch_size=1, flush_interval=0.01)
+        with mock.patch.object(QueryWriter, '_flush') as flush:
+            for number in range(5):
+                writer.submit(number)
+            writer.stop()
+        self.assertEqual([call.args[0] for call in flush.call_args_list if call.args[0]],
+                         [[number] for number in range(5)])
+        self.assertEqual(writer.dropped, 0)
+
+    def test_worker_survives_a_failing_flush(self):
+        writer = self._writer(batch_size=1, flush_interval=0.01)
+        flushed = threading.Event()
+
+        def flush(batch):
+            if batch == ['boom']:
+                raise TypeError('boom')
+            if batch:
+                flushed.set()
+
+        with mock.patch.object(QueryWriter, '_flush', side_effect=flush):
+            writer.submit('boom')
+            time.sleep(0.05)
+            writer.submit('ok')
+            self.assertTrue(flushed.wait(1))
+        self.assertTrue(writer._thread.is_alive())
+
+    @mock.patch('database_profiler.writer.update_fingerprint_stats')
+    @mock.patch('database_profiler.writer.rollup_records')
+    def test_flush_skips_bad_records(self, rollup_records, update_fingerprint_stats):
+        writer = self._writer()
+        bad_record = self._record('/broken/')
+        # a value of the wrong type, like the int total_duration of requests without queries once was
+        bad_record['response_status_code'] = '200'
+        with mock.patch.object(Query, 'insert_many') as insert_many:
+            writer._flush([self._record(), bad_record])
+        self.assertEqual([model['request_path'] for model in insert_many.call_args.args[0]], ['/film/films/'])
+        self.assertEqual([record['request_path'] for record in rollup_records.call_args.args[0]], ['/film/films/'])
+
+    @mock.patch('database_profiler.writer.update_fingerprint_stats')
+    @mock.patch('database_profiler.writer.rollup_records')
+    def test_failed_batch_is_retried_one_by_one(self, rollup_records, update_fingerprint_stats):
+        writer = self._writer()
+        collection = mock.Mock()
+        collection.insert_one.side_effect = [None, InvalidDocument('cannot encode object'), None]
+        with mock.patch.object(Query, 'insert_many', side_effect=InvalidDocument('cannot encode object')), \
+                mock.patch.object(Query, '_get_collection', return_value=collection):
+            writer._flush([self._record('/a/'), self._record('/b/'), self._record('/c/')])
+        self.assertEqual(collection.insert_one.call_count, 3)
+        self.assertEqual([record['request_path'] for record in rollup_records.call_args.args[0]], ['/a/', '/c/'])
+
+    @mock.patch('database_profiler.writer.update_fingerprint_stats')
+    @mock.patch('database_profiler.writer.rollup_records')
+    def test_flush_analyzes_captured_records_before_inserting(self, rollup_records, update_fingerprint_stats):
+        capture = RequestCapture('/film/films/', True)
+        context = {'connection': _Connection(), 'cursor': _Cursor()}
+        capture(lambda *args: None, 'SELECT "film"."film_id", "film"."language_id" FROM "film"', None, False, context)
+        for language_id in (1, 2, 3):
+            capture(lambda *args: None, 'SELECT * FROM "language" WHERE "language"."language_id" = %s',
+                    (language_id,), False, context)
+        capture.response_status_code = 200
+        record = capture.to_record()
+        self.assertNotIn('tables', record['queries'][0])
+        self.assertNotIn('is_n_plus_one', record)
+        with mock.patch.object(Query, 'insert_many') as insert_many:
+            self._writer()._flush([record])
+        [model] = insert_many.call_args.args[0]
+        self.assertEqual([query['tables'] for query in model['queries']], [['film']] + [['language']] * 3)
+        self.assertEqual(len({query['fingerprint'] for query in model['queries']}), 2)
+        self.assertTrue(model['is_n_plus_one'])
+        self.assertEqual(model['n_plus_one_suggestion'], "Use select_related('language')")
+        self.assertEqual(model['query_count'], 4)
+
+    def test_params_are_stored_bson_safe(self):
+        capture = RequestCapture('/film/films/', True)
+        capture(lambda *args: None, 'SELECT 1 WHERE %s < %s AND %s = %s',
+                (Decimal('9.99'), dt(2025, 1, 1).date(), dt(2025, 1, 1), 2 ** 70), False,
+                {'connection': _Connection(), 'cursor': _Cursor()})
+        self.assertEqual(capture.queries[0]['params'], ('9.99', '2025-01-01', dt(2025, 1, 1), str(2 ** 70)))
+
+
+class NPlusOneTest(SimpleTestCase):
+    @staticmethod
+    def _query(sql, table):
+        parsed = SQLParseCache(maxsize=10).parse(sql)
+        return {'sql': sql, 'fingerprint': parsed.fingerprint, 'tables': [table]}
+
+    def test_every_group_is_reported(self):
+        queries = [self._query('SELECT * FROM "film"', 'film')]
+        queries += [self._query(f'SELECT * FROM "language" WHERE "language"."language_id" = {i}', 'language')
+                    for i in range(3)]
+        queries += [self._query('SELECT * FROM "film_actor"', 'film_actor')]
+        queries += [self._query(f'SELECT * FROM "actor" WHERE "actor"."actor_id" = {i}', 'actor') for i in range(2)]
+        groups = find_n_plus_one_groups(queries)
+        self.assertEqual([(group['table'], group['count'], group['first_query_index'], group['suggestion'])
+                          for group in groups], [
+            ('language', 3, 1, "Use select_related('language')"),
+            ('actor', 2, 5, "Use select_related('actor')"),
+        ])
+
+    def test_repeated_query_without_parent_is_not_reported(self):
+        queries = [self._query('SELECT * FROM "language" WHERE "language"."language_id" = 1', 'language')] * 3
+        self.assertEqual(find_n_plus_one_groups(queries), [])
+
+    def test_request_without_queries_builds_a_query_document(self):
+        # unsampled slow or error requests, cached responses, rejected credentials
+        record = analyze_record({
+            'queries': [],
+            'request_path': '/film/films/',
+            'request_execution_datetime': dt(2025, 1, 1, 10),
+            'response_status_code': 401,
+            'sample_reason': ERROR,
+        })
+        query = Query(**record)
+        self.assertEqual((query['total_duration'], query['total_fetch_duration']), (0.0, 0.0))
+        self.assertIsInstance(query['total_duration'], float)
+
+
+class NormalizeSqlTest(SimpleTestCase):
+    def test_literals_and_placeholders_are_stripped(self):
+        first = normalize_sql('SELECT "film"."title" FROM "film" WHERE "film"."film_id" = 5 AND "film"."rating" = \'PG\'')
+        second = normalize_sql('SELECT "film"."title" FROM "film" WHERE "film"."film_id" = %s AND "film"."rating" = %s')
+        self.assertEqual(first, second)
+        self.assertEqual(first, 'SELECT "film"."title" FROM "film" WHERE "film"."film_id" = ? AND "film"."rating" = ?')
+
+    def test_in_lists_are_collapsed(self):
+        self.assertEqual(
+            normalize_sql('SELECT * FROM "actor" WHERE "actor"."actor_id" IN (%s, %s, %s)'),
+            normalize_sql('SELECT * FROM "actor" WHERE "actor"."actor_id" IN (1)'),
+        )
+
+    def test_savepoint_names_are_stripped(self):
+        for sql in ('SAVEPOINT "{}"', 'RELEASE SAVEPOINT "{}"', 'ROLLBACK TO SAVEPOINT "{}"', 'SAVEPOINT `{}`'):
+            self.assertEqual(normalize_sql(sql.format('s140236_x1')), normalize_sql(sql.format('s139847_x12')))
+        self.assertEqual(normalize_sql('RELEASE SAVEPOINT "s140236_x1"'), 'RELEASE SAVEPOINT ?')
+
+
+class SQLParseCacheTest(SimpleTestCase):
+    def test_parse_is_cached_by_fingerprint(self):
+        cache = SQLParseCache(maxsize=10)
+        first = cache.parse('SELECT "film"."title" FROM "film" WHERE "film"."film_id" = %s')
+        second = cache.parse('SELECT "film"."title" FROM "film" WHERE "film"."film_id" = 42')
+        self.assertEqual(first, second)
+        self.assertEqual(first.tables, ['film'])
+        self.assertEqual(first.statement_type, 'SELECT')
+        self.assertEqual(cache.stats()['hits'], 1)
+        self.assertEqual(cache.stats()['misses'], 1)
+
+    def test_least_recently_used_entry_is_evicted(self):
+        cache = SQLParseCache(maxsize=1)
+        cache.parse('SELECT * FROM "film"')
+        cache.parse('SELECT * FROM "actor"')
+        cache.parse('SELECT * FROM "film"')
+        self.assertEqual(cache.stats()['misses'], 3)
+        self.assertEqual(cache.stats()['size'], 1)
+
+
+class SamplerTest(SimpleTestCase):
+    def test_most_specific_path_rate_wins(self):
+        sampler = Sampler(rate=1.0, path_rates={'/film/': 0.0, '/film/actors/': 1.0},
+                          slow_request_threshold=None, error_status_threshold=None)
+        self.assertFalse(sampler.should_capture('/film/films/'))
+        self.assertTrue(sampler.should_capture('/film/actors/'))
+        self.assertTrue(sampler.should_capture('/customer/'))
+
+    def test_slow_and_error_requests_are_kept_without_sampling(self):
+        sampler = Sampler(rate=0.0, path_rates={}, slow_request_threshold=1.0, error_status_threshold=500)
+        self.assertIsNone(sampler.keep_reason(False, 0.1, 200))
+        self.assertEqual(sampler.keep_reason(False, 2.0, 200), SLOW)
+        self.assertEqual(sampler.keep_reason(False, 0.1, 503), ERROR)
+        self.assertEqual(sampler.keep_reason(True, 0.1, 200), SAMPLED)
+
+
+class RollupTest(SimpleTestCase):
+    def test_aligned_granularity(self):
+        self.assertEqual(aligned_granularity(dt(2025, 1, 1, 10), dt(2025, 1, 1, 12)), HOUR)
+        self.assertEqual(aligned_granularity(dt(2025, 1, 1, 10, 5), dt(2025, 1, 1, 12)), MINUTE)
+        self.assertIsNone(aligned_granularity(dt(2025, 1, 1, 10), dt(2025, 1, 1, 12, 0, 30)))
+
+    def test_batch_accumulates_buckets(self):
+        batch = RollupBatch()
+        for duration in (0.1, 0.3):
+            batch.add({
+                'request_path': '/film/films/',
+                'request_execution_datetime': dt(2025, 1, 1, 10, 5, 30),
+                'response_status_code': 200,
+                'queries': [{'execution_duration': duration, 'fingerprint': 'abc', 'tables': ['film']}],
+            })
+        endpoint = batch.buckets[(HOUR, dt(2025, 1, 1, 10), ENDPOINT, '/film/films/')]
+        self.assertEqual(endpoint['count'], 2)
+        self.assertAlmostEqual(endpoint['total_duration'], 0.4)
+        self.assertEqual(endpoint['max_duration'], 0.3)
+        self.assertEqual(endpoint['status_codes'], {'200': 2})
+        self.assertEqual(batch.buckets[(MINUTE, dt(2025, 1, 1, 10, 5), TABLE, 'film')]['count'], 2)
+        self.assertEqual(len(batch.operations()), 6)
+
+    def test_replayed_requests_are_skipped(self):
+        batch = RollupBatch()
+        batch.add({
+            'request_path': '/film/films/',
+            'request_execution_datetime': dt(2025, 1, 1, 10, 5),
+            'response_status_code': 200,
+            'replay_id': 'run:1',
+            'queries': [{'execution_duration': 0.1, 'fingerprint': 'abc', 'tables': ['film']}],
+        })
+        self.assertEqual(batch.operations(), [])
+
+    def test_endpoint_timings_only_cover_captured_requests(self):
+        batch = RollupBatch()
+        for sample_reason in (SAMPLED, SLOW):
+            batch.add({
+                'request_path': '/customer/rentals/',
+                'request_execution_datetime': dt(2025, 1, 1, 10, 5),
+                'response_status_code': 200,
+                'sample_reason': sample_reason,
+                'request_duration': 2.0,
+                'render_duration': 0.5,
+                'queries': [{'execution_duration': 0.25, 'fingerprint': 'abc', 'tables': ['rental']}]
+                if sample_reason == SAMPLED else [],
+            })
+        endpoint = batch.buckets[(HOUR, dt(2025, 1, 1, 10), ENDPOINT, '/customer/rentals/')]
+        self.assertEqual(endpoint['count'], 2)
+        self.assertEqual(endpoint['timings'], {'count': 1, 'request': 2.0, 'db': 0.25, 'render': 0.5})
+
+    def test_covering_buckets_match(self):
+        match = covering_buckets_match(dt(2025, 1, 1, 9, 58, 30), dt(2025, 1, 1, 12, 1), ENDPOINT)
+        self.assertEqual(match['$or'], [
+            {"granularity": MINUTE, "bucket_start": {"$gte": dt(2025, 1, 1, 9, 58), "$lt": dt(2025, 1, 1, 10)}},
+            {"granularity": HOUR, "bucket_start": {"$gte": dt(2025, 1, 1, 10), "$lt": dt(2025, 1, 1, 12)}},
+            {"granularity": MINUTE, "bucket_start": {"$gte": dt(2025, 1, 1, 12), "$lt": dt(2025, 1, 1, 12, 1)}},
+        ])
+
+    def test_expired_minute_edges_are_covered_by_hours(self):
+        match = covering_buckets_match(dt(2025, 1, 1, 9, 58, 30), dt(2025, 1, 1, 12, 1), ENDPOINT,
+                                       minute_since=dt(2025, 1, 1, 11))
+        self.assertEqual(match['$or'], [
+            {"granularity": HOUR, "bucket_start": {"$gte": dt(2025, 1, 1, 9), "$lt": dt(2025, 1, 1, 12)}},
+            {"granularity": MINUTE, "bucket_start": {"$gte": dt(2025, 1, 1, 12), "$lt": dt(2025, 1, 1, 12, 1)}},
+        ])
+
+    @override_settings(DATABASE_PROFILER={'MINUTE_ROLLUP_RETENTION_DAYS': 7})
+    def test_expired_minute_ranges_fall_back_to_raw_documents(self):
+        recent = bucket_start(dt.now(), HOUR) - timedelta(days=1)
+        old = recent - timedelta(days=30)
+        self.assertEqual(rollup_granularity(recent + timedelta(minutes=5), recent + timedelta(hours=2)), MINUTE)
+        self.assertIsNone(rollup_granularity(old + timedelta(minutes=5), old + timedelta(hours=2)))
+        self.assertEqual(rollup_granularity(old, old + timedelta(hours=2)), HOUR)
+        # request parameters are timezone-aware
+        aware_old = old.replace(tzinfo=timezone.utc)
+        self.assertIsNone(rollup_granularity(aware_old + timedelta(minutes=5), aware_old + timedelta(hours=2)))
+        match = covering_buckets_match(aware_old + timedelta(minutes=5), aware_old + timedelta(hours=2), ENDPOINT,
+                                       minute_since=recent)
+        self.assertEqual(match['$or'][0]['granularity'], HOUR)
+
+    def test_percentiles_merge_buckets(self):
+        batch = RollupBatch()
+        for minute, duration in ((5, 0.1), (5, 0.2), (6, 0.3), (6, 0.4)):
+            batch.add({
+                'request_path': '/film/films/',
+                'request_execution_datetime': dt(2025, 1, 1, 10, minute),
+                'response_status_code': 200,
+                'request_duration': duration,
+                'queries': [{'execution_duration': 0.01, 'fingerprint': 'abc', 'tables': ['film']}],
+            })
+        minute_buckets = [
+            dict(entry, key=key) for (granularity, _, dimension, key), entry in batch.buckets.items()
+            if granularity == MINUTE and dimension == ENDPOINT
+        ]
+        [row] = bucket_percentiles(minute_buckets)
+        self.assertEqual(row['count'], 4)
+        self.assertEqual(row['sample_count'], 4)
+        self.assertAlmostEqual(row['max_estimate'], 0.4, delta=0.4 * RELATIVE_ACCURACY)
+        self.assertEqual(row['query_count_max'], 1)
+        data = PercentilesSerializer(row).data
+        self.assertEqual(data['query_count_mean'], 1.0)
+        self.assertEqual(data['max_estimate'], row['max_estimate'])
+
+
+def _matches(document, match):
+    """
+    Evaluate the subset of a MongoDB $match the views use against an in-memory document.
+    """
+    for field, condition in match.items():
+        value = document.get(field)
+        if not isinstance(condition, dict):
+            if value != condition:
+                return False
+            continue
+        for operator, operand in condition.items():
+            if not {
+                '$gte': lambda: value >= operand,
+                '$gt': lambda: value > operand,
+                '$lte': lambda: value <= operand,
+                '$lt': lambda: value < operand,
+                '$in': lambda: value in operand,
+                '$ne': lambda: value != operand,
+            }[operator]():
+                return False
+    return True
+
+
+class RangeConsistencyTest(SimpleTestCase):
+    """
+    Ranges lining up with the rollup buckets and ranges answered from the raw documents count the same requests.
+    """
+    def _records(self):
+        def record(minute, path='/film/films/', replay_id=None):
+            return {
+                'request_path': path,
+                'request_execution_datetime': dt(2025, 1, 1, 10, minute, tzinfo=timezone.utc),
+                'response_status_code': 200,
+                'replay_id': replay_id,
+                'queries': [{'execution_duration': 0.01, 'fingerprint': 'abc', 'tables': ['film']}],
+            }
+        return [record(5), record(20), record(30, replay_id='run:1'), record(40), record(50, path='/actor/'),
+                # exactly at the end of the range, in the next bucket
+                dict(record(0, path='/next/'), request_execution_datetime=dt(2025, 1, 1, 11, tzinfo=timezone.utc))]
+
+    def _paginate_call(self, view, from_date, to_date):
+        calls = []
+
+        def paginate(collection, pipeline, *args):
+            calls.append((collection, pipeline) + args)
+            return [], None
+
+        with mock.patch('database_profiler.views.paginate', side_effect=paginate):
+            response = view.as_view()(APIRequestFactory().get('/', {'from_date': from_date, 'to_date': to_date}))
+        self.assertEqual(response.status_code, 200)
+        [call] = calls
+        return call
+
+    def _endpoint_usage(self, records, from_date, to_date):
+        batch = RollupBatch()
+        for record in records:
+            batch.add(record)
+        buckets = [dict(entry, granularity=granularity, bucket_start=start, dimension=dimension, key=key)
+                   for (granularity, start, dimension, key), entry in batch.buckets.items()]
+        collection, pipeline, *_ = self._paginate_call(MostUsedEndpointsView, from_date, to_date)
+        usage = Counter()
+        for document in buckets if collection is QueryRollup else records:
+            if _matches(document, pipeline[0]['$match']):
+                if collection is QueryRollup:
+                    usage[document['key']] += document['count']
+                else:
+                    usage[document['request_path']] += 1
+        return collection, usage
+
+    def test_aligned_and_unaligned_ranges_count_the_same_requests(self):
+        records = self._records()
+        aligned = self._endpoint_usage(records, '2025-01-01T10:00:00Z', '2025-01-01T11:00:00Z')
+        unaligned = self._endpoint_usage(records, '2025-01-01T09:59:30Z', '2025-01-01T11:00:00Z')
+        self.assertEqual((aligned[0], unaligned[0]), (QueryRollup, Query))
+        self.assertEqual(aligned[1], unaligned[1])
+        self.assertEqual(aligned[1], {'/film/films/': 3, '/actor/': 1})
+
+    def test_unaligned_query_usage_is_counted_in_the_range(self):
+        aligned = self._paginate_call(MostUsedQueriesView, '2025-01-01T10:00:00Z', '2025-01-01T11:00:00Z')
+        unaligned = self._paginate_call(MostUsedQueriesView, '2025-01-01T09:59:30Z', '2025-01-01T11:00:00Z')
+        self.assertEqual((aligned[0], unaligned[0]), (QueryRollup, Query))
+        [match, unwind, _, group] = unaligned[1]
+        self.assertEqual(match['$match']['request_execution_datetime']['$gte'],
+                         dt(2025, 1, 1, 9, 59, 30, tzinfo=timezone.utc))
+        self.assertEqual(unwind, {'$unwind': '$queries'})
+        self.assertEqual(group['$group']['_id'], '$queries.fingerprint')
+        self.assertEqual(group['$group']['total_usage'], {'$sum': 1})
+        # same sort and page stages, total_usage means executions in the range on both paths
+        self.assertEqual(aligned[2:], unaligned[2:])
+
+
+class FingerprintStatsTest(SimpleTestCase):
+    def test_batch_accumulates_fingerprints(self):
+        batch = FingerprintStatsBatch()
+        sql = 'SELECT "film"."title" FROM "film" WHERE "film"."film_id" = %s'
+        for executed_at, duration, rows_affected in ((dt(2025, 1, 1, 10), 0.2, 1), (dt(2025, 1, 1, 9), 0.05, -1)):
+            batch.add({
+                'request_execution_datetime': executed_at,
+                'queries': [{'sql': sql, 'execution_duration': duration, 'rows_affected': rows_affected,
+                             'fingerprint': 'abc', 'tables': ['film']}],
+            })
+        entry = batch.fingerprints['abc']
+        self.assertEqual(entry['call_count'], 2)
+        self.assertAlmostEqual(entry['total_duration'], 0.25)
+        self.assertEqual((entry['min_duration'], entry['max_duration']), (0.05, 0.2))
+        self.assertEqual(entry['rows_affected'], 1)
+        self.assertEqual((entry['first_seen'], entry['last_seen']), (dt(2025, 1, 1, 9), dt(2025, 1, 1, 10)))
+        self.assertEqual(entry['statement_type'], 'SELECT')
+        self.assertNotIn('%s', entry['normalized_sql'])
+        self.assertEqual(len(batch.operations()), 1)
+
+    def test_replayed_requests_are_skipped(self):
+        batch = FingerprintStatsBatch()
+        batch.add({
+            'request_execution_datetime': dt(2025, 1, 1, 10),
+            'replay_id': 'run:1',
+            'queries': [{'sql': 'SELECT 1', 'execution_duration': 0.1, 'rows_affected': 1,
+                         'fingerprint': 'abc', 'tables': []}],
+        })
+        self.assertEqual(batch.fingerprints, {})
+
+
+class CompactStorageTest(SimpleTestCase):
+    def _record(self):
+        sql = 'SELECT "film"."title" FROM "film" WHERE "film"."film_id" = %s'
+        return {
+            'request_path': '/film/films/',
+            'request_execution_datetime': dt(2025, 1, 1, 10),
+            'queries': [
+                {
+                    'sql': sql, 'params': (film_id,), 'execution_duration': 0.0015 * film_id,
+                    'execution_time': dt(2025, 1, 1, 10, 0, 0, 1000 * film_id), 'is_in_transaction': False,
+                    'db_alias': 'default', 'rows_affected': 1, 'db_vendor': 'postgresql', 'needs_rollback': False,
+                    'fingerprint': 'abc', 'tables': ['film'],
+                }
+                for film_id in (1, 2)
+            ],
+        }
+
+    def test_compact_record(self):
+        record = self._record()
+        compacted = compact_record(record)
+        self.assertEqual(compacted['storage_format'], COMPACT)
+        self.assertEqual((compacted['db_alias'], compacted['db_vendor']), ('default', 'postgresql'))
+        self.assertEqual(compacted['table_counts'], [{'table': 'film', 'count': 2}])
+        self.assertEqual(compacted['queries'][1], {
+            'fingerprint': 'abc', 'duration_us': 3000, 'offset_us': 1000, 'rows_affected': 1})
+        self.assertIn('sql', record['queries'][0])
+
+    def test_expand_restores_queries(self):
+        record = self._record()
+        compacted = compact_record(record, capture_params=True)
+        texts = {'abc': {'fingerprint': 'abc', 'sql': record['queries'][0]['sql'], 'tables': ['film']}}
+        with mock.patch('database_profiler.storage.sql_texts', return_value=texts):
+            expanded, = expand_records([compacted])
+        self.assertEqual(expanded['queries'], record['queries'])
+        self.assertNotIn('storage_format', expanded)
+
+    def test_sql_text_sample_params_are_bson_safe(self):
+        record = self._record()
+        record['queries'][0]['params'] = (Decimal('0'), dt(2025, 1, 1).date())
+        store = SqlTextStore(10, capture_params=True)
+        with mock.patch.object(SqlText, 'bulk_write') as bulk_write:
+            store.save([record])
+            store.save([record])
+        operation, = bulk_write.call_args.args[0]
+        self.assertEqual(operation._doc['$setOnInsert']['params'], ['0', '2025-01-01'])
+        # known fingerprints are not written again
+        self.assertEqual(bulk_write.call_count, 1)
+
+    def test_sql_text_params_are_only_stored_when_captured(self):
+        with mock.patch.object(SqlText, 'bulk_write') as bulk_write:
+            SqlTextStore(10).save([self._record()])
+        operation, = bulk_write.call_args.args[0]
+        self.assertIsNone(operation._doc['$setOnInsert']['params'])
+        self.assertEqual(operation._doc['$setOnInsert']['sql'], self._record()['queries'][0]['sql'])
+
+    def test_sql_text_is_stored_without_params_that_cannot_be_encoded(self):
+        store = SqlTextStore(10, capture_params=True)
+        with mock.patch.object(SqlText, 'bulk_write', side_effect=[InvalidDocument('cannot encode object'), None]) \
+                as bulk_write:
+            store.save([self._record()])
+        operation, = bulk_write.call_args.args[0]
+        self.assertIsNone(operation._doc['$setOnInsert']['params'])
+        self.assertEqual(store.stored, {'abc'})
+
+
+class SlowQueryPlanTest(SimpleTestCase):
+    def test_slow_statement_is_the_slowest_select(self):
+        record = {
+            'total_duration': 1.5,
+            'slowest_query_index': 1,
+            'queries': [
+                {'sql': 'SELECT "film"."title" FROM "film"', 'fingerprint': 'a'},
+                {'sql': 'SELECT "rental"."rental_id" FROM "rental" WHERE "rental"."customer_id" = %s',
+                 'fingerprint': 'b'},
+            ],
+        }
+        self.assertEqual(slow_statement(record, 1.0)['fingerprint'], 'b')
+        self.assertIsNone(slow_statement(record, 2.0))
+        record['queries'][1]['sql'] = 'UPDATE "rental" SET "return_date" = %s'
+        self.assertIsNone(slow_statement(record, 1.0))
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+                       DATABASE_PROFILER={'EXPLAIN_ANALYZE_MAX_PER_HOUR': 2})
+    def test_explain_runs_are_capped_per_fingerprint_and_hour(self):
+        self.assertEqual([claim_explain_slot('a', dt(2025, 1, 1, 10)) for _ in range(3)], [True, True, False])
+        self.assertTrue(claim_explain_slot('b', dt(2025, 1, 1, 10)))
+        self.assertTrue(claim_explain_slot('a', dt(2025, 1, 1, 11)))
+
+
+class ReleaseComparisonTest(SimpleTestCase):
+    def _row(self, count, p95, query_count_mean):
+        return {'count': count, 'sample_count': count, 'p95': p95, 'query_count_mean': query_count_mean}
+
+    def test_compare_metric(self):
+        change, flag = compare_metric(0.1, 0.15, 0.2)
+        self.assertAlmostEqual(change, 0.5)
+        self.assertEqual(flag, 'regression')
+        self.assertEqual(compare_metric(0.1, 0.11, 0.2)[1], None)
+        self.assertEqual(compare_metric(10, 5, 0.2), (-0.5, 'improvement'))
+        self.assertEqual(compare_metric(0, 3, 0.2), (None, 'regression'))
+        self.assertEqual(compare_metric(None, 3, 0.2), (None, None))
+
+    def test_diff_rows_flags_significant_changes(self):
+        metrics = {'queries_per_request': lambda row: row['query_count_mean'], 'p95': lambda row: row['p95']}
+        rows = diff_rows(
+            {'/film/films/': self._row(100, 0.2, 3), '/actor/': self._row(5, 0.1, 1), '/old/': self._row(50, 0.1, 1)},
+            {'/film/films/': self._row(100, 0.21, 30), '/actor/': self._row(5, 0.5, 1), '/new/': self._row(50, 0.1, 1)},
+            metrics, 0.2, 30)
+        rows = {row['key']: row for row in rows}
+        self.assertEqual(rows['/film/films/']['regressions'], ['queries_per_request'])
+        self.assertEqual(rows['/film/films/']['queries_per_request_change'], 9.0)
+        # too few samples to flag
+        self.assertEqual(rows['/actor/']['regressions'], [])
+        self.assertEqual((rows['/old/']['status'], rows['/new/']['status']), (REMOVED, NEW))
+        self.assertEqual(rows['/film/films/']['status'], COMMON)
+
+    def test_rollup_buckets_are_kept_per_release(self):
+        batch = RollupBatch('abc123')
+        batch.add({
+            'request_path': '/film/films/',
+            'request_execution_datetime': dt(2025, 1, 1, 10, 5),
+            'response_status_code': 200,
+            'queries': [],
+        })
+        self.assertTrue(all(operation._filter['release'] == 'abc123' for operation in batch.operations()))
+
+
+class SketchTest(SimpleTestCase):
+    def test_quantiles_are_within_relative_accuracy(self):
+        values = [i / 1000 for i in range(1, 10001)]
+        sketch = LogHistogram()
+        for value in values:
+            sketch.add(value)
+        for q in (0.5, 0.95, 0.99):
+            expected = values[int(q * (len(values) - 1))]
+            self.assertAlmostEqual(sketch.quantile(q), expected, delta=expected * RELATIVE_ACCURACY)
+
+    def test_merged_sketch_equals_combined_sketch(self):
+        first, second, combined = LogHistogram(), LogHistogram(), LogHistogram()
+        for value in (0.01, 0.02, 0.5):
+            first.add(value)
+            combined.add(value)
+        for value in (0.03, 1.5):
+            second.add(value)
+            combined.add(value)
+        self.assertEqual(LogHistogram(first.counts).counts, first.counts)
+        first.merge(second.counts)
+        self.assertEqual(first.counts, combined.counts)
+        self.assertIsNone(LogHistogram().quantile(0.5))
+
+    def test_count_histogram(self):
+        sketch = CountHistogram()
+        for value in (1, 1, 2, 30):
+            sketch.add(value)
+        self.assertEqual(sketch.quantile(0.5), 1)
+        self.assertEqual(sketch.max(), 30)
+
+
+class KeysetPaginationTest(SimpleTestCase):
+    def test_cursor_round_trip(self):
+        values = [dt(2025, 1, 1, 10, 5), ObjectId()]
+        self.assertEqual(decode_cursor(encode_cursor(values)), values)
+
+    def test_invalid_cursor(self):
+        with self.assertRaises(ValueError):
+            decode_cursor('not-a-cursor')
+
+    def test_cursor_must_match_the_sort_fields(self):
+        for values in ([1.0], [1.0, ObjectId(), 'x'], [{"$ne": None}, 'x'], [[1], 'x']):
+            serializer = QueriesRequestBaseSerializer(data={'cursor': encode_cursor(values)})
+            self.assertFalse(serializer.is_valid())
+            self.assertIn('cursor', serializer.errors)
+        serializer = QueriesRequestBaseSerializer(data={'cursor': encode_cursor([1.0, ObjectId()])})
+        self.assertTrue(serializer.is_valid())
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+                       DATABASE_PROFILER={'COUNT_CACHE_SECONDS': 60})
+    def test_counts_up_to_now_share_the_cache(self):
+        collection = mock.Mock()
+        collection._get_name.return_value = 'query'
+        collection.aggregate.return_value = [{'total': 3}]
+
+        def count(to_date):
+            return cached_count(collection, [{"$match": request_range_match(dt(2025, 1, 1), to_date)}])
+
+        self.assertEqual([count(dt.now()), count(dt.now()), count(dt.now(timezone.utc))], [3, 3, 3])
+        self.assertEqual(collection.aggregate.call_count, 1)
+        count(dt(2025, 1, 2))
+        count(dt(2025, 1, 3))
+        self.assertEqual(collection.aggregate.call_count, 3)
+
+    def test_keyset_match(self):
+        self.assertEqual(keyset_match([("total_usage", -1), ("request_path", -1)], [5, '/film/films/']), {
+            "$or": [
+                {"total_usage": {"$lt": 5}},
+                {"total_usage": 5, "request_path": {"$lt": '/film/films/'}},
+            ]
+        })
+
+
+class RequestSerializerTest(SimpleTestCase):
+    def test_to_date_defaults_to_the_request_time(self):
+        data = {'base_release': 'a', 'target_release': 'b'}
+        for serializer_class in (QueriesRequestBaseSerializer, PercentilesRequestSerializer,
+                                 QueriesExportRequestSerializer, ReleaseComparisonRequestSerializer):
+            before = dt.now()
+            serializer = serializer_class(data=data)
+            self.assertTrue(serializer.is_valid(), serializer.errors)
+            self.assertGreaterEqual(serializer.validated_data['to_date'], before)
+
+
+class _ExportCursor(list):
+    closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class ExportTest(SimpleTestCase):
+    def _documents(self):
+        query = {
+            'sql': 'SELECT "film"."title" FROM "film" WHERE "film"."film_id" = %s', 'params': [1],
+            'execution_duration': 0.002, 'execution_time': dt(2025, 1, 1, 10), 'rows_affected': 1,
+            'db_alias': 'default', 'fingerprint': 'abc', 'tables': ['film'],
+        }
+        return [
+            {'_id': ObjectId(), 'request_path': '/film/films/', 'request_execution_datetime': dt(2025, 1, 1, 10),
+             'response_status_code': 200, 'is_n_plus_one': False, 'queries': [query, dict(query, params=[2])],
+             'response_data': '{"title": "ACADEMY DINOSAUR"}'},
+            {'_id': ObjectId(), 'request_path': '/actor/', 'request_execution_datetime': dt(2025, 1, 1, 11),
+             'response_status_code': 200, 'is_n_plus_one': False, 'queries': [], 'response_data': None},
+        ]
+
+    def test_ndjson_has_one_decoded_line_per_document(self):
+        cursor = _ExportCursor(self._documents())
+        lines = [json.loads(line) for line in stream_ndjson(cursor)]
+        self.assertEqual([line['request_path'] for line in lines], ['/film/films/', '/actor/'])
+        self.assertEqual(lines[0]['response_data'], {'title': 'ACADEMY DINOSAUR'})
+        self.assertEqual(lines[0]['request_execution_datetime'], '2025-01-01T10:00:00')
+        self.assertTrue(cursor.closed)
+
+    def test_csv_has_one_row_per_query(self):
+        cursor = _ExportCursor(self._documents())
+        rows = list(csv.reader(''.join(stream_csv(cursor)).splitlines()))
+        self.assertEqual(rows[0], CSV_COLUMNS)
+        self.assertEqual([row[1] for row in rows[1:]], ['/film/films/', '/film/films/', '/actor/'])
+        self.assertEqual([(row[5], row[7], row[9]) for row in rows[1:3]], [('0', '[1]', 'film'), ('1', '[2]', 'film')])
+        # a request without queries has only the request columns
+        self.assertEqual(len(rows[3]), 5)
+        self.assertTrue(cursor.closed)
+
+
+class IndexAdvisorTest(SimpleTestCase):
+    sql = 'SELECT "rental"."rental_id" FROM "rental" WHERE "rental"."customer_id" = %s ORDER BY "rental"."rental_date"'
+    plan = {"Node Type": "Sort", "Plans": [{"Node Type": "Seq Scan", "Relation Name": "rental", "Plan Rows": 30}]}
+
+    def test_key_columns_of_django_sql(self):
+        sql = ('SELECT "rental"."rental_id" FROM "rental" INNER JOIN "customer" ON ("rental"."customer_id" = '
+               '"customer"."customer_id") WHERE ("rental"."rental_date" >= %s AND "rental"."staff_id" IN (%s, %s) '
+               'AND "customer"."store_id" = %s) ORDER BY "rental"."return_date" DESC')
+        self.assertEqual(index_key_columns(sql, 'rental'), (['customer_id', 'staff_id'], ['rental_date'], ['return_date']))
+        self.assertEqual(index_key_columns(sql, 'customer'), (['customer_id', 'store_id'], [], []))
+
+    def test_proposal_order(self):
+        self.assertEqual(propose_index(['staff_id'], ['rental_date'], ['return_date']), ['staff_id', 'rental_date'])
+        self.assertEqual(propose_index(['customer_id'], [], ['rental_date']), ['customer_id', 'rental_date'])
+
+    def test_selective_seq_scan_gets_a_suggestion(self):
+        indexes = {'rental': [IndexInfo('rental_customer_id_prefix', ('customer_id_old',), False),
+                              IndexInfo('rental_customer_id', ('customer_id',), False)]}
+        [suggestion] = suggest_indexes(self.sql, self.plan, 0.05, {'rental': 1000000}, indexes)
+        self.assertEqual(suggestion['statement'], 'CREATE INDEX ON "rental" ("customer_id", "rental_date")')
+        self.assertEqual(suggestion['usable_indexes'], ['rental_customer_id'])
+
+    def test_small_tables_and_covered_statements_are_skipped(self):
+        self.assertEqual(suggest_indexes(self.sql, self.plan, 0.05, {'rental': 1000}, {}), [])
+        indexes = {'rental': [IndexInfo('rental_customer_id_rental_date', ('customer_id', 'rental_date', 'staff_id'),
+                                        False)]}
+        self.assertEqual(suggest_indexes(self.sql, self.plan, 0.05, {'rental': 1000000}, indexes), [])
+        # the key order matters: rental_date first cannot serve the customer_id lookup and the sort
+        indexes = {'rental': [IndexInfo('rental_rental_date_customer_id', ('rental_date', 'customer_id'), False)]}
+        self.assertEqual(len(suggest_indexes(self.sql, self.plan, 0.05, {'rental': 1000000}, indexes)), 1)
+
+
+class _HypoPGCursor:
+    """Answers EXPLAIN with a cheaper plan while a hypothetical index exists."""
+
+    def __init__(self):
+        self.hypothetical_indexes = []
+        self.result = None
+
+    def execute(self, sql, params=None):
+        if 'hypopg_create_index' in sql:
+            self.hypothetical_indexes.append(params[0])
+        elif 'hypopg_reset' in sql:
+            self.hypothetical_indexes = []
+        elif sql.startswith('EXPLAIN'):
+            cost = 40.0 if self.hypothetical_indexes else 1000.0
+            self.result = [([{"Plan": {"Total Cost": cost}}],)]
+
+    def fetchall(self):
+        return self.result
+
+
+class WhatIfTest(SimpleTestCase):
+    def test_suggestions_are_ranked_by_weighted_cost_reduction(self):
+        cursor = _HypoPGCursor()
+        suggestions = [{'statement': 'CREATE INDEX ON "rental" ("customer_id")'}]
+        item = {'sql': 'SELECT 1', 'params': [], 'call_count': 10}
+        benefit = evaluate_suggestions(cursor, HYPOPG, item, suggestions)
+        self.assertEqual(benefit, 9600.0)
+        self.assertEqual((suggestions[0]['base_cost'], suggestions[0]['estimated_cost']), (1000.0, 40.0))
+        self.assertEqual(cursor.hypothetical_indexes, [])
+
+    def test_statements_without_params_get_a_generic_plan(self):
+        cursor = mock.Mock()
+        cursor.fetchall.return_value = [([{"Plan": {"Total Cost": 1.0}}],)]
+        plan = explain(cursor, """SELECT "film"."title" FROM "film" WHERE "film"."film_id" = %s """
+                               """AND "film"."title" LIKE 'A%%' AND "film"."length" > %s""", None)
+        self.assertEqual(plan, {"Total Cost": 1.0})
+        cursor.execute.assert_called_once_with(
+            """EXPLAIN (GENERIC_PLAN, FORMAT JSON) SELECT "film"."title" FROM "film" WHERE "film"."film_id" = $1 """
+            """AND "film"."title" LIKE 'A%' AND "film"."length" > $2""")
+
+
+class ReplayTest(SimpleTestCase):
+    def _record(self, second, path, method='GET', query_count=3):
+        return {'_id': ObjectId(), 'request_path': path, 'request_method': method,
+                'request_execution_datetime': dt(2025, 1, 1, 10, 0, second), 'request_duration': 0.2,
+                'query_count': query_count, 'response_status_code': 200}
+
+    def test_schedule_restores_sampled_frequencies(self):
+        records = [self._record(0, '/film/films/'), self._record(2, '/film/actors/'),
+                   self._record(3, '/store-staff-panel/rent-film/', method='POST')]
+        sampler = Sampler(rate=1.0, path_rates={'/film/films/': 0.25}, slow_request_threshold=None,
+                          error_status_threshold=None)
+        schedule, skipped = build_schedule(records, sampler)
+        self.assertEqual(skipped, 1)
+        self.assertEqual([(item.offset, item.record['request_path']) for item in schedule],
+                         [(0.0, '/film/films/')] * 4 + [(2.0, '/film/actors/')])
+
+    def test_compare_counts_each_replayed_record_once(self):
+        record = self._record(0, '/film/films/')
+        results = [ReplayResult(record, 200, 0.1), ReplayResult(record, 500, 0.3)]
+        [row] = compare(results, {str(record['_id']): [{'query_count': 1}, {'query_count': 1}]})
+        self.assertEqual((row['count'], row['errors'], row['status_changes']), (2, 1, 1))
+        self.assertEqual((row['original_queries'], row['replay_queries']), (3, 1))
+
+
+class _IndexCollection:
+    """
+    The index methods of a pymongo collection, on an in-memory index_information().
+    """
+    name = 'indexed'
+
+    def __init__(self):
+        self.indexes = {'_id_': {'v': 2, 'key': [('_id', 1)]}}
+        self.calls = []
+        self.database = self
+
+    def index_information(self):
+        return {name: dict(index) for name, index in self.indexes.items()}
+
+    def create_index(self, key, name, **options):
+        self.calls.append(('create', name))
+        self.indexes[name] = dict(options, v=2, key=list(key))
+
+    def drop_index(self, name):
+        self.calls.append(('drop', name))
+        del self.indexes[name]
+
+    def command(self, command, collection, index):
+        self.calls.append((command, index['name']))
+        self.indexes[index['name']]['expireAfterSeconds'] = index['expireAfterSeconds']
+
+
+class _Indexed(Model):
+    _indexes = [
+        IndexModel([("created_at", ASCENDING)], name="created_at"),
+        IndexModel([("key", ASCENDING)], name="key", unique=True, partialFilterExpression={"key": {"$type": "string"}}),
+    ]
+
+
+class EnsureIndexesTest(SimpleTestCase):
+    def setUp(self):
+        self.collection = _IndexCollection()
+        patcher = mock.patch.object(_Indexed, '_get_collection', return_value=self.collection)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_indexes_are_created_once(self):
+        _Indexed.ensure_indexes(expire_after_seconds={'created_at': 60})
+        self.assertEqual(self.collection.calls, [('create', 'created_at'), ('create', 'key')])
+        self.assertEqual(self.collection.indexes['created_at']['expireAfterSeconds'], 60)
+        self.assertTrue(self.collection.indexes['key']['unique'])
+        self.collection.calls = []
+        _Indexed.ensure_indexes(expire_after_seconds={'created_at': 60})
+        self.assertEqual(self.collection.calls, [])
+
+    def test_ttl_changes_are_applied_in_place(self):
+        _Indexed.ensure_indexes(expire_after_seconds={'created_at': 60})
+        self.collection.calls = []
+        _Indexed.ensure_indexes(expire_after_seconds={'created_at': 120})
+        self.assertEqual(self.collection.calls, [('collMod', 'created_at')])
+        self.assertEqual(self.collection.indexes['created_at']['expireAfterSeconds'], 120)
+
+    def test_option_changes_recreate_the_index(self):
+        _Indexed.ensure_indexes()
+        self.collection.indexes['key']['partialFilterExpression'] = {"key": {"$exists": True}}
+        del self.collection.indexes['created_at']
+        self.collection.indexes['created_at'] = {'v': 2, 'key': [('created_at', 1)], 'unique': True}
+        self.collection.calls = []
+        _Indexed.ensure_indexes()
+        self.assertEqual(self.collection.calls, [('drop', 'created_at'), ('create', 'created_at'),
+                                                 ('drop', 'key'), ('create', 'key')])
+        self.assertEqual(self.collection.indexes['key']['partialFilterExpression'], {"key": {"$type": "string"}})
+        self.assertNotIn('unique', self.collection.indexes['created_at'])
+
+    def test_undeclared_indexes_are_dropped_on_request(self):
+        self.collection.indexes['legacy'] = {'v': 2, 'key': [('legacy', 1)]}
+        _Indexed.ensure_indexes()
+        self.assertIn('legacy', self.collection.indexes)
+        _Indexed.ensure_indexes(drop_undeclared=True)
+        self.assertEqual(set(self.collection.indexes), {'_id_', 'created_at', 'key'})
+
+    @override_settings(DATABASE_PROFILER={'RETENTION_DAYS': 30, 'MINUTE_ROLLUP_RETENTION_DAYS': None})
+    def test_profiler_indexes_apply_the_retention_settings(self):
+        with mock.patch.object(Query, 'ensure_indexes') as query_indexes, \
+                mock.patch.object(QueryRollup, 'ensure_indexes') as rollup_indexes, \
+                mock.patch('database_profiler.indexes.IndexSuggestion'), \
+                mock.patch('database_profiler.indexes.QueryFingerprint'), \
+                mock.patch('database_profiler.indexes.SqlText'):
+            ensure_profiler_indexes()
+        query_indexes.assert_called_once_with(
+            expire_after_seconds={'request_execution_datetime': 30 * 24 * 60 * 60}, drop_undeclared=True)
+        rollup_indexes.assert_called_once_with(expire_after_seconds={'minute_bucket_start': None}, drop_undeclared=True)
+
+    def test_profiler_index_failures_are_logged(self):
+        with mock.patch.object(Query, 'ensure_indexes', side_effect=Exception('unreachable')), \
+                self.assertLogs('database_profiler.indexes', 'ERROR'):
+            ensure_profiler_indexes()
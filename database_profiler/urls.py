@@ -6,9 +6,15 @@ urlpatterns = [
     path('slow-queries/', views.SlowQueriesView.as_view(), name='database_profiler__slow_queries'),
     path('most-slow-queries/', views.MostSlowQueriesView.as_view(), name='database_profiler__most_slow_queries'),
     path('most-used-endpoints/', views.MostUsedEndpointsView.as_view(), name='database_profiler__most_used_endpoints'),
+    path('app-time-endpoints/', views.AppTimeEndpointsView.as_view(), name='database_profiler__app_time_endpoints'),
     path('most-used-tables/', views.MostUsedTablesView.as_view(), name='database_profiler__most_used_tables'),
     path('most-used-queries/', views.MostUsedQueriesView.as_view(), name='database_profiler__most_used_queries'),
     path('select-or-prefetch-related-potential-candidate-endpoints/',
          views.SelectOrPrefetchRelatedPotentialCandidateEndpointsView.as_view(),
          name='database_profiler__select_or_prefetch_related_potential_candidate_endpoints'),
+    path('percentiles/', views.PercentilesView.as_view(), name='database_profiler__percentiles'),
+    path('release-comparison/', views.ReleaseComparisonView.as_view(), name='database_profiler__release_comparison'),
+    path('index-suggestions/', views.IndexSuggestionsView.as_view(), name='database_profiler__index_suggestions'),
+    path('export/', views.ExportQueriesView.as_view(), name='database_profiler__export'),
+    path('parse-cache-stats/', views.ParseCacheStatsView.as_view(), name='database_profiler__parse_cache_stats'),
 ]
@@ -1,10 +1,24 @@
+from django.http import StreamingHttpResponse
 from rest_framework import views
 from utils.responses import CustomResponse
-from pymongo_wrapper.model import Query
+from pymongo_wrapper.model import Query, QueryRollup, IndexSuggestion, QueryFingerprint
 from .serializers import QueriesSerializer, QueriesRequestSerializer, QueriesRequestBaseSerializer, \
     MostSlowQueriesSerializer, SlowQueriesSerializer, MostUsedEndpointsSerializer, MostUsedTablesSerializer, \
-    MostUsedQueriesSerializer
+    MostUsedQueriesSerializer, QueriesExportRequestSerializer, PercentilesRequestSerializer, PercentilesSerializer, \
+    AppTimeEndpointsSerializer, \
+    NPlusOneQueriesSerializer, IndexSuggestionsRequestSerializer, IndexSuggestionsSerializer, \
+    ReleaseComparisonRequestSerializer, ReleaseEndpointDiffSerializer, ReleaseFingerprintDiffSerializer
 from drf_spectacular.utils import extend_schema
+from pymongo_wrapper.cursor import DESC
+from .conf import profiler_setting
+from .export import export_cursor, stream_csv, stream_ndjson
+from .fingerprint import get_parse_cache
+from .pagination import paginate, cached_count
+from .releases import compare_releases, COMMON
+from .rollups import bucket_range_match, bucket_percentiles, covering_buckets_match, minute_buckets_since, \
+    request_range_match, rollup_granularity, ENDPOINT, TABLE, FINGERPRINT
+from .sampling import SAMPLED
+from .storage import expand_records, max_query_field, table_usage_stages
 import os
 from dotenv import load_dotenv
 
@@ -19,50 +33,37 @@ class QueriesView(views.APIView):
             return CustomResponse.bad_request(request_serializer.errors)
 
         limit = request_serializer.validated_data.get('limit')
-        skip = request_serializer.validated_data.get('skip')
+        cursor = request_serializer.validated_data.get('cursor')
+        with_count = request_serializer.validated_data.get('with_count')
         from_date = request_serializer.validated_data.get('from_date')
         to_date = request_serializer.validated_data.get('to_date')
         sort_by = request_serializer.validated_data.get('sort_by') or 'execution_duration'
 
-        result = list(
-            Query.aggregate([
-                {
-                    "$match": {
-                        "request_execution_datetime": {"$gte": from_date, "$lte": to_date}
-                    }
-                },
-                {
-                    "$set": {
-                        "queries": {
-                            "$sortArray": {
-                                "input": "$queries",
-                                "sortBy": {sort_by: -1}
-                            }
-                        }
-                    }
-                },
-                {
-                    "$facet": {
-                        "results": [
-                            {"$sort": {f"queries.0.{sort_by}": -1}},
-                            {"$skip": skip},
-                            {"$limit": limit}
-                        ],
-                        "count": [{"$count": "total"}]
-                    }
-                },
-                {
-                    "$project": {
-                        "results": 1,
-                        "count": {"$arrayElemAt": ["$count.total", 0]}
-                    }
-                }
-            ])
-        )[0]
+        match = [
+            {
+                "$match": request_range_match(from_date, to_date)
+            },
+        ]
+        if sort_by == 'execution_duration':
+            # index-backed sort on the duration of each request's slowest query
+            pipeline = match
+            sort_fields = [("max_query_duration", DESC), ("_id", DESC)]
+        else:
+            pipeline = match + [{"$set": {"sort_value": max_query_field(sort_by)}}]
+            sort_fields = [("sort_value", DESC), ("_id", DESC)]
+        results, next_cursor = paginate(Query, pipeline, sort_fields, cursor, limit)
 
         try:
-            serializer = QueriesSerializer(result["results"], many=True)
-            response_data = {"count": result["count"], "results": serializer.data}
+            # only the returned page gets its queries sorted
+            for result in expand_records(results):
+                result['queries'].sort(
+                    key=lambda query: (query.get(sort_by) is not None, query.get(sort_by)), reverse=True)
+            serializer = QueriesSerializer(results, many=True)
+            response_data = {
+                "count": cached_count(Query, match) if with_count else None,
+                "next_cursor": next_cursor,
+                "results": serializer.data
+            }
             return CustomResponse.successful_200(response_data)
         except Exception as e:
             print('e: ', str(e))
@@ -77,49 +78,27 @@ class SlowQueriesView(views.APIView):
             return CustomResponse.bad_request(request_serializer.errors)
 
         limit = request_serializer.validated_data.get('limit')
-        skip = request_serializer.validated_data.get('skip')
+        cursor = request_serializer.validated_data.get('cursor')
+        with_count = request_serializer.validated_data.get('with_count')
         from_date = request_serializer.validated_data.get('from_date')
         to_date = request_serializer.validated_data.get('to_date')
 
-        result = list(
-            Query.aggregate([
-                {
-                    "$match": {
-                        "request_execution_datetime": {"$gte": from_date, "$lte": to_date}
-                    }
-                },
-                {
-                    "$addFields": {
-                        "total_duration": {"$sum": "$queries.execution_duration"}
-                    }
-                },
-                {
-                    "$match": {
-                        "total_duration": {"$gte": float(os.getenv('SLOW_QUERY_DURATION_THRESHOLD_SECONDS'))}
-                    }
-                },
-                {
-                    "$facet": {
-                        "results": [
-                            {"$sort": {"total_duration": -1}},
-                            {"$skip": skip},
-                            {"$limit": limit}
-                        ],
-                        "count": [{"$count": "total"}]
-                    }
-                },
-                {
-                    "$project": {
-                        "results": 1,
-                        "count": {"$arrayElemAt": ["$count.total", 0]}
-                    }
-                }
-            ])
-        )[0]
+        pipeline = [
+            {
+                "$match": request_range_match(
+                    from_date, to_date,
+                    total_duration={"$gte": float(os.getenv('SLOW_QUERY_DURATION_THRESHOLD_SECONDS'))})
+            },
+        ]
+        results, next_cursor = paginate(Query, pipeline, [("total_duration", DESC), ("_id", DESC)], cursor, limit)
 
         try:
-            serializer = SlowQueriesSerializer(result["results"], many=True)
-            response_data = {"count": result["count"], "results": serializer.data}
+            serializer = SlowQueriesSerializer(expand_records(results), many=True)
+            response_data = {
+                "count": cached_count(Query, pipeline) if with_count else None,
+                "next_cursor": next_cursor,
+                "results": serializer.data
+            }
             return CustomResponse.successful_200(response_data)
         except Exception as e:
             print('e: ', str(e))
@@ -134,44 +113,25 @@ class MostSlowQueriesView(views.APIView):
             return CustomResponse.bad_request(request_serializer.errors)
 
         limit = request_serializer.validated_data.get('limit')
-        skip = request_serializer.validated_data.get('skip')
+        cursor = request_serializer.validated_data.get('cursor')
+        with_count = request_serializer.validated_data.get('with_count')
         from_date = request_serializer.validated_data.get('from_date')
         to_date = request_serializer.validated_data.get('to_date')
 
-        result = list(
-            Query.aggregate([
-                {
-                    "$match": {
-                        "request_execution_datetime": {"$gte": from_date, "$lte": to_date}
-                    }
-                },
-                {
-                    "$addFields": {
-                        "total_duration": {"$sum": "$queries.execution_duration"}
-                    }
-                },
-                {
-                    "$facet": {
-                        "results": [
-                            {"$sort": {"total_duration": -1}},
-                            {"$skip": skip},
-                            {"$limit": limit}
-                        ],
-                        "count": [{"$count": "total"}]
-                    }
-                },
-                {
-                    "$project": {
-                        "results": 1,
-                        "count": {"$arrayElemAt": ["$count.total", 0]}
-                    }
-                }
-            ])
-        )[0]
+        match = [
+            {
+                "$match": request_range_match(from_date, to_date)
+            },
+        ]
+        results, next_cursor = paginate(Query, match, [("total_duration", DESC), ("_id", DESC)], cursor, limit)
 
         try:
-            serializer = MostSlowQueriesSerializer(result["results"], many=True)
-            response_data = {"count": result["count"], "results": serializer.data}
+            serializer = MostSlowQueriesSerializer(expand_records(results), many=True)
+            response_data = {
+                "count": cached_count(Query, match) if with_count else None,
+                "next_cursor": next_cursor,
+                "results": serializer.data
+            }
             return CustomResponse.successful_200(response_data)
         except Exception as e:
             print('e: ', str(e))
@@ -186,23 +146,41 @@ class MostUsedEndpointsView(views.APIView):
             return CustomResponse.bad_request(request_serializer.errors)
 
         limit = request_serializer.validated_data.get('limit')
-        skip = request_serializer.validated_data.get('skip')
+        cursor = request_serializer.validated_data.get('cursor')
+        with_count = request_serializer.validated_data.get('with_count')
         from_date = request_serializer.validated_data.get('from_date')
         to_date = request_serializer.validated_data.get('to_date')
 
-        result = list(
-            Query.aggregate([
+        # Ranges lining up with the rollup buckets are answered from the pre-aggregated buckets
+        granularity = rollup_granularity(from_date, to_date)
+        if granularity:
+            collection = QueryRollup
+            grouping = [
+                {"$match": bucket_range_match(from_date, to_date, granularity, ENDPOINT)},
                 {
-                    "$match": {
-                        "request_execution_datetime": {"$gte": from_date, "$lte": to_date}
+                    "$group": {
+                        "_id": "$key",
+                        "total_usage": {"$sum": "$count"}
                     }
                 },
+            ]
+        else:
+            collection = Query
+            grouping = [
+                {
+                    "$match": request_range_match(from_date, to_date)
+                },
                 {
                     "$group": {
                         "_id": "$request_path",
                         "total_usage": {"$sum": 1}
                     }
                 },
+            ]
+
+        results, next_cursor = paginate(
+            collection,
+            grouping + [
                 {
                     "$project": {
                         "_id": 0,
@@ -210,35 +188,30 @@ class MostUsedEndpointsView(views.APIView):
                         "total_usage": 1
                     }
                 },
-                {
-                    "$facet": {
-                        "results": [
-                            {"$sort": {"total_usage": -1}},
-                            {"$skip": skip},
-                            {"$limit": limit}
-                        ],
-                        "count": [{"$count": "total"}]
-                    }
-                },
-                {
-                    "$project": {
-                        "results": 1,
-                        "count": {"$arrayElemAt": ["$count.total", 0]}
-                    }
-                }
-            ])
-        )[0]
+            ],
+            [("total_usage", DESC), ("request_path", DESC)],
+            cursor,
+            limit
+        )
 
         try:
-            serializer = MostUsedEndpointsSerializer(result["results"], many=True)
-            response_data = {"count": result["count"], "results": serializer.data}
+            serializer = MostUsedEndpointsSerializer(results, many=True)
+            response_data = {
+                "count": cached_count(collection, grouping) if with_count else None,
+                "next_cursor": next_cursor,
+                "results": serializer.data
+            }
             return CustomResponse.successful_200(response_data)
         except Exception as e:
             print('e: ', str(e))
             return CustomResponse.server_error('')
 
 
-class MostUsedTablesView(views.APIView):
+class AppTimeEndpointsView(views.APIView):
+    """
+    Endpoints ranked by the time they spend outside the database (Python code, serialization
+    and rendering), over the requests whose queries were captured.
+    """
     @extend_schema(parameters=[QueriesRequestBaseSerializer])
     def get(self, request):
         request_serializer = QueriesRequestBaseSerializer(data=request.query_params)
@@ -246,61 +219,89 @@ class MostUsedTablesView(views.APIView):
             return CustomResponse.bad_request(request_serializer.errors)
 
         limit = request_serializer.validated_data.get('limit')
-        skip = request_serializer.validated_data.get('skip')
+        cursor = request_serializer.validated_data.get('cursor')
+        with_count = request_serializer.validated_data.get('with_count')
         from_date = request_serializer.validated_data.get('from_date')
         to_date = request_serializer.validated_data.get('to_date')
 
-        result = list(
-            Query.aggregate([
-                {
-                    "$match": {
-                        "request_execution_datetime": {"$gte": from_date, "$lte": to_date}
-                    }
-                },
-                {"$unwind": "$queries"},
-                {"$unwind": "$queries.tables"},
+        # Ranges lining up with the rollup buckets are answered from the pre-aggregated buckets
+        granularity = rollup_granularity(from_date, to_date)
+        if granularity:
+            collection = QueryRollup
+            grouping = [
+                {"$match": dict(bucket_range_match(from_date, to_date, granularity, ENDPOINT),
+                                **{"timings.count": {"$gt": 0}})},
                 {
                     "$group": {
-                        "_id": "$queries.tables",
-                        "total_usage": {"$sum": 1}
+                        "_id": "$key",
+                        "request_count": {"$sum": "$timings.count"},
+                        "request_duration": {"$sum": "$timings.request"},
+                        "db_duration": {"$sum": "$timings.db"},
+                        "render_duration": {"$sum": "$timings.render"}
                     }
                 },
+            ]
+        else:
+            collection = Query
+            grouping = [
                 {
-                    "$project": {
-                        "_id": 0,
-                        "table_name": "$_id",
-                        "total_usage": 1
-                    }
+                    "$match": request_range_match(
+                        from_date, to_date, sample_reason={"$in": [None, SAMPLED]}, request_duration={"$ne": None})
                 },
                 {
-                    "$facet": {
-                        "results": [
-                            {"$sort": {"total_usage": -1}},
-                            {"$skip": skip},
-                            {"$limit": limit}
-                        ],
-                        "count": [{"$count": "total"}]
+                    "$group": {
+                        "_id": "$request_path",
+                        "request_count": {"$sum": 1},
+                        "request_duration": {"$sum": "$request_duration"},
+                        "db_duration": {"$sum": {"$add": ["$total_duration",
+                                                          {"$ifNull": ["$total_fetch_duration", 0]}]}},
+                        "render_duration": {"$sum": {"$ifNull": ["$render_duration", 0]}}
                     }
                 },
+            ]
+
+        results, next_cursor = paginate(
+            collection,
+            grouping + [
                 {
                     "$project": {
-                        "results": 1,
-                        "count": {"$arrayElemAt": ["$count.total", 0]}
+                        "_id": 0,
+                        "request_path": "$_id",
+                        "request_count": 1,
+                        "total_app_duration": {"$max": [{"$subtract": ["$request_duration", "$db_duration"]}, 0]},
+                        "avg_request_duration": {"$divide": ["$request_duration", "$request_count"]},
+                        "avg_db_duration": {"$divide": ["$db_duration", "$request_count"]},
+                        "avg_render_duration": {"$divide": ["$render_duration", "$request_count"]},
+                        "app_share": {
+                            "$cond": [
+                                {"$gt": ["$request_duration", 0]},
+                                {"$max": [{"$subtract": [1, {"$divide": ["$db_duration", "$request_duration"]}]}, 0]},
+                                0
+                            ]
+                        }
                     }
-                }
-            ])
-        )[0]
+                },
+                {"$set": {"avg_app_duration": {"$divide": ["$total_app_duration", "$request_count"]}}},
+            ],
+            [("total_app_duration", DESC), ("request_path", DESC)],
+            cursor,
+            limit
+        )
 
         try:
-            serializer = MostUsedTablesSerializer(result["results"], many=True)
-            response_data = {"count": result["count"], "results": serializer.data}
+            serializer = AppTimeEndpointsSerializer(results, many=True)
+            response_data = {
+                "count": cached_count(collection, grouping) if with_count else None,
+                "next_cursor": next_cursor,
+                "results": serializer.data
+            }
             return CustomResponse.successful_200(response_data)
         except Exception as e:
             print('e: ', str(e))
             return CustomResponse.server_error('')
 
 
-class MostUsedQueriesView(views.APIView):
+class MostUsedTablesView(views.APIView):
     @extend_schema(parameters=[QueriesRequestBaseSerializer])
     def get(self, request):
         request_serializer = QueriesRequestBaseSerializer(data=request.query_params)
@@ -308,56 +309,138 @@ class MostUsedQueriesView(views.APIView):
             return CustomResponse.bad_request(request_serializer.errors)
 
         limit = request_serializer.validated_data.get('limit')
-        skip = request_serializer.validated_data.get('skip')
+        cursor = request_serializer.validated_data.get('cursor')
+        with_count = request_serializer.validated_data.get('with_count')
         from_date = request_serializer.validated_data.get('from_date')
         to_date = request_serializer.validated_data.get('to_date')
 
-        result = list(
-            Query.aggregate([
+        # Ranges lining up with the rollup buckets are answered from the pre-aggregated buckets
+        granularity = rollup_granularity(from_date, to_date)
+        if granularity:
+            collection = QueryRollup
+            grouping = [
+                {"$match": bucket_range_match(from_date, to_date, granularity, TABLE)},
                 {
-                    "$match": {
-                        "request_execution_datetime": {"$gte": from_date, "$lte": to_date},
-                        "is_n_plus_one": True
+                    "$group": {
+                        "_id": "$key",
+                        "total_usage": {"$sum": "$count"}
                     }
                 },
+            ]
+        else:
+            collection = Query
+            grouping = [
                 {
-                    "$unwind": "$queries"
-                },
-                {
-                    "$group": {
-                        "_id": "$queries.sql",
-                        "total_usage": {"$sum": 1}
-                    }
+                    "$match": request_range_match(from_date, to_date)
                 },
+            ] + table_usage_stages()
+
+        results, next_cursor = paginate(
+            collection,
+            grouping + [
                 {
                     "$project": {
                         "_id": 0,
-                        "query": "$_id",
+                        "table_name": "$_id",
                         "total_usage": 1
                     }
                 },
+            ],
+            [("total_usage", DESC), ("table_name", DESC)],
+            cursor,
+            limit
+        )
+
+        try:
+            serializer = MostUsedTablesSerializer(results, many=True)
+            response_data = {
+                "count": cached_count(collection, grouping) if with_count else None,
+                "next_cursor": next_cursor,
+                "results": serializer.data
+            }
+            return CustomResponse.successful_200(response_data)
+        except Exception as e:
+            print('e: ', str(e))
+            return CustomResponse.server_error('')
+
+
+class MostUsedQueriesView(views.APIView):
+    """
+    SQL fingerprints by number of executions in the range, over all captured queries.
+    Ranges lining up with the rollup buckets are counted from the fingerprint buckets, other
+    ranges from the queries of the raw Query documents.
+    """
+    @extend_schema(parameters=[QueriesRequestBaseSerializer])
+    def get(self, request):
+        request_serializer = QueriesRequestBaseSerializer(data=request.query_params)
+        if not request_serializer.is_valid():
+            return CustomResponse.bad_request(request_serializer.errors)
+
+        limit = request_serializer.validated_data.get('limit')
+        cursor = request_serializer.validated_data.get('cursor')
+        with_count = request_serializer.validated_data.get('with_count')
+        from_date = request_serializer.validated_data.get('from_date')
+        to_date = request_serializer.validated_data.get('to_date')
+
+        granularity = rollup_granularity(from_date, to_date)
+        if granularity:
+            collection = QueryRollup
+            grouping = [
+                {"$match": bucket_range_match(from_date, to_date, granularity, FINGERPRINT)},
                 {
-                    "$facet": {
-                        "results": [
-                            {"$sort": {"total_usage": -1}},
-                            {"$skip": skip},
-                            {"$limit": limit}
-                        ],
-                        "count": [{"$count": "total"}]
+                    "$group": {
+                        "_id": "$key",
+                        "total_usage": {"$sum": "$count"},
+                        "total_duration": {"$sum": "$total_duration"},
+                        "max_duration": {"$max": "$max_duration"}
                     }
                 },
+            ]
+        else:
+            # durations of either storage format, in seconds
+            duration = {"$ifNull": ["$queries.execution_duration", {"$divide": ["$queries.duration_us", 1000000]}]}
+            collection = Query
+            grouping = [
+                {"$match": request_range_match(from_date, to_date)},
+                {"$unwind": "$queries"},
+                {"$match": {"queries.fingerprint": {"$ne": None}}},
                 {
-                    "$project": {
-                        "results": 1,
-                        "count": {"$arrayElemAt": ["$count.total", 0]}
+                    "$group": {
+                        "_id": "$queries.fingerprint",
+                        "total_usage": {"$sum": 1},
+                        "total_duration": {"$sum": duration},
+                        "max_duration": {"$max": duration}
                     }
                 },
-            ])
-        )[0]
+            ]
+        sort_fields = [("total_usage", DESC), ("_id", DESC)]
+        page_stages = [
+            {
+                "$lookup": {
+                    "from": QueryFingerprint._get_name(),
+                    "localField": "_id",
+                    "foreignField": "fingerprint",
+                    "as": "statistics"
+                }
+            },
+            {
+                "$set": {
+                    "fingerprint": "$_id",
+                    "query": {"$first": "$statistics.normalized_sql"},
+                    "tables": {"$first": "$statistics.tables"}
+                }
+            },
+        ]
+
+        results, next_cursor = paginate(collection, grouping, sort_fields, cursor, limit, page_stages)
 
         try:
-            serializer = MostUsedQueriesSerializer(result["results"], many=True)
-            response_data = {"count": result["count"], "results": serializer.data}
+            serializer = MostUsedQueriesSerializer(results, many=True)
+            response_data = {
+                "count": cached_count(collection, grouping) if with_count else None,
+                "next_cursor": next_cursor,
+                "results": serializer.data
+            }
             return CustomResponse.successful_200(response_data)
         except Exception as e:
             print('e: ', str(e))
@@ -372,40 +455,177 @@ class SelectOrPrefetchRelatedPotentialCandidateEndpointsView(views.APIView):
             return CustomResponse.bad_request(request_serializer.errors)
 
         limit = request_serializer.validated_data.get('limit')
-        skip = request_serializer.validated_data.get('skip')
+        cursor = request_serializer.validated_data.get('cursor')
+        with_count = request_serializer.validated_data.get('with_count')
         from_date = request_serializer.validated_data.get('from_date')
         to_date = request_serializer.validated_data.get('to_date')
 
-        result = list(
-            Query.aggregate([
-                {
-                    "$match": {
-                        "request_execution_datetime": {"$gte": from_date, "$lte": to_date},
-                        "is_n_plus_one": True
-                    }
-                },
-                {
-                    "$facet": {
-                        "results": [
-                            {"$skip": skip},
-                            {"$limit": limit}
-                        ],
-                        "count": [{"$count": "total"}]
-                    }
-                },
+        match = [
+            {
+                "$match": request_range_match(from_date, to_date, is_n_plus_one=True)
+            },
+        ]
+        results, next_cursor = paginate(
+            Query, match, [("request_execution_datetime", DESC), ("_id", DESC)], cursor, limit)
+
+        try:
+            serializer = NPlusOneQueriesSerializer(expand_records(results), many=True)
+            response_data = {
+                "count": cached_count(Query, match) if with_count else None,
+                "next_cursor": next_cursor,
+                "results": serializer.data
+            }
+            return CustomResponse.successful_200(response_data)
+        except Exception as e:
+            print('e: ', str(e))
+            return CustomResponse.server_error('')
+
+
+class PercentilesView(views.APIView):
+    @extend_schema(parameters=[PercentilesRequestSerializer])
+    def get(self, request):
+        request_serializer = PercentilesRequestSerializer(data=request.query_params)
+        if not request_serializer.is_valid():
+            return CustomResponse.bad_request(request_serializer.errors)
+
+        limit = request_serializer.validated_data.get('limit')
+        from_date = request_serializer.validated_data.get('from_date')
+        to_date = request_serializer.validated_data.get('to_date')
+        group_by = request_serializer.validated_data.get('group_by')
+        sort_by = request_serializer.validated_data.get('sort_by')
+
+        try:
+            # The range is widened to whole minutes, the finest rollup granularity
+            buckets = QueryRollup.aggregate([
+                {"$match": covering_buckets_match(from_date, to_date, group_by, minute_buckets_since())},
                 {
                     "$project": {
-                        "results": 1,
-                        "count": {"$arrayElemAt": ["$count.total", 0]}
+                        "_id": 0,
+                        "key": 1,
+                        "count": 1,
+                        "latency_sketch": 1,
+                        "query_count_sketch": 1
                     }
-                }
+                },
             ])
-        )[0]
+            results = bucket_percentiles(buckets)
+            results.sort(key=lambda row: (row[sort_by] is not None, row[sort_by] or 0), reverse=True)
+            serializer = PercentilesSerializer(results[:limit], many=True)
+            return CustomResponse.successful_200({"results": serializer.data})
+        except Exception as e:
+            print('e: ', str(e))
+            return CustomResponse.server_error('')
+
+
+class ReleaseComparisonView(views.APIView):
+    """
+    Diff two releases by endpoint and by SQL fingerprint, from the rollup buckets of both.
+    Changes larger than the threshold are flagged as regressions or improvements when both
+    releases have enough samples; fingerprints seen in one release only are new or removed.
+    """
+    @extend_schema(parameters=[ReleaseComparisonRequestSerializer])
+    def get(self, request):
+        request_serializer = ReleaseComparisonRequestSerializer(data=request.query_params)
+        if not request_serializer.is_valid():
+            return CustomResponse.bad_request(request_serializer.errors)
+
+        base_release = request_serializer.validated_data.get('base_release')
+        target_release = request_serializer.validated_data.get('target_release')
+        from_date = request_serializer.validated_data.get('from_date')
+        to_date = request_serializer.validated_data.get('to_date')
+        threshold = request_serializer.validated_data.get('threshold')
+        min_samples = request_serializer.validated_data.get('min_samples')
+        only_changes = request_serializer.validated_data.get('only_changes')
+        limit = request_serializer.validated_data.get('limit')
+        if threshold is None:
+            threshold = profiler_setting('REGRESSION_THRESHOLD')
+        if min_samples is None:
+            min_samples = profiler_setting('REGRESSION_MIN_SAMPLES')
+
+        try:
+            endpoints, fingerprints = compare_releases(
+                base_release, target_release, from_date, to_date, threshold, min_samples)
+            if only_changes:
+                endpoints = [row for row in endpoints
+                             if row['regressions'] or row['improvements'] or row['status'] != COMMON]
+                fingerprints = [row for row in fingerprints
+                                if row['regressions'] or row['improvements'] or row['status'] != COMMON]
+            response_data = {
+                "base_release": base_release,
+                "target_release": target_release,
+                "regression_count": sum(bool(row['regressions']) for row in endpoints + fingerprints),
+                "endpoints": ReleaseEndpointDiffSerializer(endpoints[:limit], many=True).data,
+                "fingerprints": ReleaseFingerprintDiffSerializer(fingerprints[:limit], many=True).data
+            }
+            return CustomResponse.successful_200(response_data)
+        except Exception as e:
+            print('e: ', str(e))
+            return CustomResponse.server_error('')
+
+
+class IndexSuggestionsView(views.APIView):
+    """
+    The index advisor's suggestions, by estimated benefit (plan cost reduction times call count)
+    or by the total time of their fingerprint.
+    """
+    @extend_schema(parameters=[IndexSuggestionsRequestSerializer])
+    def get(self, request):
+        request_serializer = IndexSuggestionsRequestSerializer(data=request.query_params)
+        if not request_serializer.is_valid():
+            return CustomResponse.bad_request(request_serializer.errors)
+
+        limit = request_serializer.validated_data.get('limit')
+        cursor = request_serializer.validated_data.get('cursor')
+        with_count = request_serializer.validated_data.get('with_count')
+        with_empty = request_serializer.validated_data.get('with_empty')
+        sort_by = request_serializer.validated_data.get('sort_by')
+
+        match = [{"$match": {} if with_empty else {"suggestions.0": {"$exists": True}}}]
+        results, next_cursor = paginate(
+            IndexSuggestion, match, [(sort_by, DESC), ("fingerprint", DESC)], cursor, limit)
 
         try:
-            serializer = QueriesSerializer(result["results"], many=True)
-            response_data = {"count": result["count"], "results": serializer.data}
+            serializer = IndexSuggestionsSerializer(results, many=True)
+            response_data = {
+                "count": cached_count(IndexSuggestion, match) if with_count else None,
+                "next_cursor": next_cursor,
+                "results": serializer.data
+            }
             return CustomResponse.successful_200(response_data)
         except Exception as e:
             print('e: ', str(e))
             return CustomResponse.server_error('')
+
+
+class ParseCacheStatsView(views.APIView):
+    def get(self, request):
+        return CustomResponse.successful_200(get_parse_cache().stats())
+
+
+class ExportQueriesView(views.APIView):
+    @extend_schema(parameters=[QueriesExportRequestSerializer])
+    def get(self, request):
+        request_serializer = QueriesExportRequestSerializer(data=request.query_params)
+        if not request_serializer.is_valid():
+            return CustomResponse.bad_request(request_serializer.errors)
+
+        from_date = request_serializer.validated_data.get('from_date')
+        to_date = request_serializer.validated_data.get('to_date')
+        request_path = request_serializer.validated_data.get('request_path')
+        is_n_plus_one = request_serializer.validated_data.get('is_n_plus_one')
+        export_format = request_serializer.validated_data.get('export_format')
+
+        spec = {"request_execution_datetime": {"$gte": from_date, "$lte": to_date}}
+        if request_path is not None:
+            spec["request_path"] = request_path
+        if is_n_plus_one is not None:
+            spec["is_n_plus_one"] = is_n_plus_one
+        cursor = export_cursor(spec, profiler_setting('EXPORT_BATCH_SIZE'))
+
+        if export_format == 'csv':
+            response = StreamingHttpResponse(stream_csv(cursor), content_type='text/csv')
+            response['Content-Disposition'] = 'attachment; filename="queries.csv"'
+        else:
+            response = StreamingHttpResponse(stream_ndjson(cursor), content_type='application/x-ndjson')
+            response['Content-Disposition'] = 'attachment; filename="queries.ndjson"'
+        return response
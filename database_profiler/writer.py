@@ -0,0 +1,250 @@
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+from bson import ObjectId
+from pymongo.errors import DuplicateKeyError
+from pymongo_wrapper.model import Query
+from .analysis import analyze_record
+from .conf import profiler_setting
+from .fingerprint_stats import update_fingerprint_stats
+from .plans import claim_explain_slot, slow_request_threshold, slow_statement
+from .rollups import rollup_records
+from .storage import compact_record, SqlTextStore, COMPACT, STORAGE_FORMATS
+from .tasks import explain_slow_query
+
+logger = logging.getLogger(__name__)
+
+DROP_OLDEST = 'drop_oldest'
+DROP_NEWEST = 'drop_newest'
+BLOCK = 'block'
+OVERFLOW_POLICIES = (DROP_OLDEST, DROP_NEWEST, BLOCK)
+
+
+class QueryWriter:
+    """
+    Persists captured request records in the background.
+
+    Records are put on a bounded in-process queue and a daemon worker thread
+    writes them to the Query collection with insert_many, whenever batch_size
+    records are waiting or flush_interval seconds have passed. Before a batch
+    is written, every record goes through the deferred analysis stage; once it
+    is written, the batch is added to the rollup buckets.
+
+    In the compact storage format, the SQL text of new fingerprints is written to
+    SqlText before the documents referencing it.
+    """
+
+    def __init__(self, queue_size, batch_size, flush_interval, overflow_policy, shutdown_timeout,
+                 storage_format=COMPACT, capture_params=False, sql_text_cache_size=10000):
+        if overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Invalid overflow policy: {overflow_policy}. Allowed values are: "
+                             f"{', '.join(OVERFLOW_POLICIES)}.")
+        if storage_format not in STORAGE_FORMATS:
+            raise ValueError(f"Invalid storage format: {storage_format}. Allowed values are: "
+                             f"{', '.join(STORAGE_FORMATS)}.")
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.overflow_policy = overflow_policy
+        self.shutdown_timeout = shutdown_timeout
+        self.storage_format = storage_format
+        self.capture_params = capture_params
+        self.sql_texts = SqlTextStore(sql_text_cache_size, capture_params)
+        self.dropped = 0
+        self._lock = threading.Lock()
+        self._pid = None
+        self._queue = None
+        self._stop_event = None
+        self._thread = None
+
+    def _ensure_started(self):
+        # Threads do not survive a fork, so every (gunicorn) worker process starts its own.
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = queue.Queue(maxsize=self.queue_size)
+            self._stop_event = threading.Event()
+            self._thread = threading.Thread(target=self._run, name='database-profiler-writer', daemon=True)
+            self._thread.start()
+            self._pid = os.getpid()
+            atexit.register(self.stop)
+
+    def submit(self, record):
+        """
+        Queue a request record for persistence, applying the overflow policy if the queue is full.
+        """
+        self._ensure_started()
+        if self.overflow_policy == BLOCK:
+            self._queue.put(record)
+            return
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            if self.overflow_policy == DROP_OLDEST:
+                try:
+                    self._queue.get_nowait()
+                except queue.Empty:
+                    pass
+                try:
+                    self._queue.put_nowait(record)
+                except queue.Full:
+                    pass
+            self.dropped += 1
+
+    def stop(self):
+        """
+        Flush everything still queued and stop the worker thread.
+        """
+        if self._pid != os.getpid() or self._stop_event.is_set():
+            return
+        self._stop_event.set()
+        self._thread.join(self.shutdown_timeout)
+
+    def _run(self):
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+        while True:
+            stopping = self._stop_event.is_set()
+            try:
+                if stopping:
+                    batch.append(self._queue.get_nowait())
+                else:
+                    timeout = max(deadline - time.monotonic(), 0)
+                    batch.append(self._queue.get(timeout=min(timeout, self.flush_interval)))
+            except queue.Empty:
+                if stopping:
+                    self._safe_flush(batch)
+                    return
+            if len(batch) >= self.batch_size or time.monotonic() >= deadline:
+                self._safe_flush(batch)
+                batch = []
+                deadline = time.monotonic() + self.flush_interval
+
+    def _safe_flush(self, batch):
+        # the worker thread must survive anything, otherwise every later record is lost
+        # (and request threads block forever under the block policy)
+        try:
+            self._flush(batch)
+        except Exception as e:
+            logger.error(f"Flushing {len(batch)} captured requests failed: {e}")
+
+    def _flush(self, batch):
+        if not batch:
+            return
+        analyzed_records = []
+        for record in batch:
+            try:
+                analyzed_records.append(analyze_record(record))
+            except Exception as e:
+                logger.error(f"Analyzing captured request {record.get('request_path')} failed: {e}")
+        if not analyzed_records:
+            return
+        is_compact = self.storage_format == COMPACT
+        if is_compact:
+            try:
+                self.sql_texts.save(analyzed_records)
+            except Exception as e:
+                # never store documents referencing SQL text that may not exist
+                logger.error(f"Saving the SQL text of {len(analyzed_records)} captured requests failed, "
+                             f"storing them expanded: {e}")
+                is_compact = False
+        records = []
+        models = []
+        for record in analyzed_records:
+            try:
+                model = Query(**(compact_record(record, self.capture_params) if is_compact else record))
+                # a fixed _id makes retrying the insert of an already stored document harmless
+                model['_id'] = ObjectId()
+            except Exception as e:
+                logger.error(f"Building the document of captured request {record.get('request_path')} failed: {e}")
+                continue
+            records.append(record)
+            models.append(model)
+        if not models:
+            return
+        try:
+            Query.insert_many(models, ordered=False)
+        except Exception as e:
+            # one document that cannot be stored must not cost the whole batch
+            logger.error(f"Saving {len(models)} captured requests failed, retrying them one by one: {e}")
+            stored = [self._insert_one(model) for model in models]
+            records = [record for record, is_stored in zip(records, stored) if is_stored]
+            models = [model for model, is_stored in zip(models, stored) if is_stored]
+            if not models:
+                return
+        if profiler_setting('ROLLUPS_ENABLED'):
+            try:
+                rollup_records(records)
+            except Exception as e:
+                logger.error(f"Updating rollups for {len(records)} captured requests failed: {e}")
+        if profiler_setting('FINGERPRINT_STATS_ENABLED'):
+            try:
+                update_fingerprint_stats(records)
+            except Exception as e:
+                logger.error(f"Updating fingerprint statistics for {len(records)} captured requests failed: {e}")
+        if profiler_setting('EXPLAIN_SLOW_QUERIES'):
+            try:
+                self._explain_slow_queries(records, models)
+            except Exception as e:
+                logger.error(f"Scheduling EXPLAIN ANALYZE for {len(records)} captured requests failed: {e}")
+
+    @staticmethod
+    def _insert_one(model):
+        """
+        Insert a single document, returning whether it is stored.
+        """
+        try:
+            Query._get_collection().insert_one(model.copy())
+        except DuplicateKeyError:
+            # stored by the failed batch insert already
+            pass
+        except Exception as e:
+            logger.error(f"Saving captured request {model.get('request_path')} failed: {e}")
+            return False
+        return True
+
+    @staticmethod
+    def _explain_slow_queries(records, models):
+        """
+        Hand the slowest SELECT of every slow request to a Celery worker for EXPLAIN ANALYZE.
+        The statement and its params are taken from the record, compact documents do not keep them.
+        """
+        threshold = slow_request_threshold()
+        if threshold is None:
+            return
+        for record, model in zip(records, models):
+            query = slow_statement(record, threshold)
+            if query is None or not claim_explain_slot(query['fingerprint']):
+                continue
+            explain_slow_query.delay(str(model['_id']), record['slowest_query_index'], query['fingerprint'],
+                                     query['db_alias'], query['sql'], list(query['params']))
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def get_writer():
+    """
+    Return the process-wide QueryWriter, configured from the DATABASE_PROFILER setting.
+    """
+    global _writer
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                _writer = QueryWriter(
+                    queue_size=profiler_setting('WRITER_QUEUE_SIZE'),
+                    batch_size=profiler_setting('WRITER_BATCH_SIZE'),
+                    flush_interval=profiler_setting('WRITER_FLUSH_INTERVAL_SECONDS'),
+                    overflow_policy=profiler_setting('WRITER_OVERFLOW_POLICY'),
+                    shutdown_timeout=profiler_setting('WRITER_SHUTDOWN_TIMEOUT_SECONDS'),
+                    storage_format=profiler_setting('STORAGE_FORMAT'),
+                    capture_params=profiler_setting('CAPTURE_PARAMS'),
+                    sql_text_cache_size=profiler_setting('PARSE_CACHE_SIZE'),
+                )
+    return _writer
@@ -45,8 +45,9 @@ from .helpers import check_none, Document
 
 from bson.dbref import DBRef
 from bson.objectid import ObjectId
+from pymongo import ASCENDING, DESCENDING, IndexModel
 from pymongo.collection import Collection
-from pymongo.results import DeleteResult, UpdateResult
+from pymongo.results import BulkWriteResult, DeleteResult, InsertManyResult, UpdateResult
 
 import typing
 from typing import Any, Callable, cast, Dict, Iterator
@@ -56,6 +57,15 @@ from typing import Optional, Sequence, Tuple, Type, TypeVar, Union
 M = TypeVar("M", bound="Model")
 P = TypeVar("P", bound="PolyModel")
 
+# index_information() fields that are not options of the index, or are ignored by the server
+_IGNORED_INDEX_OPTIONS = ("v", "key", "name", "ns", "background", "expireAfterSeconds")
+
+
+def _index_options(index: Dict[str, Any]) -> Dict[str, Any]:
+    """ The options of an index document that have to match for an index to be kept """
+    return {option: value for option, value in index.items()
+            if option not in _IGNORED_INDEX_OPTIONS and value is not False}
+
 
 _UpdateCallable = Callable[..., UpdateResult]
 
@@ -134,6 +144,7 @@ class Model(metaclass=NewModelClass):
     _name = None  # type: Optional[str]
     _pymongo_data: Optional[dict[str, Any]] = None
     _collection: Optional[Collection[Document]] = None
+    _indexes = []  # type: Sequence[IndexModel]
     _child_models = None  # type: Optional[Dict[Any, Type["PolyModel"]]]
     _init_okay = False  # type: bool
     __fields = None  # type: Optional[Dict[int, str]]
@@ -452,6 +463,28 @@ class Model(metaclass=NewModelClass):
 
         return Cursor(cls, *args, **kwargs)
 
+    @classmethod
+    def insert_many(cls: Type[M], models: Sequence[M], **kwargs: Any) -> InsertManyResult:
+        """
+        Wrapper for PyMongo's insert_many.
+        Checks required fields on every model and sets the inserted ids.
+        """
+        for model in models:
+            model._check_required()
+        coll = cls._get_collection()
+        result = coll.insert_many([model.copy() for model in models], **kwargs)
+        for model, object_id in zip(models, result.inserted_ids):
+            model.__setitem__(cls._id_field, object_id)
+        return result
+
+    @classmethod
+    def bulk_write(cls: Type[M], requests: Sequence[Any], **kwargs: Any) -> BulkWriteResult:
+        """
+        Wrapper for PyMongo's bulk_write.
+        """
+        coll = cls._get_collection()
+        return coll.bulk_write(requests, **kwargs)
+
     @classmethod
     def update_one(cls: Type[M], filter: Dict[str, Any], update: Dict[str, Any], **kwargs: Any) -> UpdateResult:
         """
@@ -520,6 +553,54 @@ class Model(metaclass=NewModelClass):
         """ Wrapper for collection ensure_index() """
         return cls._get_collection().ensure_index(*args, **kwargs)
 
+    @classmethod
+    def ensure_indexes(
+            cls: Type[M],
+            expire_after_seconds: Optional[Dict[str, Optional[int]]] = None,
+            drop_undeclared: bool = False) -> None:
+        """
+        Idempotently creates the indexes declared in _indexes.
+
+        expire_after_seconds maps index names to a TTL (None removes it). TTL
+        changes on existing indexes are applied in place with collMod, any
+        other change of the key or options drops and recreates the index.
+        With drop_undeclared, existing indexes that are no longer declared
+        are dropped (the _id index is always kept).
+        """
+        expire_after_seconds = expire_after_seconds or {}
+        coll = cls._get_collection()
+        existing = coll.index_information()
+        declared = set()
+        for index in cls._indexes:
+            document = dict(index.document)
+            name = document["name"]
+            declared.add(name)
+            if name in expire_after_seconds:
+                if expire_after_seconds[name] is None:
+                    document.pop("expireAfterSeconds", None)
+                else:
+                    document["expireAfterSeconds"] = expire_after_seconds[name]
+            key = list(document.pop("key").items())
+            document.pop("name")
+            current = existing.get(name)
+            if current is not None and current["key"] == key \
+                    and _index_options(current) == _index_options(document):
+                ttl = document.get("expireAfterSeconds")
+                if current.get("expireAfterSeconds") == ttl:
+                    continue
+                if ttl is not None:
+                    coll.database.command(
+                        "collMod", coll.name,
+                        index={"name": name, "expireAfterSeconds": ttl})
+                    continue
+            if current is not None:
+                coll.drop_index(name)
+            coll.create_index(key, name=name, **document)
+        if drop_undeclared:
+            for name in existing:
+                if name != "_id_" and name not in declared:
+                    coll.drop_index(name)
+
     @classmethod
     def drop_indexes(cls: Type[M], *args: Any, **kwargs: Any) -> Any:
         """ Wrapper for collection drop_indexes() """
@@ -758,11 +839,136 @@ __all__ = ["Model", "PolyModel"]
 
 # adding models to the databases
 class Query(Model):
+    _indexes = [
+        IndexModel([("request_execution_datetime", DESCENDING)], name="request_execution_datetime"),
+        IndexModel([("is_n_plus_one", ASCENDING), ("request_execution_datetime", DESCENDING)],
+                   name="is_n_plus_one_request_execution_datetime"),
+        IndexModel([("request_path", ASCENDING), ("request_execution_datetime", DESCENDING)],
+                   name="request_path_request_execution_datetime"),
+        IndexModel([("total_duration", DESCENDING), ("_id", DESCENDING), ("request_execution_datetime", DESCENDING)],
+                   name="total_duration_id_request_execution_datetime"),
+        IndexModel([("max_query_duration", DESCENDING), ("_id", DESCENDING),
+                    ("request_execution_datetime", DESCENDING)],
+                   name="max_query_duration_id_request_execution_datetime"),
+        IndexModel([("replay_id", ASCENDING)], name="replay_id",
+                   partialFilterExpression={"replay_id": {"$type": "string"}}),
+    ]
+
     queries = Field[object](list, required=True)
     request_path = Field[str](str, required=True)
+    request_method = Field[str](str, default=None)
+    request_query_string = Field[str](str, default=None)
+    request_authenticated = Field[bool](bool, default=False)
+    replay_id = Field[str](str, default=None)
+    release = Field[str](str, default=None)
     request_execution_datetime = Field(datetime, required=True)
     response_status_code = Field[int](int, required=True)
+    # JSON text, older documents hold the decoded data
     response_data = Field[Dict[str, Any]](default=None, description="API response data")
+    response_size = Field[int](int, default=None)
+    response_hash = Field[str](str, default=None)
+    response_preview = Field[str](str, default=None)
     is_n_plus_one = Field[bool](bool, default=False)
     n_plus_one_suggestion = Field[str](str, default=None)
+    n_plus_one_groups = Field[object](list, default=list)
+    sample_reason = Field[str](str, default=None)
+    request_finished_datetime = Field(datetime, default=None)
+    request_duration = Field[float](float, default=None)
+    render_duration = Field[float](float, default=None)
+    app_duration = Field[float](float, default=None)
+    total_duration = Field[float](float, default=0.0)
+    total_fetch_duration = Field[float](float, default=0.0)
+    profiler_overhead = Field[float](float, default=None)
+    query_count = Field[int](int, default=0)
+    max_query_duration = Field[float](float, default=0.0)
+    slowest_query_index = Field[int](int, default=None)
+    # compact documents reference the SQL text in SqlText and hoist the per-request constants
+    storage_format = Field[str](str, default='expanded')
+    db_alias = Field[str](str, default=None)
+    db_vendor = Field[str](str, default=None)
+    first_query_time = Field(datetime, default=None)
+    table_counts = Field[object](list, default=None)
+    # EXPLAIN ANALYZE of the slowest query of a slow request, filled in by a Celery worker
+    explain_plan = Field[object](dict, default=None)
     # index_suggestion = Field[str](str, default=None)
+
+
+class QueryRollup(Model):
+    _indexes = [
+        IndexModel([("granularity", ASCENDING), ("dimension", ASCENDING), ("bucket_start", ASCENDING),
+                    ("key", ASCENDING), ("release", ASCENDING)],
+                   name="granularity_dimension_bucket_start_key_release", unique=True),
+        IndexModel([("release", ASCENDING), ("dimension", ASCENDING), ("granularity", ASCENDING),
+                    ("bucket_start", ASCENDING)], name="release_dimension_granularity_bucket_start"),
+        # TTL index expiring the minute buckets, see MINUTE_ROLLUP_RETENTION_DAYS
+        IndexModel([("bucket_start", ASCENDING)], name="minute_bucket_start",
+                   partialFilterExpression={"granularity": "minute"}),
+    ]
+
+    granularity = Field[str](str, required=True)
+    bucket_start = Field(datetime, required=True)
+    dimension = Field[str](str, required=True)
+    key = Field[str](str, required=True)
+    # buckets are kept per release, so two deploys can be compared
+    release = Field[str](str, default=None)
+    count = Field[int](int, default=0)
+    total_duration = Field[float](float, default=0.0)
+    max_duration = Field[float](float, default=0.0)
+    status_codes = Field[Dict[str, int]](dict, default=dict)
+    latency_sketch = Field[Dict[str, int]](dict, default=dict)
+    query_count_sketch = Field[Dict[str, int]](dict, default=dict)
+    # request, db and render time summed over the requests whose queries were captured
+    timings = Field[Dict[str, float]](dict, default=dict)
+
+
+class IndexSuggestion(Model):
+    _indexes = [
+        IndexModel([("fingerprint", ASCENDING)], name="fingerprint", unique=True),
+        IndexModel([("total_duration", DESCENDING), ("fingerprint", DESCENDING)], name="total_duration_fingerprint"),
+        IndexModel([("estimated_benefit", DESCENDING), ("fingerprint", DESCENDING)],
+                   name="estimated_benefit_fingerprint"),
+    ]
+
+    fingerprint = Field[str](str, required=True)
+    sql = Field[str](str, required=True)
+    tables = Field[object](list, default=list)
+    db_alias = Field[str](str, default=None)
+    call_count = Field[int](int, default=0)
+    total_duration = Field[float](float, default=0.0)
+    suggestions = Field[object](list, default=list)
+    estimated_benefit = Field[float](float, default=0.0)
+    what_if_method = Field[str](str, default=None)
+    analyzed_at = Field(datetime, default=None)
+
+
+class QueryFingerprint(Model):
+    _indexes = [
+        IndexModel([("fingerprint", ASCENDING)], name="fingerprint", unique=True),
+        IndexModel([("call_count", DESCENDING), ("fingerprint", DESCENDING)], name="call_count_fingerprint"),
+        IndexModel([("last_seen", DESCENDING)], name="last_seen"),
+    ]
+
+    fingerprint = Field[str](str, required=True)
+    normalized_sql = Field[str](str, required=True)
+    statement_type = Field[str](str, default=None)
+    tables = Field[object](list, default=list)
+    call_count = Field[int](int, default=0)
+    total_duration = Field[float](float, default=0.0)
+    min_duration = Field[float](float, default=None)
+    max_duration = Field[float](float, default=None)
+    rows_affected = Field[int](int, default=0)
+    first_seen = Field(datetime, default=None)
+    last_seen = Field(datetime, default=None)
+
+
+class SqlText(Model):
+    _indexes = [
+        IndexModel([("fingerprint", ASCENDING)], name="fingerprint", unique=True),
+    ]
+
+    fingerprint = Field[str](str, required=True)
+    sql = Field[str](str, required=True)
+    # the params of the first captured execution, needed to EXPLAIN the statement
+    params = Field[object](list, default=None)
+    tables = Field[object](list, default=list)
+    first_seen = Field(datetime, default=None)
@@ -2,6 +2,10 @@ import sqlparse
 from sqlparse.tokens import Keyword, DML
 from sqlparse.sql import IdentifierList, Identifier
 import uuid
+from datetime import date, datetime, time
+
+# the largest integer BSON can store (int64)
+BSON_MAX_INT = 2 ** 63 - 1
 
 
 def convert_uuid_to_string(value):
@@ -21,3 +25,27 @@ def convert_uuid_to_string(value):
     else:
         # Return the value unchanged
         return value
+
+
+def convert_to_bson_safe(value):
+    """
+    Recursively converts a value into one MongoDB can store: Decimals, dates, times,
+    timedeltas, UUIDs, integers beyond int64 and any other unknown type become strings.
+    """
+    if value is None or isinstance(value, (bool, float, str, bytes, datetime)):
+        return value
+    elif isinstance(value, int):
+        return value if -BSON_MAX_INT - 1 <= value <= BSON_MAX_INT else str(value)
+    elif isinstance(value, (list, tuple)):
+        # Recursively process each item in the list
+        return [convert_to_bson_safe(item) for item in value]
+    elif isinstance(value, dict):
+        # Recursively process each key-value pair, keys must be strings
+        return {str(key): convert_to_bson_safe(val) for key, val in value.items()}
+    elif isinstance(value, (bytearray, memoryview)):
+        return bytes(value)
+    elif isinstance(value, (date, time)):
+        return value.isoformat()
+    else:
+        # Decimal, timedelta, UUID and anything else
+        return str(value)